@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+'''
+    Single entry point for the Python clients, e.g....
+
+        python3 amqp-client.py pika-producer -q some_queue -m 100
+        python3 amqp-client.py proton-receiver -t some_topic -m 0
+
+    Only the chosen client, and the library it is built on, is imported, so
+    short-lived senders don't pay for the ones they don't use.  Everything
+    after the client name is passed to the client as its own options.
+
+    Execute script with -h parameter for usage
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from amqp_common import client
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in client.CLIENTS:
+        usage = "usage: %s {%s} [options]\n" % (os.path.basename(sys.argv[0]), ",".join(sorted(client.CLIENTS)))
+        if len(sys.argv) > 1 and sys.argv[1] in ["-h", "--help"]:
+            sys.stdout.write(usage)
+            sys.exit(0)
+        sys.stderr.write(usage)
+        sys.exit(2)
+
+    # the client parses the rest of the command line, with its usage naming the command
+    command = sys.argv.pop(1)
+    sys.argv[0] = "%s %s" % (os.path.basename(sys.argv[0]), command)
+    client.load(command).main()
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
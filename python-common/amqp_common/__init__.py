@@ -0,0 +1,3 @@
+'''
+    Code shared by the Python Pika and Proton clients.
+'''
@@ -0,0 +1,115 @@
+'''
+    Packs many small logical messages into a single AMQP message.
+
+    An envelope is a count followed by length-prefixed entries...
+
+        entry count (4 bytes)
+        send timestamp (8 byte double) | payload length (4 bytes) | payload
+        ...
+
+    ...all big-endian.  Envelopes are flagged with BATCH_CONTENT_TYPE so that
+    the receivers know to unpack them, and each entry keeps its own send time
+    so that latency is still measured per logical message.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+BATCH_CONTENT_TYPE = "application/vnd.amqp-batch"
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import struct
+import time
+
+BATCH_HEADER = struct.Struct(">I")
+ENTRY_HEADER = struct.Struct(">dI")
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def unpack(envelope):
+    # returns a list of (send timestamp, payload) for each entry in the envelope
+    envelope = memoryview(envelope)
+    (count,) = BATCH_HEADER.unpack_from(envelope, 0)
+    offset = BATCH_HEADER.size
+
+    entries = []
+    for i in range(count):
+        (timestamp, length) = ENTRY_HEADER.unpack_from(envelope, offset)
+        offset += ENTRY_HEADER.size
+        entries.append((timestamp, envelope[offset:offset + length].tobytes()))
+        offset += length
+
+    return entries
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Batcher(object):
+    """Collects payloads until the batch is full (by count or by size) or
+    its oldest entry has lingered for long enough, at which point the
+    producer should pack and send it.
+
+    """
+
+    def __init__(self, max_messages, max_bytes, linger):
+        """
+        :param int max_messages: Most logical messages per envelope
+        :param int max_bytes: Envelope size at which the batch counts as full
+        :param float linger: Seconds the first entry may wait before sending
+
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self._entries = []
+        self._size = BATCH_HEADER.size
+        self._started = None
+
+
+    def __len__(self):
+        # entries are held as header, payload pairs
+        return len(self._entries) // 2
+
+
+    def add(self, payload, timestamp=None):
+        """Add a payload to the batch, returning True if the batch is now full.
+
+        :param bytes payload: The logical message body
+        :param float timestamp: When it was sent (defaults to now)
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if not self._entries:
+            self._started = timestamp
+
+        self._entries.append(ENTRY_HEADER.pack(timestamp, len(payload)))
+        self._entries.append(payload)
+        self._size += ENTRY_HEADER.size + len(payload)
+
+        return self.full()
+
+
+    def full(self):
+        return len(self) >= self.max_messages or self._size >= self.max_bytes
+
+
+    def due(self):
+        # the oldest entry has waited out the linger time
+        return bool(self._entries) and time.time() - self._started >= self.linger
+
+
+    def pack(self):
+        """Return (envelope, number of logical messages) and start a new batch.
+
+        """
+        count = len(self)
+        envelope = BATCH_HEADER.pack(count) + b"".join(self._entries)
+
+        self._entries = []
+        self._size = BATCH_HEADER.size
+        self._started = None
+
+        return (envelope, count)
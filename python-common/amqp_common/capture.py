@@ -0,0 +1,307 @@
+'''
+    Capture log for received messages.
+
+    A capture is a directory of numbered segment files.  Each segment starts
+    with CAPTURE_MAGIC and is followed by length-prefixed records...
+
+        receive timestamp (double) | properties length | body length
+        properties (UTF-8 JSON)    | body
+
+    Segments may be written through gzip or zstd, in which case the whole
+    segment stream is compressed.  The file senders recognise captures and
+    replay the records with their original properties.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+CAPTURE_MAGIC = b"AMQPCAP1"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+SEGMENT_SUFFIXES = {"none": ".cap", "gzip": ".cap.gz", "zstd": ".cap.zst"}
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import importlib.util
+import io
+import json
+import logging
+import os
+import struct
+import threading
+
+# gzip and zstandard are only imported when a compressed capture is opened
+ZSTD_AVAILABLE = importlib.util.find_spec("zstandard") is not None
+
+RECORD_HEADER = struct.Struct(">dII")
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def open_input(filename, compression="auto"):
+    # opens the file as a binary stream, decompressing incrementally if need be
+    raw_file = open(filename, 'rb')
+
+    if compression == "auto":
+        magic = raw_file.peek(4)[:4]
+        if magic.startswith(GZIP_MAGIC):
+            compression = "gzip"
+        elif magic == ZSTD_MAGIC:
+            compression = "zstd"
+        else:
+            compression = "none"
+
+    logging.debug("Opening %s with compression %s", filename, compression)
+
+    if compression == "gzip":
+        import gzip
+        return gzip.GzipFile(fileobj=raw_file, mode='rb')
+    elif compression == "zstd":
+        if not ZSTD_AVAILABLE:
+            raw_file.close()
+            raise Exception("zstd input requires the 'zstandard' package to be installed")
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw_file))
+    else:
+        return raw_file
+
+
+def is_capture(path):
+    # a capture is either a directory of segments or a single segment file
+    if os.path.isdir(path):
+        return True
+
+    with open_input(path) as a_file:
+        return a_file.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def list_segments(path):
+    # returns the segment files making up a capture, in the order written
+    if not os.path.isdir(path):
+        return [path]
+
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.startswith("segment-"))
+
+
+def read_capture(path):
+    # yields (receive timestamp, properties, body) for every captured message
+    for segment in list_segments(path):
+        with open_input(segment) as a_file:
+            if a_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise Exception(segment + " is not a capture segment")
+
+            while True:
+                # a short read is a record torn by an unclean shutdown (or a
+                # segment that is still being written), so stop there
+                try:
+                    header = a_file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+
+                    (timestamp, properties_length, body_length) = RECORD_HEADER.unpack(header)
+                    properties = a_file.read(properties_length)
+                    body = a_file.read(body_length)
+                    if len(body) < body_length:
+                        break
+                except EOFError:
+                    break
+
+                yield (timestamp, json.loads(properties.decode('utf-8')), body)
+
+
+def encode_body(body):
+    # captures hold bytes, so note how to turn the body back into its original type
+    if isinstance(body, bytes):
+        return (body, "binary")
+    elif isinstance(body, str):
+        return (body.encode('utf-8'), "text")
+    else:
+        # as with the properties, AMQP types JSON has no place for (symbols, UUIDs,
+        # decimals, nested binary...) are captured as their text
+        return (json.dumps(body, ensure_ascii=False, default=str).encode('utf-8'), "json")
+
+
+def decode_body(body, properties):
+    # the reverse of encode_body
+    body_type = properties.get("body_type", "binary")
+    if body_type == "text":
+        return body.decode('utf-8')
+    elif body_type == "json":
+        return json.loads(body.decode('utf-8'))
+    else:
+        return body
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class CaptureWriter(object):
+    """Appends received messages to a segmented capture log.
+
+    Messages are packed into an in-memory buffer by the consuming thread and
+    written out (and compressed) by a background flusher thread, so the
+    consumer only pays for the packing.  The flusher wakes every
+    flush_interval seconds, or sooner once buffer_size bytes are waiting.
+    If writing fails, the error is logged and no more messages are
+    captured (they are counted as dropped).
+
+    """
+
+    def __init__(
+        self,
+        directory,
+        compression="none",
+        segment_size=64 * 1024 * 1024,
+        buffer_size=1024 * 1024,
+        flush_interval=1.0
+    ):
+        """Create the capture directory (if need be) and start the flusher.
+
+        :param str directory: Where to write the segments
+        :param str compression: "none", "gzip" or "zstd"
+        :param int segment_size: Uncompressed bytes per segment before rolling
+        :param int buffer_size: Buffered bytes that trigger an early flush
+        :param float flush_interval: Maximum seconds between flushes
+
+        """
+        if compression == "zstd" and not ZSTD_AVAILABLE:
+            raise Exception("zstd capture requires the 'zstandard' package to be installed")
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._directory = directory
+        self._compression = compression
+        self._segment_size = segment_size
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+
+        self._buffer = []
+        self._buffered = 0
+        # records taken from the buffer by the flusher and not yet written out
+        self._flushing = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+
+        self._segment = None
+        self._segment_number = len(list_segments(directory))
+        self._segment_written = 0
+        self.captured = 0
+        self.dropped = 0
+        # why the flusher stopped writing, if it has
+        self.error = None
+
+        self._flusher = threading.Thread(target=self._run, name="capture")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+
+    def append(self, properties, body, timestamp):
+        """Buffer one message.
+
+        :param dict properties: The message properties (must be JSON-able)
+        :param bytes body: The message body
+        :param float timestamp: When the message was received
+
+        """
+        encoded_properties = json.dumps(properties, ensure_ascii=False, default=str).encode('utf-8')
+        record = b"".join((
+            RECORD_HEADER.pack(timestamp, len(encoded_properties), len(body)),
+            encoded_properties,
+            body))
+
+        with self._lock:
+            if self.error is not None:
+                self.dropped += 1
+                return
+            self._buffer.append(record)
+            self._buffered += len(record)
+            self.captured += 1
+            full = self._buffered >= self._buffer_size
+
+        if full:
+            self._wakeup.set()
+
+
+    def close(self):
+        """Flush anything outstanding, stop the flusher and close the segment.
+
+        """
+        self._closing = True
+        self._wakeup.set()
+        self._flusher.join()
+        logging.debug("Captured %s messages to %s", self.captured, self._directory)
+        if self.dropped:
+            logging.warning("%s messages not captured after capture failed: %s", self.dropped, self.error)
+
+
+    def _run(self):
+        try:
+            while not self._closing:
+                self._wakeup.wait(self._flush_interval)
+                self._wakeup.clear()
+                self._flush()
+
+            self._flush()
+            if self._segment:
+                self._segment.close()
+        except Exception as e:
+            # the consumer carries on, so stop it buffering records that will never be written
+            logging.error("Capture to %s failed, no more messages will be captured: %s", self._directory, e)
+            with self._lock:
+                self.error = e
+                lost = len(self._flushing) + len(self._buffer)
+                self.captured -= lost
+                self.dropped += lost
+                self._flushing = []
+                self._buffer = []
+                self._buffered = 0
+            if self._segment:
+                try:
+                    self._segment.close()
+                except Exception as close_error:
+                    logging.debug("Couldn't close capture segment: %s", close_error)
+                self._segment = None
+
+
+    def _flush(self):
+        with self._lock:
+            records = self._flushing = self._buffer
+            self._buffer = []
+            self._buffered = 0
+
+        for record in records:
+            if self._segment is None or self._segment_written >= self._segment_size:
+                self._roll_segment()
+            self._segment.write(record)
+            self._segment_written += len(record)
+
+        if records:
+            self._segment.flush()
+        self._flushing = []
+
+
+    def _roll_segment(self):
+        if self._segment:
+            self._segment.close()
+
+        filename = os.path.join(
+            self._directory,
+            "segment-%06d%s" % (self._segment_number, SEGMENT_SUFFIXES[self._compression]))
+        logging.debug("Starting capture segment %s", filename)
+
+        if self._compression == "gzip":
+            import gzip
+            self._segment = gzip.open(filename, 'wb')
+        elif self._compression == "zstd":
+            import zstandard
+            self._segment = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        else:
+            self._segment = open(filename, 'wb')
+
+        self._segment.write(CAPTURE_MAGIC)
+        self._segment_number += 1
+        self._segment_written = len(CAPTURE_MAGIC)
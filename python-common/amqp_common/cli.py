@@ -0,0 +1,60 @@
+'''
+    Command line plumbing shared by the client scripts - the broker string
+    check, the verbose option, logging set-up and clean_url - so that each
+    behaves the same way in every script.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+LOG_FORMAT = '[%(levelname)s] (%(threadName)-10s) %(message)s'
+
+# what a broker string looks like to each client library, with an example for the error message
+BROKER_FORMATS = {
+    "pika": (r'amqp(s?)://(.*):\d{1,5}$', "amqp://localhost:5672"),
+    "proton": (r'(.*):\d{1,5}', "localhost:5672")}
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import datetime
+import logging
+import re
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_verbose_option(opts):
+    opts.add_argument("--verbose", "-v",
+        required=False,
+        default=False,
+        action="store_true",
+        help="send log messages to sysout")
+
+
+def check_broker(opts, broker, library):
+    # rejects a broker string that the client library won't understand
+    (pattern, example) = BROKER_FORMATS[library]
+    if not re.match(pattern, broker):
+        opts.error("The broker connection string looks a bit dodgy.  It should be something like '%s'" % example)
+
+
+def log_level(options):
+    if options.verbose:
+        return logging.DEBUG
+    return logging.INFO
+
+
+def setup_logging(level):
+    logging.basicConfig(
+            level=level,
+            format=LOG_FORMAT,
+        )
+    logging.debug("%s Started", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+
+
+def clean_url(dirty_url):
+    # removes ID and password from URL, if present
+    if "@" in dirty_url:
+        return dirty_url.split('@', 1)[1]
+    else:
+        return dirty_url
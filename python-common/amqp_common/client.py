@@ -0,0 +1,125 @@
+'''
+    One way in to the Pika and Proton clients.
+
+    load() imports just the client script asked for, so pika or proton
+    (and everything the script needs) is only imported when one of its
+    clients is actually used.  producer() and consumer() build a client from
+    the options the two libraries have in common, choosing the library from
+    the broker string - 'amqp://...' or 'amqps://...' for pika and 'host:port'
+    for proton - and return an object with a run() method...
+
+        from amqp_common import client
+        client.producer("amqp://localhost:5672", queue="some_queue", max_messages=1000).run()
+
+    Any other keyword arguments are passed on to the client class itself
+    (Publisher, Consumer, Send or Recv).
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# the folder and script behind each client command
+CLIENTS = {
+    "pika-producer": ("python-pika", "pika_producer"),
+    "pika-receiver": ("python-pika", "pika_receiver"),
+    "pika-file-sender": ("python-pika", "pika_file_sender"),
+    "pika-consumer-harness": ("python-pika", "pika_consumer_harness"),
+    "pika-rpc-client": ("python-pika", "pika_rpc_client"),
+    "proton-producer": ("python-proton", "proton_producer"),
+    "proton-receiver": ("python-proton", "proton_receiver"),
+    "proton-file-sender": ("python-proton", "proton_file_sender")}
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import importlib
+import os
+import sys
+
+# the client folders sit alongside python-common
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def load(command):
+    # imports (once) and returns the module behind a client command
+    (folder, module_name) = CLIENTS[command]
+    path = os.path.normpath(os.path.join(ROOT, folder))
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module(module_name)
+
+
+def library(broker):
+    # "pika" for AMQP 0-9-1 URLs, "proton" for AMQP 1.0 addresses
+    if broker.startswith("amqp://") or broker.startswith("amqps://"):
+        return "pika"
+    return "proton"
+
+
+def producer(broker, queue=None, topic=None, max_messages=100, persistent=False, exchange=None, **kwargs):
+    # builds a producer for one queue or topic (or, with proton, lists of them)
+    if library(broker) == "pika":
+        if topic:
+            (routing_key, exchange_type) = (topic, "topic")
+        else:
+            (routing_key, exchange_type) = (queue, "direct")
+
+        module = load("pika-producer")
+        return module.Publisher(broker, exchange or routing_key, exchange_type, routing_key, max_messages, persistent, **kwargs)
+
+    module = load("proton-producer")
+    handler = module.Send(broker, addresses(queue, topic),
+        kwargs.pop("links", 1),
+        kwargs.pop("connections", 1),
+        max_messages,
+        persistent,
+        kwargs.pop("subject", None),
+        kwargs.pop("user_id", None),
+        **kwargs)
+    return ContainerClient(handler, module.Container)
+
+
+def consumer(broker, queue=None, topic=None, max_messages=0, exchange=None, **kwargs):
+    # builds a consumer for one queue or topic (or, with proton, lists of them)
+    if library(broker) == "pika":
+        binding_keys = kwargs.pop("binding_keys", None)
+        binding_key = topic or queue
+
+        module = load("pika-receiver")
+        return module.Consumer(broker, exchange or binding_key, binding_keys or [binding_key], queue or topic, max_messages, **kwargs)
+
+    module = load("proton-receiver")
+    handler = module.Recv(broker, addresses(queue, topic),
+        kwargs.pop("links", 1),
+        kwargs.pop("connections", 1),
+        max_messages,
+        kwargs.pop("subscription_name", None),
+        **kwargs)
+    return ContainerClient(handler, module.Container)
+
+
+def addresses(queue, topic):
+    # proton's addresses for the named queue(s) and topic(s)
+    resources = []
+    for (prefix, names) in [("topic://", topic), ("queue://", queue)]:
+        if isinstance(names, str):
+            names = [names]
+        resources.extend(prefix + name for name in names or [])
+    return resources
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class ContainerClient(object):
+    """Gives a proton handler the same run() as the pika clients.
+
+    """
+
+    def __init__(self, handler, container_class):
+        self.handler = handler
+        self._container_class = container_class
+
+
+    def run(self):
+        self._container_class(self.handler).run()
@@ -0,0 +1,208 @@
+'''
+    Message body compression with pluggable codecs.
+
+    zlib is always available; lz4 and zstd are offered if the 'lz4' and
+    'zstandard' packages are installed, though neither is imported until a
+    message actually needs it, to keep start-up quick.  Bodies smaller than the threshold
+    are sent as they are, as are bodies that the codec fails to shrink.  The
+    codec is signalled in the message's content encoding (AMQP 0-9-1) or
+    COMPRESSION_PROPERTY (AMQP 1.0), with the uncompressed size alongside so
+    that receivers can report logical bytes without decompressing.  AMQP 1.0
+    bodies also note their original type in BODY_TYPE_PROPERTY.
+
+    A body in an encoding that isn't available here (lz4 or zstd without the
+    package installed, or a codec this module has never heard of) can't be
+    decompressed, so decompress raises UnsupportedEncoding rather than
+    handing it back as if it were plain.  Receivers check decodable() first
+    and count such bodies as undecodable.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+COMPRESSION_PROPERTY = "compression"
+ORIGINAL_LENGTH_PROPERTY = "original_length"
+BODY_TYPE_PROPERTY = "body_type"
+
+# content encodings (compared in lower case) that leave the body as it is:
+# other clients often put the character set here
+PLAIN_ENCODINGS = ("identity", "utf-8", "utf8", "us-ascii", "ascii", "iso-8859-1", "latin-1")
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import collections
+import importlib.util
+import zlib
+
+from amqp_common.capture import encode_body, decode_body
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def _load_lz4():
+    import lz4.frame
+    return (lz4.frame.compress, lz4.frame.decompress)
+
+
+def _load_zstd():
+    import zstandard
+
+    def zstd_compress(body):
+        return zstandard.ZstdCompressor().compress(body)
+
+    def zstd_decompress(body):
+        return zstandard.ZstdDecompressor().decompress(body)
+
+    return (zstd_compress, zstd_decompress)
+
+
+# each codec's (compress, decompress) functions, or None until an installed
+# optional codec is first used and its loader has imported it
+CODECS = {"zlib": (zlib.compress, zlib.decompress)}
+_LOADERS = {}
+for (name, package, loader) in [("lz4", "lz4", _load_lz4), ("zstd", "zstandard", _load_zstd)]:
+    if importlib.util.find_spec(package) is not None:
+        CODECS[name] = None
+        _LOADERS[name] = loader
+
+
+def register_codec(name, compress, decompress):
+    # makes another codec available to the clients
+    CODECS[name] = (compress, decompress)
+
+
+def load_codec(name):
+    # returns the (compress, decompress) functions of an available codec
+    functions = CODECS[name]
+    if functions is None:
+        functions = CODECS[name] = _LOADERS[name]()
+    return functions
+
+
+def decodable(encoding):
+    # whether a body with this content encoding can be read here
+    return not encoding or encoding.lower() in PLAIN_ENCODINGS or encoding in CODECS
+
+
+def decompress(body, encoding):
+    # returns the original body, or the body itself if it was not compressed
+    if not encoding or encoding.lower() in PLAIN_ENCODINGS:
+        return body
+    if encoding not in CODECS:
+        raise UnsupportedEncoding(encoding)
+    return load_codec(encoding)[1](body)
+
+
+def compress_value(compressor, body, properties):
+    # AMQP 1.0 bodies are typed, so they are serialised to bytes (noting the
+    # original type) before compressing; returns the body and properties to send
+    (encoded, body_type) = encode_body(body)
+    (compressed, encoding) = compressor.compress(encoded)
+    if not encoding:
+        return (body, properties)
+
+    properties = dict(properties or {})
+    properties[COMPRESSION_PROPERTY] = encoding
+    properties[ORIGINAL_LENGTH_PROPERTY] = len(encoded)
+    properties[BODY_TYPE_PROPERTY] = body_type
+    return (compressed, properties)
+
+
+def decompress_value(body, properties):
+    # the reverse of compress_value
+    if not properties or COMPRESSION_PROPERTY not in properties:
+        return body
+    return decode_body(decompress(body, properties[COMPRESSION_PROPERTY]), properties)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class UnsupportedEncoding(Exception):
+    """A body was compressed with a codec that isn't available here.
+
+    """
+
+    def __init__(self, encoding):
+        super(UnsupportedEncoding, self).__init__(
+            "Unsupported encoding %s (available: %s)" % (encoding, ", ".join(sorted(CODECS))))
+        self.encoding = encoding
+
+
+class CompressionStats(object):
+    """Tally of bytes on the wire against logical (uncompressed) bytes.
+
+    """
+
+    def __init__(self):
+        self.logical_bytes = 0
+        self.wire_bytes = 0
+        self.compressed = 0
+        # bodies that couldn't be decompressed, by their encoding
+        self.undecodable = collections.Counter()
+
+
+    def record(self, wire_length, original_length=None):
+        self.wire_bytes += wire_length
+        if original_length is None:
+            self.logical_bytes += wire_length
+        else:
+            self.logical_bytes += original_length
+            self.compressed += 1
+
+
+    def record_undecodable(self, encoding):
+        # counts a body in an unsupported encoding, returning whether it was the first in that encoding
+        self.undecodable[encoding] += 1
+        return self.undecodable[encoding] == 1
+
+
+    def summary(self):
+        if not self.wire_bytes:
+            return "no bytes sent or received"
+        text = "%s bytes on the wire, %s logical bytes (%0.2f:1), %s bodies compressed" % (
+            self.wire_bytes,
+            self.logical_bytes,
+            float(self.logical_bytes) / self.wire_bytes,
+            self.compressed)
+        if self.undecodable:
+            text += ", undecodable %s" % " ".join(
+                "%s:%s" % (encoding, count) for (encoding, count) in sorted(self.undecodable.items()))
+        return text
+
+
+class Compressor(CompressionStats):
+    """Compresses bodies at or above a size threshold with the chosen codec,
+    keeping count of the bytes before and after.
+
+    """
+
+    def __init__(self, codec, threshold):
+        """
+        :param str codec: The name of a codec in CODECS
+        :param int threshold: Smallest body (in bytes) worth compressing
+
+        """
+        if codec not in CODECS:
+            raise Exception("Compression codec " + codec + " is not available")
+
+        super(Compressor, self).__init__()
+        self.codec = codec
+        self.threshold = threshold
+        self._compress = load_codec(codec)[0]
+
+
+    def compress(self, body):
+        """Return (body, encoding), where the encoding is None if the body
+        was left as it was.
+
+        :param bytes body: The body to compress
+
+        """
+        if len(body) >= self.threshold:
+            compressed = self._compress(body)
+            if len(compressed) < len(body):
+                self.record(len(compressed), len(body))
+                return (compressed, self.codec)
+
+        self.record(len(body))
+        return (body, None)
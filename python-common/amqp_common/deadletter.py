@@ -0,0 +1,145 @@
+'''
+    Rejection and dead-letter measurement for the AMQP 0-9-1 receivers.
+
+    A Rejecter decides which deliveries a receiver should nack, spreading
+    the chosen fraction evenly through the stream rather than at random so
+    that runs are repeatable.  With requeueing it tracks how many times each
+    requeued message comes round again.  Without it, the broker dead-letters
+    the rejected messages (e.g. through the ha-and-dlx policy's DLX exchange)
+    and a receiver on the dead-letter queue can use DeadLetterStats to
+    report why they died and how long the extra hop took.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+DEATH_HEADER = "x-death"
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import collections
+import time
+
+from amqp_common.sequencing import SENT_TIME_PROPERTY, latency_since
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Rejecter(object):
+    """Chooses which deliveries to reject.
+
+    """
+
+    def __init__(self, fraction, requeue=False):
+        """
+        :param float fraction: Share of deliveries to reject, from 0 to 1
+        :param bool requeue: Whether rejected messages go back on the queue
+            (rather than to the dead-letter exchange)
+
+        """
+        self.fraction = fraction
+        self.requeue = requeue
+        self.deliveries = 0
+        self.rejected = 0
+        self.redelivered = 0
+        self.loops = collections.Counter()
+        self._requeued = {}
+
+
+    def reject(self, message_id, redelivered):
+        """Return True if this delivery should be rejected.
+
+        :param str message_id: The message's id, to follow it round requeues
+        :param bool redelivered: The delivery's redelivered flag
+
+        """
+        self.deliveries += 1
+        if redelivered:
+            self.redelivered += 1
+
+        # reject whenever the running total of fraction * deliveries passes another whole number
+        rejecting = int(self.deliveries * self.fraction) > self.rejected
+        if rejecting:
+            self.rejected += 1
+
+        if self.requeue and message_id:
+            if rejecting:
+                self._requeued[message_id] = self._requeued.get(message_id, 0) + 1
+            else:
+                # the loop is over, so record how many times the message went round
+                times = self._requeued.pop(message_id, None)
+                if times is not None:
+                    self.loops[times] += 1
+
+        return rejecting
+
+
+    def summary(self):
+        text = "%s of %s deliveries rejected (%s), %s redelivered" % (
+            self.rejected,
+            self.deliveries,
+            "requeued" if self.requeue else "dead-lettered",
+            self.redelivered)
+
+        if self.loops:
+            text += ", requeue loops %s, longest %s" % (
+                " ".join("%sx:%s" % (times, count) for (times, count) in sorted(self.loops.items())),
+                max(self.loops))
+        if self._requeued:
+            text += ", %s still looping" % len(self._requeued)
+        return text
+
+
+class DeadLetterStats(object):
+    """Tally of dead-lettered messages by reason and source queue, and of
+    the time they took to arrive.
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.reasons = collections.Counter()
+        self.queues = collections.Counter()
+        self.deaths = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+
+    def record(self, headers):
+        """Record a dead-lettered delivery from its headers.
+
+        :param dict headers: The message headers (which carry x-death)
+
+        """
+        headers = headers or {}
+        deaths = headers.get(DEATH_HEADER) or []
+        self.count += 1
+
+        # the broker puts the most recent death first
+        if deaths:
+            self.reasons[deaths[0].get("reason")] += 1
+            self.queues[deaths[0].get("queue")] += 1
+            self.deaths += sum(death.get("count", 1) for death in deaths)
+
+        sent = headers.get(SENT_TIME_PROPERTY)
+        if sent:
+            latency = latency_since(sent)
+            self.latency_count += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+
+    def summary(self):
+        text = "%s dead letters (%s deaths), reasons %s, from %s" % (
+            self.count,
+            self.deaths,
+            dict(self.reasons),
+            dict(self.queues))
+
+        if self.latency_count:
+            text += ", latency from publish mean %0.3fms max %0.3fms" % (
+                1000 * self.latency_total / self.latency_count,
+                1000 * self.latency_max)
+        return text
@@ -0,0 +1,229 @@
+'''
+    Per-phase timing and optional profiling of a client run.
+
+    The clients name the lifecycle callbacks worth timing (connect, channel
+    open, declarations, publish, confirm, receive, stop...) and a Profiler
+    wraps those methods on the client instance, recording how often each was
+    called, how long was spent inside it and when it first ran relative to the
+    start of the run.  The gap between one phase first running and the next
+    (e.g. connect to on_connection_open) is time spent waiting on the broker,
+    such as the TCP and TLS handshakes.
+
+    The run itself can also be wrapped in cProfile (written in pstats format)
+    and/or a sampling profiler that writes collapsed stacks, one
+    "frame;frame;frame count" line per distinct stack, as read by
+    flamegraph.pl and speedscope.
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import collections
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the profiling options to a script's argument parser
+    opts.add_argument("--phases",
+        required=False,
+        default=False,
+        action="store_true",
+        help="report the time spent in each phase of the client lifecycle")
+    opts.add_argument("--profile",
+        required=False,
+        help="profile the run with cProfile, writing pstats output to this file")
+    opts.add_argument("--profile_samples",
+        required=False,
+        help="sample the run's stacks, writing flamegraph-compatible collapsed stacks to this file")
+    opts.add_argument("--profile_interval",
+        type=float,
+        default=5,
+        required=False,
+        help="milliseconds between stack samples")
+
+
+def from_options(options):
+    # builds the Profiler described by the command line options, or None
+    if not (options.phases or options.profile or options.profile_samples):
+        return None
+
+    return Profiler(options.profile, options.profile_samples, options.profile_interval / 1000.0)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Phase(object):
+    """Calls to, and time spent in, one lifecycle callback.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.first = None
+
+
+class Sampler(threading.Thread):
+    """Background thread that periodically records the stack of every other
+    thread, counting identical stacks.
+
+    """
+
+    def __init__(self, interval):
+        super(Sampler, self).__init__(name="sampler")
+        self.daemon = True
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+
+
+    def run(self):
+        names = {}
+        while not self._stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for (ident, frame) in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+    def write(self, filename):
+        with open(filename, 'w') as output:
+            for (stack, count) in sorted(self.stacks.items()):
+                output.write("%s %s\n" % (stack, count))
+
+
+class Profiler(object):
+    """Times a client's lifecycle callbacks and optionally profiles its run.
+
+    """
+
+    def __init__(self, profile_file=None, samples_file=None, sample_interval=0.005):
+        """
+        :param str profile_file: Where to write cProfile stats (optional)
+        :param str samples_file: Where to write collapsed stack samples (optional)
+        :param float sample_interval: Seconds between stack samples
+
+        """
+        self.profile_file = profile_file
+        self.samples_file = samples_file
+        self.sample_interval = sample_interval
+        self.phases = collections.OrderedDict()
+        self.started = time.perf_counter()
+        self.finished = None
+
+
+    def instrument(self, client, names):
+        """Wrap the named methods of a client so that calls to them are timed.
+        Methods the client doesn't have are skipped, so that one list of names
+        can be shared between similar clients.
+
+        :param client: The producer or receiver object
+        :param list names: Names of the methods to time
+
+        """
+        for name in names:
+            method = getattr(client, name, None)
+            if method is not None:
+                setattr(client, name, self.timed(name, method))
+
+
+    def timed(self, name, method):
+        # returns method wrapped so that its calls are recorded against the named phase
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(name)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            if phase.first is None:
+                phase.first = start - self.started
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                phase.calls += 1
+                phase.total += elapsed
+                if elapsed > phase.max:
+                    phase.max = elapsed
+
+        return wrapper
+
+
+    def run(self, target, *args):
+        """Run target (typically the client's run method), under cProfile
+        and/or the stack sampler if either was asked for.
+
+        """
+        profile = cProfile.Profile() if self.profile_file else None
+        sampler = Sampler(self.sample_interval) if self.samples_file else None
+
+        if sampler:
+            sampler.start()
+        if profile:
+            profile.enable()
+        try:
+            return target(*args)
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.profile_file)
+            if sampler:
+                sampler.stop()
+                sampler.write(self.samples_file)
+            self.finished = time.perf_counter()
+
+
+    def report(self, logger):
+        """Log the phase breakdown in the order the phases first ran.
+
+        """
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        logger.info("Phase breakdown over %0.3fs", elapsed)
+
+        ran = [phase for phase in self.phases.values() if phase.calls]
+        for phase in sorted(ran, key=lambda phase: phase.first):
+            logger.info("  %-24s first at %9.3fms  %8s calls  %10.3fms total  %8.3fms mean  %8.3fms max",
+                phase.name,
+                1000 * phase.first,
+                phase.calls,
+                1000 * phase.total,
+                1000 * phase.total / phase.calls,
+                1000 * phase.max)
+
+        accounted = sum(phase.total for phase in ran)
+        logger.info("  %-24s %0.3fms (the I/O loop, including waits on the network and broker)",
+            "outside callbacks", 1000 * max(elapsed - accounted, 0))
+
+        if self.profile_file:
+            logger.info("cProfile stats written to %s", self.profile_file)
+        if self.samples_file:
+            logger.info("Collapsed stack samples written to %s", self.samples_file)
@@ -0,0 +1,145 @@
+'''
+    Timed replay of recorded traffic by the file senders.
+
+    read_timed() streams (timestamp, properties, body) records from either a
+    capture (see amqp_common.capture) or a JSONL file (optionally gzip or
+    zstd compressed) holding a JSON object per line, with a "timestamp" in
+    seconds since the epoch, a "body" (a string or any other JSON value)
+    and, optionally, "properties" and any of the captured message fields...
+
+        {"timestamp": 1700000000.25, "body": "hello", "properties": {"region": "eu"}}
+
+    A Pacer works out when each record is due, keeping the original gaps
+    between the timestamps divided by the speed.  Every due time is measured
+    from the first record and the start of the replay, not from the previous
+    send, so time lost on one send (to a busy ioloop or a full confirmation
+    window) is made up on the next rather than building up over a long
+    replay.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+JSONL_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import json
+import time
+
+from amqp_common import capture
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the replay options to a file sender's argument parser
+    opts.add_argument("--speed",
+        type=float,
+        default=0,
+        required=False,
+        help="replay a capture or JSONL file at this multiple of its original pace (1 is as recorded, 0 is as fast as possible)")
+
+
+def from_options(opts, options):
+    # builds the Pacer described by the command line options, or None
+    if options.speed < 0:
+        opts.error("The replay speed cannot be negative")
+    if not options.speed:
+        return None
+    return Pacer(options.speed)
+
+
+def is_jsonl(path):
+    return path.endswith(JSONL_SUFFIXES)
+
+
+def is_timed(path):
+    # whether the file holds timestamped records to replay, rather than plain lines
+    return is_jsonl(path) or capture.is_capture(path)
+
+
+def read_jsonl(path, compression="auto"):
+    # yields (timestamp, properties, body) for each line, in the same form as a capture
+    with capture.open_input(path, compression) as a_file:
+        for a_line in a_file:
+            if not a_line.strip():
+                continue
+
+            record = json.loads(a_line.decode('utf-8'))
+            timestamp = record.pop("timestamp")
+            (body, record["body_type"]) = capture.encode_body(record.pop("body", ""))
+            yield (timestamp, record, body)
+
+
+def read_timed(path, compression="auto"):
+    if is_jsonl(path):
+        return read_jsonl(path, compression)
+    return capture.read_capture(path)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Pacer(object):
+    """Schedules records at their original pace (or a multiple of it).
+
+    """
+
+    def __init__(self, speed):
+        """
+        :param float speed: Multiple of the original pace (2 replays an hour
+            of traffic in half an hour)
+
+        """
+        self.speed = speed
+        self.count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._started = None
+        self._last_sent = None
+
+
+    def due(self, timestamp, now=None):
+        """Return the time.monotonic() time at which the record is due; the
+        first record is due straight away.
+
+        :param float timestamp: The record's original timestamp
+
+        """
+        if self._started is None:
+            self._started = time.monotonic() if now is None else now
+            self._first_timestamp = timestamp
+        return self._started + (timestamp - self._first_timestamp) / self.speed
+
+
+    def sent(self, timestamp, due, now=None):
+        """Record that a record has been sent, and how late.
+
+        :param float timestamp: The record's original timestamp
+        :param float due: When it was due, as returned by due()
+
+        """
+        if now is None:
+            now = time.monotonic()
+        lag = now - due
+        if lag > 0:
+            self.lag_total += lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        self.count += 1
+        self._last_timestamp = timestamp
+        self._last_sent = now
+
+
+    def summary(self):
+        if not self.count:
+            return "nothing replayed"
+        return "%s records at %sx, %0.3fs of traffic replayed in %0.3fs, lag mean %0.3fms max %0.3fms" % (
+            self.count,
+            self.speed,
+            self._last_timestamp - self._first_timestamp,
+            self._last_sent - self._started,
+            1000 * self.lag_total / self.count,
+            1000 * self.lag_max)
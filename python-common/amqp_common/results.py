@@ -0,0 +1,470 @@
+'''
+    Interval result logs, so that the runs of many producers can be merged
+    into one report.
+
+    A ResultLog is a JSON line file.  A "start" record describes the client,
+    then an "interval" record is written for each --results_interval in which
+    anything happened, holding the messages sent and confirmed and three
+    latency Histograms...
+
+        latency     confirmation time less the actual send time
+        response    confirmation time less the intended send time
+        send_lag    actual send time less the intended send time
+
+    ...and an "end" record holds the totals.  compare() lays runs side by
+    side instead, e.g. the same load under each of the pika clients'
+    connection profiles (which the start record names).  Only producers publishing to a
+    schedule know when each message was meant to go, so for the others
+    response and send_lag are empty.
+
+    Measuring from the actual send time suffers from coordinated omission: a
+    stalled producer stops sending, so the messages that would have waited
+    out the stall are never measured.  Measuring from the intended send time
+    avoids it.  Where a log only has latencies but its client was meant to
+    send at a known interval, merge() corrects them instead, back-filling the
+    samples the stall hid at that interval (as HdrHistogram does).  A client
+    with no expected interval (an asynchronous producer sending as fast as
+    it can) isn't corrected: its average gap between sends is no measure of
+    when messages were due, and back-filling at it would understate latency.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# values below 2^SUB_BUCKET_BITS microseconds are exact, larger ones are held
+# to within 1 part in 2^(SUB_BUCKET_BITS - 1)
+SUB_BUCKET_BITS = 7
+
+PERCENTILES = [50, 90, 99, 99.9, 99.99]
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import json
+import os
+import socket
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the result log options to a client's argument parser
+    opts.add_argument("--results",
+        required=False,
+        help="file to write an interval result log to (replacing any earlier one), for merge-results.py")
+    opts.add_argument("--results_interval",
+        type=float,
+        default=1.0,
+        required=False,
+        help="seconds covered by each record of the result log")
+
+
+def from_options(opts, options, client, expected_interval=None, connection_profile=None):
+    # builds the ResultLog described by the command line options, or None
+    if not options.results:
+        return None
+    if options.results_interval <= 0:
+        opts.error("The results interval must be more than 0 seconds")
+    return ResultLog(open(options.results, 'w'), client, options.results_interval, expected_interval, connection_profile)
+
+
+def read_log(path):
+    # yields the records of a result log
+    with open(path, encoding='utf-8') as a_file:
+        for a_line in a_file:
+            if a_line.strip():
+                yield json.loads(a_line)
+
+
+def merge(paths, expected_interval=None):
+    """Combine result logs into a Report, correcting the latencies of each
+    client that sent at a known interval, but not to a schedule, for
+    coordinated omission.
+
+    :param list paths: The result logs
+    :param float expected_interval: Seconds between each client's sends, if
+        not the interval in its log
+
+    """
+    report = Report()
+    for path in paths:
+        records = list(read_log(path))
+        starts = [record for record in records if record["type"] == "start"]
+        intervals = [record for record in records if record["type"] == "interval"]
+        ends = [record for record in records if record["type"] == "end"]
+        if not starts:
+            raise Exception(path + " is not a result log")
+
+        # each client's own gap between sends (from --rate), unless one is given
+        interval = expected_interval or starts[0].get("expected_interval")
+
+        report.add_client(path, starts[0], ends[0] if ends else None, interval)
+        for record in intervals:
+            report.add_interval(record, interval)
+    return report
+
+
+def compare(paths, expected_interval=None):
+    """Merge each result log on its own and return a line per log of its
+    throughput and latency percentiles, to compare runs of the same load.
+
+    :param list paths: The result logs
+    :param float expected_interval: Seconds between each client's sends, if
+        not the interval in its log
+
+    """
+    lines = ["%-30s %-10s %10s %8s %10s %10s %10s %10s %14s" % (
+        "log", "profile", "conf/s", "nacked", "p50 (ms)", "p99 (ms)", "p99.9 (ms)", "max (ms)", "p99 corr (ms)")]
+    for path in paths:
+        report = merge([path], expected_interval)
+        (sent, confirmed, nacked, span) = report.totals()
+        lines.append("%-30s %-10s %10.1f %8s %10s %10s %10s %10s %14s" % (
+            path,
+            report.clients[0]["connection_profile"] or "-",
+            confirmed / span if span else 0,
+            nacked,
+            Report._milliseconds(report.latency.percentile(50)),
+            Report._milliseconds(report.latency.percentile(99)),
+            Report._milliseconds(report.latency.percentile(99.9)),
+            Report._milliseconds(report.latency.max()),
+            Report._milliseconds(report.corrected.percentile(99))))
+    return lines
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Histogram(object):
+    """Latency histogram with log-linear buckets of whole microseconds, so
+    that it has a fixed relative accuracy and merges by adding counts.
+
+    """
+
+    def __init__(self, counts=None):
+        """
+        :param dict counts: Count per bucket (keyed by its lowest value), as
+            produced by to_dict()
+
+        """
+        self.counts = dict((int(bucket), count) for (bucket, count) in (counts or {}).items())
+
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+
+    @staticmethod
+    def bucket(value):
+        # the lowest value of the bucket holding a value
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return (value >> shift) << shift
+
+
+    @staticmethod
+    def highest(bucket):
+        # the highest value of a bucket
+        shift = bucket.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return bucket
+        return bucket + (1 << shift) - 1
+
+
+    def record(self, seconds, count=1):
+        self.record_micros(max(int(seconds * 1000000), 0), count)
+
+
+    def record_micros(self, value, count=1):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+
+    def merge(self, other):
+        for (bucket, count) in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+
+    def corrected(self, expected_interval):
+        """Return a copy with the samples that coordinated omission hid added
+        back: for a value above the expected interval, the sends that should
+        have followed it during the stall would have seen the value less one
+        interval, less two, and so on.
+
+        :param float expected_interval: Seconds between sends
+
+        """
+        step = max(int(expected_interval * 1000000), 1)
+        copy = Histogram()
+        for (bucket, count) in self.counts.items():
+            copy.record_micros(bucket, count)
+
+            # back-fill a bucket at a time, rather than a sample at a time
+            value = bucket - step
+            while value >= step:
+                low = max(self.bucket(value), step)
+                samples = (value - low) // step + 1
+                copy.record_micros(value, count * samples)
+                value -= samples * step
+        return copy
+
+
+    def percentile(self, point):
+        # the highest value of the bucket holding the percentile, in seconds
+        total = len(self)
+        if not total:
+            return None
+        rank = max(int(point / 100.0 * total + 0.999999), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self.highest(bucket) / 1000000.0
+        return self.highest(max(self.counts)) / 1000000.0
+
+
+    def max(self):
+        if not self.counts:
+            return None
+        return self.highest(max(self.counts)) / 1000000.0
+
+
+    def mean(self):
+        total = len(self)
+        if not total:
+            return None
+        return sum((bucket + self.highest(bucket)) / 2.0 * count for (bucket, count) in self.counts.items()) / total / 1000000.0
+
+
+    def summary(self, points=PERCENTILES):
+        if not self.counts:
+            return "no samples"
+        return ", ".join(["p%s %0.3fms" % (point, 1000 * self.percentile(point)) for point in points] +
+            ["max %0.3fms" % (1000 * self.max())])
+
+
+    def to_dict(self):
+        return dict((str(bucket), count) for (bucket, count) in sorted(self.counts.items()))
+
+
+class ResultLog(object):
+    """Writes a client's interval result log.
+
+    """
+
+    def __init__(self, stream, client, interval=1.0, expected_interval=None, connection_profile=None):
+        """
+        :param file stream: Where to write the log
+        :param str client: Name of the client script
+        :param float interval: Seconds covered by each interval record
+        :param float expected_interval: Seconds between sends, if the client
+            is sending at a fixed rate
+        :param str connection_profile: The client's connection profile, if
+            it has them
+
+        """
+        self.interval = interval
+        self.sent = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self._stream = stream
+        self._totals = dict((name, Histogram()) for name in ("latency", "response", "send_lag"))
+        self._current = None
+        self._interval_start = None
+        now = time.time()
+        self._new_interval(now)
+        self._write({"type": "start",
+            "client": client,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "time": now,
+            "interval": interval,
+            "expected_interval": expected_interval,
+            "connection_profile": connection_profile})
+
+
+    def _new_interval(self, now):
+        # intervals line up on multiples of the interval (rounded, so that the floating point
+        # arithmetic comes out the same), so that logs from different clients match up
+        self._interval_start = round(now - now % self.interval, 6)
+        self._current = {"sent": 0, "confirmed": 0, "nacked": 0,
+            "latency": Histogram(), "response": Histogram(), "send_lag": Histogram()}
+
+
+    def _roll(self, now):
+        if now >= self._interval_start + self.interval:
+            self._write_interval()
+            self._new_interval(now)
+
+
+    def _write_interval(self):
+        current = self._current
+        if not (current["sent"] or current["confirmed"] or current["nacked"]):
+            return
+        record = {"type": "interval",
+            "start": self._interval_start,
+            "end": round(self._interval_start + self.interval, 6)}
+        for (name, value) in current.items():
+            if isinstance(value, Histogram):
+                self._totals[name].merge(value)
+                record[name] = value.to_dict()
+            else:
+                record[name] = value
+        self._write(record)
+
+
+    def record_send(self, sent_time, intended_time=None, count=1):
+        """Record the sending of a message (or a batch of them).
+
+        :param float sent_time: When it was sent (time.monotonic())
+        :param float intended_time: When it was meant to be sent, if the
+            client is sending to a schedule
+
+        """
+        self._roll(time.time())
+        self.sent += count
+        self._current["sent"] += count
+        if intended_time is not None:
+            self._current["send_lag"].record(sent_time - intended_time, count)
+
+
+    def record_confirm(self, sent_time, intended_time=None, count=1, nacked=False, now=None):
+        """Record the broker's confirmation of a message (or a batch).
+
+        :param float sent_time: When it was sent (time.monotonic())
+        :param float intended_time: When it was meant to be sent, if known
+        :param bool nacked: Whether the broker rejected it
+
+        """
+        self._roll(time.time())
+        if nacked:
+            self.nacked += count
+            self._current["nacked"] += count
+            return
+
+        if now is None:
+            now = time.monotonic()
+        self.confirmed += count
+        self._current["confirmed"] += count
+        self._current["latency"].record(now - sent_time, count)
+        if intended_time is not None:
+            self._current["response"].record(now - intended_time, count)
+
+
+    def close(self):
+        # writes the last interval and the totals, and closes the log
+        self._write_interval()
+        self._write({"type": "end",
+            "time": time.time(),
+            "sent": self.sent,
+            "confirmed": self.confirmed,
+            "nacked": self.nacked,
+            "unconfirmed": self.sent - self.confirmed - self.nacked,
+            "latency": self._totals["latency"].to_dict(),
+            "response": self._totals["response"].to_dict(),
+            "send_lag": self._totals["send_lag"].to_dict()})
+        self._stream.close()
+
+
+    def _write(self, record):
+        self._stream.write(json.dumps(record) + "\n")
+
+
+class Report(object):
+    """The merged result logs of a number of clients.
+
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.intervals = {}
+        self.latency = Histogram()
+        self.corrected = Histogram()
+        self.send_lag = Histogram()
+
+
+    def add_client(self, path, start, end, expected_interval):
+        self.clients.append({"path": path,
+            "client": start.get("client"),
+            "host": start.get("host"),
+            "pid": start.get("pid"),
+            "connection_profile": start.get("connection_profile"),
+            "expected_interval": expected_interval,
+            "sent": end["sent"] if end else None,
+            "confirmed": end["confirmed"] if end else None,
+            "nacked": end["nacked"] if end else None,
+            "unconfirmed": end["unconfirmed"] if end else None})
+
+
+    def add_interval(self, record, expected_interval):
+        # intervals from every client that start together are added together
+        key = (record["start"], record["end"])
+        merged = self.intervals.get(key)
+        if merged is None:
+            merged = {"sent": 0, "confirmed": 0, "nacked": 0, "latency": Histogram(), "corrected": Histogram()}
+            self.intervals[key] = merged
+
+        latency = Histogram(record["latency"])
+        response = Histogram(record.get("response"))
+        if len(response):
+            # measured from the intended send time, so there's nothing to correct
+            corrected = response
+        elif expected_interval:
+            corrected = latency.corrected(expected_interval)
+        else:
+            corrected = latency
+
+        for name in ("sent", "confirmed", "nacked"):
+            merged[name] += record.get(name, 0)
+        merged["latency"].merge(latency)
+        merged["corrected"].merge(corrected)
+        self.latency.merge(latency)
+        self.corrected.merge(corrected)
+        self.send_lag.merge(Histogram(record.get("send_lag")))
+
+
+    def lines(self):
+        # the report, as lines of text
+        lines = []
+        for client in self.clients:
+            lines.append("%s: %s on %s (pid %s), %s sent, %s confirmed, %s nacked, %s unconfirmed at exit%s" % (
+                client["path"], client["client"], client["host"], client["pid"],
+                client["sent"], client["confirmed"], client["nacked"], client["unconfirmed"],
+                ", expected interval %0.3fms" % (1000 * client["expected_interval"]) if client["expected_interval"] else ", no expected interval"))
+
+        lines.append("%-12s %10s %10s %8s %12s %14s" % ("offset (s)", "sent/s", "conf/s", "nacked", "p99 (ms)", "p99 corr (ms)"))
+        first = min(self.intervals)[0] if self.intervals else 0
+        for ((start, end), merged) in sorted(self.intervals.items()):
+            seconds = end - start
+            lines.append("%-12.2f %10.1f %10.1f %8s %12s %14s" % (
+                start - first,
+                merged["sent"] / seconds,
+                merged["confirmed"] / seconds,
+                merged["nacked"],
+                self._milliseconds(merged["latency"].percentile(99)),
+                self._milliseconds(merged["corrected"].percentile(99))))
+
+        if self.intervals:
+            (sent, confirmed, nacked, span) = self.totals()
+            lines.append("%s sent and %s confirmed by %s clients in %0.1fs (%0.1f/s confirmed)" % (
+                sent, confirmed, len(self.clients), span, confirmed / span))
+        lines.append("Latency: %s" % self.latency.summary())
+        lines.append("Corrected latency: %s" % self.corrected.summary())
+        if len(self.send_lag):
+            lines.append("Send lag: %s" % self.send_lag.summary())
+        return lines
+
+
+    def totals(self):
+        # the messages sent, confirmed and nacked over all the intervals, and the seconds they span
+        if not self.intervals:
+            return (0, 0, 0, 0)
+        span = max(self.intervals)[1] - min(self.intervals)[0]
+        sent = sum(merged["sent"] for merged in self.intervals.values())
+        confirmed = sum(merged["confirmed"] for merged in self.intervals.values())
+        nacked = sum(merged["nacked"] for merged in self.intervals.values())
+        return (sent, confirmed, nacked, span)
+
+
+    @staticmethod
+    def _milliseconds(seconds):
+        return "-" if seconds is None else "%0.3f" % (1000 * seconds)
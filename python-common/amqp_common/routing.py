@@ -0,0 +1,132 @@
+'''
+    Routing keys drawn from a hierarchical key space.
+
+    A key space of levels [4, 10, 3] under the prefix 'bench' holds the
+    120 keys 'bench.0.0.0' to 'bench.3.9.2', so receivers can bind with
+    patterns such as 'bench.1.*.2' or 'bench.3.#' to pick out a share of
+    the traffic.  Keys are built and interned up front, so publishing only
+    picks one out of a list.  With a Zipf distribution the keys are ranked
+    in order, so 'bench.0.0.0' is the hottest and the '0' subtree gets the
+    largest share.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+MAX_KEYS = 1000000
+
+DISTRIBUTIONS = ["uniform", "zipf"]
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import collections
+import itertools
+import random
+import sys
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the routing key options to a producer's argument parser
+    opts.add_argument("--key_space",
+        type=int,
+        nargs="+",
+        required=False,
+        help="publish to routing keys '<topic>.<n>.<n>...' with this many values at each level")
+    opts.add_argument("--key_distribution",
+        choices=DISTRIBUTIONS,
+        default="uniform",
+        required=False,
+        help="how often each routing key is chosen")
+    opts.add_argument("--zipf_exponent",
+        type=float,
+        default=1.0,
+        required=False,
+        help="skew of the Zipf distribution (higher favours the first keys more)")
+    opts.add_argument("--key_seed",
+        type=int,
+        required=False,
+        help="seed for choosing routing keys, to repeat a run's key sequence")
+
+
+def from_options(opts, options, prefix):
+    # builds the KeySpace described by the command line options, or None
+    if not options.key_space:
+        return None
+
+    if min(options.key_space) < 1:
+        opts.error("Each level of the key space needs at least one value")
+    size = 1
+    for level in options.key_space:
+        size *= level
+    if size > MAX_KEYS:
+        opts.error("The key space may hold at most %s keys" % MAX_KEYS)
+
+    return KeySpace(prefix, options.key_space, options.key_distribution, options.zipf_exponent, options.key_seed)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class KeySpace(object):
+    """Hands out routing keys from a hierarchical key space.
+
+    """
+
+    _BLOCK = 1024   # keys drawn from the distribution at a time
+
+
+    def __init__(self, prefix, levels, distribution="uniform", exponent=1.0, seed=None):
+        """
+        :param str prefix: First word of every key (e.g. the topic name)
+        :param list levels: Number of values at each level below the prefix
+        :param str distribution: 'uniform' or 'zipf'
+        :param float exponent: Skew of the Zipf distribution
+        :param int seed: Seed for the random choice of keys (optional)
+
+        """
+        if distribution not in DISTRIBUTIONS:
+            raise Exception("Unknown key distribution " + distribution)
+
+        self.distribution = distribution
+        self.keys = [sys.intern(".".join([prefix] + [str(n) for n in path]))
+            for path in itertools.product(*[range(level) for level in levels])]
+        self.published = collections.Counter()
+        self._random = random.Random(seed)
+        self._block = []
+
+        if distribution == "zipf":
+            self._cum_weights = list(itertools.accumulate(
+                1.0 / (rank ** exponent) for rank in range(1, len(self.keys) + 1)))
+        else:
+            self._cum_weights = None
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def next(self):
+        # draws keys a block at a time, as one call to choices is far cheaper than many
+        if not self._block:
+            if self._cum_weights:
+                self._block = self._random.choices(self.keys, cum_weights=self._cum_weights, k=self._BLOCK)
+            else:
+                self._block = self._random.choices(self.keys, k=self._BLOCK)
+        return self._block.pop()
+
+
+    def count(self, key, messages=1):
+        self.published[key] += messages
+
+
+    def summary(self, top=5):
+        # distinct keys used and the share taken by the hottest
+        total = sum(self.published.values())
+        if not total:
+            return "no keys used"
+
+        hottest = ", ".join("%s %0.1f%%" % (key, 100.0 * count / total)
+            for (key, count) in self.published.most_common(top))
+        return "%s of %s keys used (%s), hottest %s" % (
+            len(self.published), len(self.keys), self.distribution, hottest)
@@ -0,0 +1,70 @@
+'''
+    Request/reply bookkeeping for the RPC benchmark.
+
+    Outstanding requests are held in a dict by correlation id, each also
+    dropped into a slot of a TimeoutWheel.  The wheel ticks round at a fixed
+    resolution and hands back whatever is in the slot it arrives at, so
+    timing out a request costs nothing unless it actually times out, however
+    many requests are in flight, rather than one ioloop timer per request.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# RabbitMQ's pseudo-queue for replies sent straight back to the consumer's channel
+DIRECT_REPLY_TO = "amq.rabbitmq.reply-to"
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import math
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def percentiles(values, points=PERCENTILES):
+    # returns (point, value) for each percentile of the values, by the nearest rank
+    ordered = sorted(values)
+    if not ordered:
+        return []
+    return [(point, ordered[max(0, int(math.ceil(point / 100.0 * len(ordered))) - 1)]) for point in points]
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class TimeoutWheel(object):
+    """A hashed wheel of timeout slots.
+
+    """
+
+    def __init__(self, timeout, resolution=0.1):
+        """
+        :param float timeout: Seconds after which an entry expires
+        :param float resolution: Seconds between ticks (and so the accuracy
+            of the timeout)
+
+        """
+        self.resolution = resolution
+        # a spare slot allows for the part tick before the first, so entries never expire early
+        self._slots = [set() for n in range(int(math.ceil(timeout / resolution)) + 2)]
+        self._position = 0
+
+
+    def add(self, key):
+        # puts the key in the slot the wheel will reach last, returning the slot
+        slot = (self._position - 1) % len(self._slots)
+        self._slots[slot].add(key)
+        return slot
+
+
+    def remove(self, key, slot):
+        self._slots[slot].discard(key)
+
+
+    def tick(self):
+        # moves the wheel on one slot, returning the keys that have expired
+        self._position = (self._position + 1) % len(self._slots)
+        expired = self._slots[self._position]
+        self._slots[self._position] = set()
+        return expired
@@ -0,0 +1,259 @@
+'''
+    Timed sends for the producers.
+
+    A TimerWheel holds any number of future timers at a constant cost per
+    timer, however many there are and however far ahead they fall.  Level 0
+    has a slot per tick; each slot of the level above spans a whole turn of
+    the level below, and its timers are cascaded down a level as the wheel
+    turns into it.  With the defaults (1ms ticks, four levels of 256 slots)
+    the wheel reaches 49 days ahead; anything further waits in an overflow
+    list until the top level comes round.
+
+    A SendSchedule uses a wheel to pace a producer - messages fall due at a
+    steady rate, each held back by an optional (random) delay - and keeps
+    count of how late they actually went out.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+RESOLUTION = 0.001      # seconds per tick
+SLOT_BITS = 8           # 256 slots per level
+LEVELS = 4
+
+# most sends brought forward on one tick, so that the ioloop isn't held up
+MAX_GENERATED = 10000
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import random
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the scheduling options to a producer's argument parser
+    opts.add_argument("--rate",
+        type=float,
+        default=0,
+        required=False,
+        help="messages per second to publish at (0 publishes as fast as possible)")
+    opts.add_argument("--delay",
+        type=float,
+        nargs="+",
+        required=False,
+        help="milliseconds to hold each message back before publishing it, or a MIN MAX range to pick from at random")
+    opts.add_argument("--delay_seed",
+        type=int,
+        required=False,
+        help="seed for choosing the delays, to repeat a run's timings")
+
+
+def from_options(opts, options, total):
+    # builds the SendSchedule described by the command line options, or None
+    if not options.rate and not options.delay:
+        return None
+
+    if options.rate < 0:
+        opts.error("The publishing rate cannot be negative")
+    if options.delay:
+        if len(options.delay) > 2 or min(options.delay) < 0 or options.delay[0] > options.delay[-1]:
+            opts.error("The delay must be a number of milliseconds, or a MIN MAX range")
+        delay = (options.delay[0] / 1000.0, options.delay[-1] / 1000.0)
+    else:
+        delay = None
+
+    return SendSchedule(total, options.rate, delay, options.delay_seed)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class TimerWheel(object):
+    """Hierarchical timing wheel.
+
+    """
+
+    def __init__(self, resolution=RESOLUTION, slot_bits=SLOT_BITS, levels=LEVELS, start=None):
+        """
+        :param float resolution: Seconds per tick
+        :param int slot_bits: log2 of the number of slots per level
+        :param int levels: Number of levels
+        :param float start: time.monotonic() time of tick 0 (defaults to now)
+
+        """
+        self.resolution = resolution
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._levels = [[[] for n in range(1 << slot_bits)] for level in range(levels)]
+        self._overflow = []
+        self._due = []
+        self._origin = time.monotonic() if start is None else start
+        self._tick = 0
+        self._count = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def schedule(self, when, item):
+        """Add a timer, returning nothing.
+
+        :param float when: time.monotonic() time the item falls due
+        :param item: What to hand back from advance() once it has
+
+        """
+        self._count += 1
+        self._place(int((when - self._origin) / self.resolution), item)
+
+
+    def _place(self, tick, item):
+        delta = tick - self._tick
+        if delta <= 0:
+            self._due.append(item)
+            return
+
+        # the lowest level whose span covers the delta
+        for (level, slots) in enumerate(self._levels):
+            if delta < 1 << (self._bits * (level + 1)):
+                slots[(tick >> (self._bits * level)) & self._mask].append((tick, item))
+                return
+        self._overflow.append((tick, item))
+
+
+    def advance(self, now=None):
+        """Turn the wheel up to the given time, returning the items that
+        have fallen due (in tick order).
+
+        :param float now: time.monotonic() time to turn to (defaults to now)
+
+        """
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self._origin) / self.resolution)
+
+        due = self._due
+        self._due = []
+        while self._tick < target:
+            self._tick += 1
+            self._cascade()
+            slot = self._levels[0][self._tick & self._mask]
+            if slot:
+                due.extend(item for (tick, item) in slot)
+                del slot[:]
+
+        # cascading may have found timers due on the tick it happened
+        if self._due:
+            due.extend(self._due)
+            self._due = []
+
+        self._count -= len(due)
+        return due
+
+
+    def _cascade(self):
+        # as each level turns into a new slot, its timers move down to where they now belong,
+        # starting from the top so that they can fall more than one level at once
+        if self._overflow and not self._tick & ((1 << (self._bits * len(self._levels))) - 1):
+            (timers, self._overflow) = (self._overflow, [])
+            for (tick, item) in timers:
+                self._place(tick, item)
+
+        for level in range(len(self._levels) - 1, 0, -1):
+            if self._tick & ((1 << (self._bits * level)) - 1):
+                continue
+            slot = self._levels[level][(self._tick >> (self._bits * level)) & self._mask]
+            timers = slot[:]
+            del slot[:]
+            for (tick, item) in timers:
+                self._place(tick, item)
+
+
+class SendSchedule(object):
+    """Decides when each of a producer's messages is due to be published.
+
+    """
+
+    def __init__(self, total, rate=0, delay=None, seed=None, resolution=RESOLUTION):
+        """
+        :param int total: Number of messages to schedule
+        :param float rate: Messages per second to bring forward (0 brings
+            them all forward at once)
+        :param tuple delay: (min, max) seconds to hold each message back
+            once it has been brought forward, if any
+        :param int seed: Seed for choosing the delays (optional)
+        :param float resolution: Seconds per tick of the wheel
+
+        """
+        self.total = total
+        self.rate = rate
+        self.delay = delay
+        self.resolution = resolution
+        self.started = None
+        self.generated = 0
+        self.sent = 0
+        self.most_pending = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self._random = random.Random(seed)
+        self._wheel = None
+
+
+    def start(self, now=None):
+        self.started = time.monotonic() if now is None else now
+        self._wheel = TimerWheel(self.resolution, start=self.started)
+
+
+    def due(self, now=None):
+        """Return the due times of the messages that should be published
+        now, oldest first, bringing forward any new ones the rate allows.
+
+        :param float now: time.monotonic() time (defaults to now)
+
+        """
+        if now is None:
+            now = time.monotonic()
+
+        # the nth message is due n / rate seconds after the start, plus its delay
+        if self.rate:
+            target = min(self.total, int((now - self.started) * self.rate) + 1)
+        else:
+            target = self.total
+        target = min(target, self.generated + MAX_GENERATED)
+
+        ready = []
+        while self.generated < target:
+            when = self.started + (self.generated / self.rate if self.rate else 0)
+            if self.delay:
+                when += self._random.uniform(*self.delay)
+                self._wheel.schedule(when, when)
+            else:
+                ready.append(when)
+            self.generated += 1
+
+        if len(self._wheel) > self.most_pending:
+            self.most_pending = len(self._wheel)
+
+        if self.delay:
+            ready.extend(sorted(self._wheel.advance(now)))
+
+        for when in ready:
+            lag = now - when
+            if lag > self.lag_max:
+                self.lag_max = lag
+            self.lag_total += lag if lag > 0 else 0
+        self.sent += len(ready)
+        return ready
+
+
+    def summary(self):
+        text = "%s of %s sends scheduled" % (self.sent, self.total)
+        if self.rate:
+            text += " at %s/s" % self.rate
+        if self.delay:
+            text += ", delayed %s-%sms (at most %s waiting at once)" % (
+                1000 * self.delay[0], 1000 * self.delay[1], self.most_pending)
+        if self.sent:
+            text += ", lag mean %0.3fms max %0.3fms" % (1000 * self.lag_total / self.sent, 1000 * self.lag_max)
+        return text
@@ -0,0 +1,211 @@
+'''
+    Sequence-gap and ordering verification for received messages.
+
+    The producers number their messages from 1 in a 'sequence' field and
+    identify themselves with a PRODUCER_ID_PROPERTY header (AMQP 0-9-1) or
+    group id (AMQP 1.0).  The AMQP 0-9-1 producer also sends the time of
+    publishing, as an integer count of microseconds since the epoch (pika
+    can't encode floats in headers), in a SENT_TIME_PROPERTY header.  Each
+    producer's numbers are tracked in a sliding window, held as a bitmap (a
+    Python int) relative to the lowest number not yet seen.  Below the window
+    everything has been accounted for.  So memory stays constant however
+    many messages are received, and numbers that fall out of the top of the
+    window are counted as gaps.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+PRODUCER_ID_PROPERTY = "producer_id"
+SENT_TIME_PROPERTY = "sent_time"
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import json
+import os
+import socket
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def producer_id():
+    # identifies this producer process to the receivers
+    return "%s-%s" % (socket.gethostname(), os.getpid())
+
+
+def sent_time():
+    # the SENT_TIME_PROPERTY header for a message published now, in microseconds
+    return int(time.time() * 1000000)
+
+
+def latency_since(sent):
+    # seconds since a SENT_TIME_PROPERTY header's time
+    return time.time() - sent / 1000000.0
+
+
+def extract_sequence(body):
+    # pulls the sequence number out of a producer's message body, if it has one
+    if isinstance(body, dict):
+        return body.get('sequence')
+
+    try:
+        return json.loads(body).get('sequence')
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class SequenceWindow(object):
+    """Tracks one producer's sequence numbers.
+
+    base is the lowest sequence number not yet received; bit n of the bitmap
+    is set if base + 1 + n has been received.  When base arrives the window
+    slides up past every contiguous number already received.  A number that
+    arrives after the window has moved past it cannot be told apart from a
+    duplicate, so the window should be wider than any expected reordering.
+
+    """
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.base = 1
+        self.bitmap = 0
+        self.highest = 0
+        self.received = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.gaps = 0
+
+
+    def add(self, sequence):
+        """Record a sequence number, returning 'ok', 'duplicate' or
+        'out_of_order'.
+
+        """
+        if sequence < self.base:
+            self.duplicates += 1
+            return 'duplicate'
+
+        offset = sequence - self.base
+        if offset and self.bitmap >> (offset - 1) & 1:
+            self.duplicates += 1
+            return 'duplicate'
+
+        self.received += 1
+        result = 'ok'
+        if sequence < self.highest:
+            self.out_of_order += 1
+            result = 'out_of_order'
+        else:
+            self.highest = sequence
+
+        if offset == 0:
+            self._advance(1)
+        else:
+            self.bitmap |= 1 << (offset - 1)
+
+            # anything beyond the window is given up on and counted as missing
+            if offset > self.window_size:
+                self._skip(offset - self.window_size)
+
+        return result
+
+
+    def missing(self):
+        # numbers currently outstanding inside the window
+        if self.highest < self.base:
+            return 0
+        return self.highest - self.base + 1 - bin(self.bitmap).count('1')
+
+
+    def _advance(self, count):
+        # move base up by count, then past any run already received above it
+        self.base += count
+        self.bitmap >>= count - 1
+
+        # bit 0 now stands for base itself
+        while self.bitmap & 1:
+            self.bitmap >>= 1
+            self.base += 1
+        self.bitmap >>= 1
+
+
+    def _skip(self, count):
+        # give up on the lowest count numbers, recording those never received
+        received_bits = self.bitmap & ((1 << (count - 1)) - 1)
+        self.gaps += count - bin(received_bits).count('1')
+        self._advance(count)
+
+
+class SequenceVerifier(object):
+    """Verifies the sequence numbers of many producers, logging problems
+    as they are found.
+
+    """
+
+    def __init__(self, window_size=65536, logger=None, report_interval=100000):
+        """
+        :param int window_size: How far ahead of the lowest outstanding
+            number a producer may get before the outstanding numbers are
+            counted as gaps
+        :param logger: Where to report duplicates and gaps (optional)
+        :param int report_interval: Log a summary every so many messages
+
+        """
+        self.window_size = window_size
+        self.logger = logger
+        self.report_interval = report_interval
+        self.producers = {}
+        self.checked = 0
+        self.unsequenced = 0
+
+
+    def add(self, producer, sequence):
+        """Record a message, returning the SequenceWindow result.
+
+        :param str producer: Identifies the sending producer
+        :param int sequence: The message's sequence number, or None
+
+        """
+        self.checked += 1
+        if self.logger and self.checked % self.report_interval == 0:
+            self.logger.info("Sequence check: %s", self.summary())
+
+        if sequence is None:
+            self.unsequenced += 1
+            return None
+
+        window = self.producers.get(producer)
+        if window is None:
+            window = self.producers[producer] = SequenceWindow(self.window_size)
+
+        gaps = window.gaps
+        result = window.add(sequence)
+
+        if self.logger:
+            if result == 'duplicate':
+                self.logger.warning("Duplicate sequence %s from %s", sequence, producer)
+            if window.gaps > gaps:
+                self.logger.warning("%s sequence numbers from %s missing below %s",
+                    window.gaps - gaps, producer, window.base)
+
+        return result
+
+
+    def summary(self):
+        # totals across all producers, counting anything still outstanding as a gap
+        received = duplicates = out_of_order = gaps = 0
+        for window in self.producers.values():
+            received += window.received
+            duplicates += window.duplicates
+            out_of_order += window.out_of_order
+            gaps += window.gaps + window.missing()
+
+        return "%s producers, %s sequenced messages, %s gaps, %s duplicates, %s out of order" % (
+            len(self.producers),
+            received,
+            gaps,
+            duplicates,
+            out_of_order)
@@ -0,0 +1,446 @@
+'''
+    Streams large message bodies in and out a chunk at a time.
+
+    A Stream is a body of known length (a file, or a generated payload) that
+    the senders read a frame's worth at a time, straight into the outgoing
+    frames, rather than building the whole body in memory first...
+
+        pika     a Basic.Publish and content header, then one body frame per
+                 chunk, written while pika's outbound buffer has room
+        proton   a single delivery spread over as many transfers as it takes,
+                 its body one data section whose header gives the length up
+                 front, written while the session's outgoing buffer has room
+
+    On the receiving side, a StreamSink writes bodies of at least its
+    threshold to a file (or just counts them) as their frames arrive, so
+    that peak memory stays the same however large the messages get.  The
+    body handed to on_message is then the StreamFile, which knows its
+    length and keeps the first few bytes, enough for the sequence number.
+    Compressed bodies and batches are never streamed, as they have to be
+    read whole to be unpacked.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# application property (pika header) naming the file a streamed body came from
+STREAM_NAME_PROPERTY = "stream_name"
+
+STREAM_CONTENT_TYPE = "application/octet-stream"
+
+# bytes read from a stream at a time, where the protocol doesn't set the size
+CHUNK_SIZE = 64 * 1024
+
+# bytes a sender may have buffered but not yet written before it waits
+STREAM_WINDOW = 1024 * 1024
+
+# seconds between attempts to write more while the buffer is full
+POLL_INTERVAL = 0.001
+
+# bytes of each streamed body kept in memory for the receiver to look at
+HEAD_SIZE = 256
+
+# bytes repeated to pad a generated payload
+FILLER = b"0123456789abcdefghijklmnopqrstuvwxyz"
+
+# AMQP 1.0 section descriptors (as small ulongs) and the data section header
+DATA_SECTION = 0x75
+DATA_SECTION_HEADER = b"\x00\x53\x75\xb0"
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import functools
+import itertools
+import os
+import resource
+import struct
+
+from amqp_common import batching
+
+LENGTH_8 = struct.Struct(">B")
+LENGTH_32 = struct.Struct(">I")
+
+# bytes taken by an AMQP 1.0 value, by the high nibble of its constructor:
+# a fixed width, or the width of the size that follows the constructor
+FIXED_WIDTHS = {0x4: 0, 0x5: 1, 0x6: 2, 0x7: 4, 0x8: 8, 0x9: 16}
+SIZE_WIDTHS = {0xa: LENGTH_8, 0xc: LENGTH_8, 0xe: LENGTH_8, 0xb: LENGTH_32, 0xd: LENGTH_32, 0xf: LENGTH_32}
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the incremental consumption options to a receiver's argument parser
+    opts.add_argument("--stream_threshold",
+        type=int,
+        default=0,
+        required=False,
+        help="write bodies of at least this many bytes out as they arrive, rather than holding them in memory (0 never does)")
+    opts.add_argument("--stream_dir",
+        required=False,
+        help="directory to write streamed bodies to (otherwise they are counted and discarded)")
+
+
+def from_options(opts, options):
+    # returns a StreamSink, or None if bodies aren't being streamed
+    if options.stream_threshold < 0:
+        opts.error("The stream threshold cannot be negative")
+    if options.stream_dir and not options.stream_threshold:
+        opts.error("A stream directory needs a --stream_threshold")
+
+    if not options.stream_threshold:
+        return None
+    return StreamSink(options.stream_threshold, options.stream_dir)
+
+
+def file_stream(path):
+    # a Stream of the file's contents, named after the file
+    length = os.path.getsize(path)
+    return Stream(length, functools.partial(file_chunks, path, length), os.path.basename(path))
+
+
+def generated_stream(prefix, size):
+    # a Stream of the prefix followed by size bytes of filler, never all in memory at once
+    return Stream(len(prefix) + size, functools.partial(generated_chunks, prefix, size))
+
+
+def file_chunks(path, length, chunk_size):
+    # yields the first length bytes of the file, chunk_size bytes at a time
+    with open(path, 'rb') as a_file:
+        remaining = length
+        while remaining:
+            chunk = a_file.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError("%s shrank while it was being sent" % path)
+            remaining -= len(chunk)
+            yield chunk
+
+
+def generated_chunks(prefix, size, chunk_size):
+    # yields the prefix and filler chunk_size bytes at a time, reusing one block of filler
+    block = (FILLER * (chunk_size // len(FILLER) + 1))[:chunk_size]
+    pending = prefix
+    remaining = len(prefix) + size
+
+    while remaining > 0:
+        length = min(chunk_size, remaining)
+        if pending:
+            chunk = (pending + block)[:length]
+            pending = pending[length:]
+        else:
+            chunk = block[:length]
+        remaining -= length
+        yield chunk
+
+
+def data_section_header(length):
+    # the start of an AMQP 1.0 data section holding length bytes
+    return DATA_SECTION_HEADER + LENGTH_32.pack(length)
+
+
+def section_sizes(buffer):
+    """Return (descriptor, header length, value length) for the AMQP 1.0
+    section at the start of the buffer, or None if the buffer doesn't yet
+    hold enough of it to tell.  The header is the descriptor, constructor
+    and any size; the value follows it.
+
+    """
+    if len(buffer) < 3:
+        return None
+    if buffer[0] != 0x00 or buffer[1] != 0x53:
+        raise ValueError("Unexpected AMQP 1.0 section constructor 0x%02x%02x" % (buffer[0], buffer[1]))
+
+    descriptor = buffer[2]
+    if len(buffer) < 4:
+        return None
+    constructor = buffer[3]
+    if constructor >> 4 in FIXED_WIDTHS:
+        return (descriptor, 4, FIXED_WIDTHS[constructor >> 4])
+
+    size = SIZE_WIDTHS.get(constructor >> 4)
+    if size is None:
+        raise ValueError("Unexpected AMQP 1.0 constructor 0x%02x in section 0x%02x" % (constructor, descriptor))
+    if len(buffer) < 4 + size.size:
+        return None
+    (length,) = size.unpack_from(buffer, 4)
+    return (descriptor, 4 + size.size, length)
+
+
+def streamable(content_type, compressed):
+    # whether a body can be streamed: compressed bodies and batches have to be
+    # read whole, to be decompressed or unpacked
+    return not compressed and content_type != batching.BATCH_CONTENT_TYPE
+
+
+def peak_rss():
+    # the process's peak resident set size in bytes (Linux reports kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sent_summary(count, body_bytes):
+    return "%s bodies streamed, %s bytes, peak RSS %0.1fMB" % (count, body_bytes, peak_rss() / 1048576.0)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Stream(object):
+    """A message body of known length, read a chunk at a time.
+
+    """
+
+    def __init__(self, length, source, name=None):
+        """
+        :param int length: The body's length in bytes
+        :param function source: Called with a chunk size, returns an
+            iterator over the body's chunks
+        :param str name: Where the body came from, if anywhere
+
+        """
+        self.length = length
+        self.name = name
+        self._source = source
+
+
+    def chunks(self, chunk_size):
+        # a fresh pass over the body, so that it can be sent again after a reconnection
+        return self._source(chunk_size)
+
+
+class OutgoingStream(object):
+    """Writes a message into a single AMQP 1.0 delivery on a proton sender,
+    the encoded message (without a body) first and the Stream after it as
+    one data section.  pump() writes while the session's outgoing buffer
+    has room, and is called again until it returns True (and done is set).
+
+    """
+
+    def __init__(self, sender, preamble, stream, chunk_size=CHUNK_SIZE):
+        """
+        :param proton.Sender sender: The link to send on, which has credit
+        :param bytes preamble: The message encoded without a body
+        :param Stream stream: The body
+
+        """
+        self.sender = sender
+        self.stream = stream
+        self.delivery = sender.delivery(sender.delivery_tag())
+        self.done = False
+        self._pieces = itertools.chain(
+            [preamble + data_section_header(stream.length)],
+            stream.chunks(chunk_size))
+
+
+    def pump(self, window=STREAM_WINDOW):
+        """Write as much of the message as the window allows, returning True
+        once it has all been written and the delivery is complete.
+
+        """
+        while not self.done and self.sender.session.outgoing_bytes < window:
+            piece = next(self._pieces, None)
+            if piece is None:
+                self.sender.advance()
+                self.done = True
+            else:
+                self.sender.stream(piece)
+
+        return self.done
+
+
+class SectionReader(object):
+    """Reads an AMQP 1.0 message as its transfers arrive.  The sections
+    before the body are kept, to decode for the properties.  If the first
+    data section is at least the sink's threshold (and those sections allow
+    it), it is written to a StreamFile as it comes; otherwise the whole
+    message is kept, to be decoded as usual.
+
+    """
+
+    def __init__(self, sink, streamable=None):
+        """
+        :param StreamSink sink: Where large bodies are written
+        :param function streamable: Given the encoded sections before the
+            body, says whether it may be streamed
+
+        """
+        self.sink = sink
+        self.streamable = streamable
+        self.preamble = bytearray()
+        self.raw = bytearray()
+        self.stream_file = None
+        self._pending = bytearray()
+        self._remaining = 0
+        self._body_started = False
+
+
+    def feed(self, data):
+        """Take the next bytes of the message.
+
+        :param bytes data: As much of the message as has arrived since last time
+
+        """
+        if self.stream_file is None:
+            self.raw += data
+        self._pending += data
+
+        while self._pending:
+            if self._remaining:
+                # inside a data section, whose bytes go straight through
+                chunk = bytes(self._pending[:self._remaining])
+                del self._pending[:len(chunk)]
+                self._remaining -= len(chunk)
+                if self.stream_file is not None:
+                    self.stream_file.write(chunk)
+                continue
+
+            sizes = section_sizes(self._pending)
+            if sizes is None:
+                return
+            (descriptor, header_length, value_length) = sizes
+
+            if descriptor == DATA_SECTION:
+                if (not self._body_started and value_length >= self.sink.threshold
+                        and (self.streamable is None or self.streamable(bytes(self.preamble)))):
+                    self.stream_file = self.sink.open(value_length)
+                    self.raw = None
+                self._body_started = True
+                del self._pending[:header_length]
+                self._remaining = value_length
+            elif len(self._pending) >= header_length + value_length:
+                self.preamble += self._pending[:header_length + value_length]
+                del self._pending[:header_length + value_length]
+            else:
+                return
+
+
+    def encoded(self):
+        """Return the bytes to decode into a message: those without the body
+        if it was streamed, or else the whole message.
+
+        """
+        if self.stream_file is not None:
+            return bytes(self.preamble)
+        return bytes(self.raw)
+
+
+class StreamFile(object):
+    """A body being written out as it arrives, which stands in for the body
+    once it is complete.
+
+    """
+
+    def __init__(self, path, length):
+        """
+        :param str path: Where to write the body (None discards it)
+        :param int length: The length the body is expected to be
+
+        """
+        self.path = path
+        self.length = length
+        self.received = 0
+        self.head = b""
+        if path:
+            self._file = open(path, 'wb')
+        else:
+            self._file = None
+
+
+    def __len__(self):
+        return self.received
+
+
+    def write(self, chunk):
+        if len(self.head) < HEAD_SIZE:
+            self.head += chunk[:HEAD_SIZE - len(self.head)]
+        if self._file:
+            self._file.write(chunk)
+        self.received += len(chunk)
+
+
+    def first_line(self):
+        # the producers put the sequence number on the first line of a streamed body
+        return self.head.split(b"\n", 1)[0]
+
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class StreamSink(object):
+    """Opens a StreamFile for each large body and keeps count of them.  A
+    body is written to a temporary file in the directory and renamed, after
+    its stream_name property or else its message id, once it is complete.
+
+    """
+
+    def __init__(self, threshold, directory=None):
+        """
+        :param int threshold: Smallest body, in bytes, to stream
+        :param str directory: Where to write bodies (None discards them)
+
+        """
+        self.threshold = threshold
+        self.directory = directory
+        self.streamed = 0
+        self.body_bytes = 0
+        self.largest = 0
+        self.incomplete = 0
+        self._opened = 0
+        self._open_files = set()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+    def open(self, length):
+        """Start a new body of the given length.
+
+        """
+        self._opened += 1
+        if self.directory:
+            path = os.path.join(self.directory, ".partial-%s-%s" % (os.getpid(), self._opened))
+        else:
+            path = None
+        stream_file = StreamFile(path, length)
+        self._open_files.add(stream_file)
+        return stream_file
+
+
+    def finished(self, stream_file, name=None):
+        """Close a body that has arrived in full, returning it.
+
+        :param StreamFile stream_file: The body
+        :param str name: What to call the file (made safe), if anything
+
+        """
+        stream_file.close()
+        self._open_files.discard(stream_file)
+        self.streamed += 1
+        self.body_bytes += stream_file.received
+        self.largest = max(self.largest, stream_file.received)
+
+        if stream_file.path:
+            name = os.path.basename(str(name or "")) or "message-%s" % self._opened
+            final_path = os.path.join(self.directory, name)
+            os.replace(stream_file.path, final_path)
+            stream_file.path = final_path
+
+        return stream_file
+
+
+    def close(self):
+        # bodies cut short by a lost connection are thrown away
+        for stream_file in self._open_files:
+            stream_file.close()
+            if stream_file.path:
+                os.remove(stream_file.path)
+            self.incomplete += 1
+        self._open_files = set()
+
+
+    def summary(self):
+        return "%s bodies streamed, %s bytes, largest %s bytes, %s incomplete, peak RSS %0.1fMB" % (
+            self.streamed,
+            self.body_bytes,
+            self.largest,
+            self.incomplete,
+            peak_rss() / 1048576.0)
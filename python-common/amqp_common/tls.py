@@ -0,0 +1,149 @@
+'''
+    Shared TLS client context with session resumption.
+
+    The certificate files are checked and loaded into a single SSLContext
+    the first time a client connects, and that context is reused for every
+    later connection and reconnection in the process.  The session from
+    the last handshake is offered on the next one, so that reconnections
+    resume it (from a session id or ticket) rather than going through a full
+    mutual-TLS handshake.  Handshake times are recorded so that the cost of
+    connecting can be reported separately from the rest of the run.
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import os
+import ssl
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+_sessions = {}
+
+
+def session(cafile, certfile, keyfile):
+    # returns this process's TLSSession for a set of certificate files, creating it on first use
+    key = (cafile, certfile, keyfile)
+    if key not in _sessions:
+        _sessions[key] = TLSSession(cafile, certfile, keyfile)
+    return _sessions[key]
+
+
+def sessions():
+    # every TLSSession created so far, for reporting at the end of a run
+    return list(_sessions.values())
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class TimedSSLSocket(ssl.SSLSocket):
+    """SSLSocket that reports its handshakes, and its final session, back
+    to the TLSSession whose context created it.
+
+    """
+
+    tls_session = None
+
+
+    def do_handshake(self, *args, **kwargs):
+        start = time.perf_counter()
+        super(TimedSSLSocket, self).do_handshake(*args, **kwargs)
+        self.tls_session.record_handshake(time.perf_counter() - start, self.session_reused, self.session)
+
+
+    def close(self):
+        # TLS 1.3 tickets arrive after the handshake, so the session is saved again on the way out
+        try:
+            if self.session is not None:
+                self.tls_session.session = self.session
+        except (ValueError, OSError):
+            pass
+        super(TimedSSLSocket, self).close()
+
+
+class TLSSession(object):
+    """A client SSLContext, loaded once, and the session to resume with it.
+
+    """
+
+    def __init__(self, cafile, certfile, keyfile):
+        """
+        :param str cafile: CA certificate used to verify the broker
+        :param str certfile: Client certificate
+        :param str keyfile: Client private key
+
+        """
+        for f in [cafile, certfile, keyfile]:
+            if not os.path.isfile(f):
+                raise Exception(f + " does not exist")
+
+        # brokers are addressed by whatever name the test network gives them,
+        # so the certificate chain is verified but the host name isn't
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_REQUIRED
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.context.load_verify_locations(cafile)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.context.sslsocket_class = type("SessionSSLSocket", (TimedSSLSocket,), {"tls_session": self})
+
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_total = 0.0
+        self.handshake_max = 0.0
+        self._connection_classes = {}
+
+
+    def wrap_socket(self, sock, server_hostname=None, do_handshake_on_connect=True):
+        """Wrap a socket for the client side of a connection, offering the
+        last session for resumption.
+
+        """
+        return self.context.wrap_socket(sock,
+            server_hostname=server_hostname,
+            do_handshake_on_connect=do_handshake_on_connect,
+            session=self.session)
+
+
+    def record_handshake(self, elapsed, reused, session):
+        self.handshakes += 1
+        self.handshake_total += elapsed
+        if elapsed > self.handshake_max:
+            self.handshake_max = elapsed
+        if reused:
+            self.resumed += 1
+        if session is not None:
+            self.session = session
+
+
+    def connection_class(self, base):
+        """Return a subclass of a pika connection class whose sockets are
+        wrapped with this context.  pika 0.x builds a new context from its
+        ssl_options on every connect, so the class overrides its _wrap_socket.
+
+        :param class base: The pika connection class, e.g. pika.SelectConnection
+
+        """
+        if base not in self._connection_classes:
+            tls_session = self
+
+            def _wrap_socket(connection, sock):
+                return tls_session.wrap_socket(sock,
+                    server_hostname=connection.params.host,
+                    do_handshake_on_connect=connection.DO_HANDSHAKE)
+
+            self._connection_classes[base] = type("TLS" + base.__name__, (base,), {"_wrap_socket": _wrap_socket})
+
+        return self._connection_classes[base]
+
+
+    def summary(self):
+        if not self.handshakes:
+            return "no handshakes"
+        return "%s handshakes (%s resumed), mean %0.3fms max %0.3fms" % (
+            self.handshakes,
+            self.resumed,
+            1000 * self.handshake_total / self.handshakes,
+            1000 * self.handshake_max)
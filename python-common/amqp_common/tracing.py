@@ -0,0 +1,80 @@
+'''
+    Sampled, structured per-message tracing.
+
+    Per-message detail is kept out of the logging calls on the hot path,
+    where even a suppressed logging.debug costs a level check and an
+    argument tuple for every message.  Instead, the clients hold a Tracer
+    (or None when tracing is off, so that the check is a single comparison)
+    and write one JSON line for every Nth message, chosen by message number
+    so that the same messages are traced at each stage of their lifecycle.
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import json
+import sys
+import time
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the tracing options to a script's argument parser
+    opts.add_argument("--trace",
+        type=int,
+        default=0,
+        required=False,
+        help="write a JSON trace line for one in every N messages (0 disables tracing)")
+    opts.add_argument("--trace_file",
+        required=False,
+        help="file to write the trace to (defaults to stderr)")
+
+
+def from_options(options):
+    # builds the Tracer described by the command line options, or None
+    if options.trace < 1:
+        return None
+
+    if options.trace_file:
+        return Tracer(options.trace, open(options.trace_file, 'a'))
+    return Tracer(options.trace)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class Tracer(object):
+    """Writes a JSON line for one in every sample_every messages.
+
+    """
+
+    def __init__(self, sample_every, stream=None):
+        """
+        :param int sample_every: Trace messages whose number is a multiple of this
+        :param file stream: Where to write the trace (defaults to stderr)
+
+        """
+        self.sample_every = max(sample_every, 1)
+        self._stream = stream or sys.stderr
+
+
+    def sampled(self, number):
+        # whether the message with this number should be traced
+        return number % self.sample_every == 0
+
+
+    def emit(self, event, **fields):
+        """Write a trace line for an event.
+
+        :param str event: What happened to the message (e.g. "publish")
+        :param fields: Anything else worth recording
+
+        """
+        fields["event"] = event
+        fields["time"] = time.time()
+        self._stream.write(json.dumps(fields, default=str) + "\n")
+
+
+    def close(self):
+        self._stream.flush()
+        if self._stream not in (sys.stdout, sys.stderr):
+            self._stream.close()
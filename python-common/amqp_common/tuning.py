@@ -0,0 +1,190 @@
+'''
+    Named connection profiles for the pika clients.
+
+    A profile gathers the connection settings that trade throughput against
+    latency, so that they are chosen together with --connection_profile and
+    applied the same way by every client...
+
+        default     the settings the clients have always used
+        throughput  big socket buffers and frames, so that a busy connection
+                    moves more per system call and per frame header
+        latency     small frames and send buffer, so that a message isn't
+                    queued behind a large one, and short heartbeats, so that
+                    a dead connection is noticed quickly
+
+    frame_max, channel_max and the heartbeat are proposals that the broker
+    may negotiate down (RabbitMQ allows frames of 128KB by default).  The
+    socket buffer sizes are set before connecting, as the TCP window scale
+    is agreed in the handshake and a receive buffer set afterwards can't
+    grow past it.  Setting them at all turns off the kernel's autotuning of
+    that socket, and they are capped by net.core.wmem_max and rmem_max.
+    Linux doubles the sizes asked for, so the sizes actually in use are read
+    back for the report.
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# the settings of each profile, as ConnectionProfile arguments
+PROFILES = {
+    "default": {"heartbeat": 3600, "socket_timeout": 5},
+
+    # TCP_NODELAY stays on: Nagle's algorithm holding back the tail of each
+    # write until the last is acked costs more on confirm traffic than it saves
+    "throughput": {
+        "heartbeat": 600,
+        "socket_timeout": 10,
+        "frame_max": 131072,
+        "channel_max": 2047,
+        "send_buffer": 4 * 1024 * 1024,
+        "receive_buffer": 4 * 1024 * 1024},
+
+    "latency": {
+        "heartbeat": 10,
+        "socket_timeout": 5,
+        "frame_max": 4096,
+        "send_buffer": 64 * 1024,
+        "nodelay": True}}
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import socket
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def add_options(opts):
+    # adds the connection profile option to a pika client's argument parser
+    opts.add_argument("--connection_profile",
+        choices=sorted(PROFILES),
+        default="default",
+        required=False,
+        help="heartbeat, frame size and socket settings to connect with")
+
+
+def from_options(options):
+    return profile(options.connection_profile)
+
+
+def profile(name):
+    # a new ConnectionProfile for the named settings
+    return ConnectionProfile(name, **PROFILES[name])
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class ConnectionProfile(object):
+    """A named set of connection settings.
+
+    """
+
+    def __init__(
+        self,
+        name,
+        heartbeat,
+        socket_timeout,
+        frame_max=None,
+        channel_max=None,
+        send_buffer=None,
+        receive_buffer=None,
+        nodelay=True
+    ):
+        """
+        :param str name: The profile's name
+        :param int heartbeat: Seconds between heartbeats to propose
+        :param float socket_timeout: Seconds to wait while connecting
+        :param int frame_max: Largest frame to propose, if not pika's default
+        :param int channel_max: Most channels to propose, if not pika's default
+        :param int send_buffer: SO_SNDBUF in bytes, if not the system default
+        :param int receive_buffer: SO_RCVBUF in bytes, if not the system default
+        :param bool nodelay: Whether to set TCP_NODELAY (pika always does)
+
+        """
+        self.name = name
+        self.heartbeat = heartbeat
+        self.socket_timeout = socket_timeout
+        self.frame_max = frame_max
+        self.channel_max = channel_max
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.nodelay = nodelay
+        self.negotiated = None
+        self._connection_classes = {}
+
+
+    def parameters(self):
+        """Return the keyword arguments for pika.ConnectionParameters.
+
+        """
+        parameters = {
+            "heartbeat_interval": self.heartbeat,
+            "socket_timeout": self.socket_timeout}
+        if self.frame_max:
+            parameters["frame_max"] = self.frame_max
+        if self.channel_max:
+            parameters["channel_max"] = self.channel_max
+        return parameters
+
+
+    def connection_class(self, base):
+        """Return a subclass of a pika connection class whose sockets get
+        this profile's buffer sizes before they connect.  pika 0.x has no
+        option for them, so the class overrides the method that creates its
+        sockets.
+
+        :param class base: The pika connection class, e.g. pika.SelectConnection
+            or a TLSSession's subclass of it
+
+        """
+        if not (self.send_buffer or self.receive_buffer):
+            return base
+
+        if base not in self._connection_classes:
+            profile = self
+
+            def _create_tcp_connection_socket(connection, sock_family, sock_type, sock_proto):
+                sock = socket.socket(sock_family, sock_type, sock_proto)
+                if profile.send_buffer:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, profile.send_buffer)
+                if profile.receive_buffer:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, profile.receive_buffer)
+                return sock
+
+            self._connection_classes[base] = type("Tuned" + base.__name__, (base,),
+                {"_create_tcp_connection_socket": _create_tcp_connection_socket})
+
+        return self._connection_classes[base]
+
+
+    def apply(self, connection):
+        """Set TCP_NODELAY on a newly opened pika connection and note the
+        settings the broker and the kernel actually agreed to.  The buffer
+        sizes were set before connecting, by connection_class.
+
+        :param pika.connection.Connection connection: The open connection
+
+        """
+        sock = connection.socket
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+
+        # pika keeps the tuned values in its parameters
+        self.negotiated = {
+            "heartbeat": connection.params.heartbeat,
+            "frame_max": connection.params.frame_max,
+            "channel_max": connection.params.channel_max,
+            "send_buffer": sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            "receive_buffer": sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            "nodelay": bool(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))}
+
+
+    def summary(self):
+        if self.negotiated is None:
+            return "%s (never connected)" % self.name
+        return "%s: heartbeat %ss, frame_max %s, channel_max %s, SO_SNDBUF %s, SO_RCVBUF %s, TCP_NODELAY %s" % (
+            self.name,
+            self.negotiated["heartbeat"],
+            self.negotiated["frame_max"],
+            self.negotiated["channel_max"],
+            self.negotiated["send_buffer"],
+            self.negotiated["receive_buffer"],
+            "on" if self.negotiated["nodelay"] else "off")
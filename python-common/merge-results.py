@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+'''
+    Merges the result logs written by the producers' --results option into
+    one report, e.g. for the producers started by producer_looper.ps1...
+
+        python3 merge-results.py results/producer_*.log
+
+    Latencies of producers sending at a fixed rate are corrected for
+    coordinated omission (see amqp_common.results), and reported per
+    interval and overall.  With --compare, each log is reported on its own
+    in a line of a table instead, e.g. to compare connection profiles...
+
+        python3 merge-results.py --compare /tmp/producer_default.log /tmp/producer_throughput.log /tmp/producer_latency.log
+
+    Execute script with -h parameter for usage
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from amqp_common import results
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="Merges client result logs into one report, corrected for coordinated omission.")
+
+    opts.add_argument("logs",
+        nargs="+",
+        help="result log(s) to merge")
+    opts.add_argument("--expected_interval",
+        type=float,
+        required=False,
+        help="milliseconds each client was meant to leave between sends (defaults to the rate in its log, without which its latencies aren't corrected)")
+    opts.add_argument("--compare",
+        required=False,
+        default=False,
+        action="store_true",
+        help="report each log on its own, side by side, rather than merging them")
+    options = opts.parse_args()
+
+    if options.expected_interval is not None and options.expected_interval <= 0:
+        opts.error("The expected interval must be more than 0 milliseconds")
+
+    if options.expected_interval:
+        expected_interval = options.expected_interval / 1000.0
+    else:
+        expected_interval = None
+
+    return(
+        options.logs,
+        expected_interval,
+        options.compare)
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    (logs, expected_interval, compare) = process_options()
+
+    try:
+        if compare:
+            lines = results.compare(logs, expected_interval)
+        else:
+            lines = results.merge(logs, expected_interval).lines()
+    except IOError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    for line in lines:
+        print(line)
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
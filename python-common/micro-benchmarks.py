@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+'''
+    Measures what each step of sending and receiving one message costs the
+    clients (see amqp_common.benchmarks), without a broker.  Save a baseline
+    before changing the per-message code, and compare against it after...
+
+        python3 micro-benchmarks.py --save /tmp/baseline.json
+        python3 micro-benchmarks.py --compare /tmp/baseline.json
+
+    It exits with status 1 if any benchmark failed or, when comparing, got
+    slower by more than the tolerance.
+
+    Execute script with -h parameter for usage
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from amqp_common import benchmarks
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="Per-message cost microbenchmarks for the clients' encode and decode paths.")
+
+    opts.add_argument("--filter", "-k",
+        nargs="+",
+        required=False,
+        help="only run benchmarks whose names contain one of these, e.g. 'pika.' or 'receive'")
+    opts.add_argument("--repeat", "-r",
+        type=int,
+        default=benchmarks.DEFAULT_REPEAT,
+        required=False,
+        help="times to measure each benchmark (the median is reported)")
+    opts.add_argument("--min_time",
+        type=float,
+        default=benchmarks.MIN_TIME,
+        required=False,
+        help="seconds each measurement runs for at least")
+    opts.add_argument("--save",
+        required=False,
+        help="write the results to this file as a baseline")
+    opts.add_argument("--compare",
+        required=False,
+        help="compare the results with this baseline")
+    opts.add_argument("--tolerance",
+        type=float,
+        default=benchmarks.DEFAULT_TOLERANCE,
+        required=False,
+        help="percentage change from the baseline that counts as slower or faster")
+    opts.add_argument("--list",
+        required=False,
+        default=False,
+        action="store_true",
+        help="list the benchmarks that would be run, and stop")
+    options = opts.parse_args()
+
+    if options.repeat < 2:
+        opts.error("Each benchmark must be measured at least twice")
+    if options.min_time <= 0:
+        opts.error("The minimum time must be more than 0 seconds")
+    if options.tolerance < 0:
+        opts.error("The tolerance cannot be negative")
+
+    return(
+        options.filter,
+        options.repeat,
+        options.min_time,
+        options.save,
+        options.compare,
+        options.tolerance,
+        options.list)
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    (name_filter, repeat, min_time, save_path, compare_path, tolerance, list_only) = process_options()
+
+    suite = [(name, function) for (name, function) in benchmarks.suite()
+        if not name_filter or any(part in name for part in name_filter)]
+    if not benchmarks.PIKA_AVAILABLE:
+        print("pika is not installed, so its benchmarks are skipped")
+    if not benchmarks.PROTON_AVAILABLE:
+        print("proton is not installed, so its benchmarks are skipped")
+
+    if list_only:
+        for (name, function) in suite:
+            print(name)
+        return
+
+    baseline = None
+    if compare_path:
+        try:
+            baseline = benchmarks.load(compare_path)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        print("Comparing with %s (Python %s on %s, %s)" % (
+            compare_path, baseline["python"], baseline["node"], baseline["created"]))
+
+    results = benchmarks.run(suite, repeat, min_time)
+    (lines, slower, failed) = benchmarks.report(results, baseline, tolerance)
+    for line in lines:
+        print(line)
+
+    if save_path:
+        benchmarks.save(save_path, results)
+        print("Baseline saved to %s" % save_path)
+
+    if failed:
+        print("%s benchmark(s) failed: %s" % (len(failed), ", ".join(failed)))
+    if slower:
+        print("%s benchmark(s) slower than the baseline: %s" % (len(slower), ", ".join(slower)))
+    if failed or slower:
+        sys.exit(1)
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
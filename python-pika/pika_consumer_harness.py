@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+'''
+    Python AMQP 0-9-1 competing-consumer harness.  Runs increasing numbers of
+    consumers against the same queue, each on its own connection with its
+    own prefetch, and reports the aggregate throughput, each consumer's share
+    and how fairly the queue was shared out, so as to show the point at
+    which adding consumers stops helping.
+
+    The queue needs to be kept busy by a producer for the whole run.
+
+    Execute script with -h parameter for usage
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# seconds beyond the duration to wait for consumers that can't connect or stop
+GRACE_PERIOD = 60
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import os
+
+from pika_receiver import Consumer
+
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import cli, tuning
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="AMQP 0-9-1 competing-consumer harness.  Will run increasing numbers of consumers against a queue.")
+
+    opts.add_argument("--broker", "-b",
+        required=False,
+        default="amqp://localhost:5672",
+        help="broker connection string")
+    opts.add_argument("--exchange", "-e",
+        required=False,
+        help="exchange name (is set to the queue name if omitted)")
+    opts.add_argument("--queue", "-q",
+        required=True,
+        help="queue name")
+    opts.add_argument("--consumers", "-n",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        required=False,
+        help="numbers of competing consumers to try, in turn")
+    opts.add_argument("--processes",
+        type=int,
+        default=1,
+        required=False,
+        help="spread the consumers over this many processes (the rest are threads within them)")
+    opts.add_argument("--prefetch",
+        type=int,
+        nargs="+",
+        default=[10],
+        required=False,
+        help="prefetch count for each consumer (repeated if there are more consumers than counts)")
+    opts.add_argument("--duration", "-d",
+        type=float,
+        default=10,
+        required=False,
+        help="seconds to consume for at each number of consumers")
+    opts.add_argument("--min_gain",
+        type=float,
+        default=10,
+        required=False,
+        help="percentage increase in throughput below which more consumers aren't considered to help")
+    tuning.add_options(opts)
+    cli.add_verbose_option(opts)
+    options = opts.parse_args()
+
+    # Check that the connection string looks sensible
+    cli.check_broker(opts, options.broker, "pika")
+
+    if min(options.consumers) < 1 or options.processes < 1:
+        opts.error("The numbers of consumers and processes must be at least 1")
+    if min(options.prefetch) < 0:
+        opts.error("The prefetch count cannot be negative")
+
+    # if no explicit exchange parameter was specified, set it to the same as the queue
+    if options.exchange:
+        exchange = options.exchange
+    else:
+        exchange = options.queue
+
+    log_level = cli.log_level(options)
+
+    return(
+        options.broker,
+        exchange,
+        options.queue,
+        options.consumers,
+        options.processes,
+        options.prefetch,
+        options.duration,
+        options.min_gain,
+        options.connection_profile,
+        log_level)
+
+
+def run_consumers(broker, exchange, queue_name, consumers, duration, results, profile_name, log_level=None):
+    # runs each (name, prefetch) consumer on its own thread, waiting for them all to finish
+    if log_level is not None:
+        # a fresh process needs its logging set up again
+        logging.basicConfig(
+                level=log_level,
+                format=cli.LOG_FORMAT,
+            )
+
+    threads = []
+    for (name, prefetch) in consumers:
+        consumer = TimedConsumer(broker, exchange, queue_name, prefetch, duration, name, results,
+            tuning.profile(profile_name))
+        threads.append(threading.Thread(target=consumer.run, name=name, daemon=True))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(duration + GRACE_PERIOD)
+
+
+def run_step(broker, exchange, queue_name, count, processes, prefetch, duration, profile_name, log_level):
+    # runs count consumers for the duration, returning a (name, prefetch, messages, seconds) tuple for each
+    consumers = [("consumer-%s" % n, prefetch[n % len(prefetch)]) for n in range(count)]
+    results = multiprocessing.Queue()
+
+    if processes == 1:
+        run_consumers(broker, exchange, queue_name, consumers, duration, results, profile_name)
+    else:
+        workers = [multiprocessing.Process(target=run_consumers,
+                args=(broker, exchange, queue_name, consumers[p::processes], duration, results, profile_name, log_level))
+            for p in range(min(processes, count))]
+        for worker in workers:
+            worker.start()
+
+    collected = []
+    try:
+        for n in range(count):
+            collected.append(results.get(timeout=duration + GRACE_PERIOD))
+    except queue.Empty:
+        logging.warning("Only %s of %s consumers reported back", len(collected), count)
+
+    if processes > 1:
+        for worker in workers:
+            worker.join(GRACE_PERIOD)
+            if worker.is_alive():
+                worker.terminate()
+
+    return sorted(collected)
+
+
+def fairness(rates):
+    # Jain's fairness index: 1 when the consumers share equally, 1/n when one does everything
+    total = sum(rates)
+    if not total:
+        return 0.0
+    return total * total / (len(rates) * sum(rate * rate for rate in rates))
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class TimedConsumer(Consumer):
+    """Consumer that stops after consuming for a set time, reporting how many
+    messages it received.
+
+    """
+
+    def __init__(self, amqp_url, exchange, queue_name, prefetch, duration, name, results, connection_profile=None):
+        """
+        :param int prefetch: Unacknowledged messages allowed (0 is unlimited)
+        :param float duration: Seconds to consume for
+        :param str name: Identifies the consumer in the results
+        :param multiprocessing.Queue results: Where to report the results
+        :param ConnectionProfile connection_profile: Heartbeat, frame and
+            socket settings (the default profile if not given)
+
+        """
+        super(TimedConsumer, self).__init__(amqp_url, exchange, [queue_name], queue_name, 0, prefetch=prefetch,
+            connection_profile=connection_profile)
+        self._duration = duration
+        self._name = name
+        self._results = results
+        self._started = None
+
+
+    def start_consuming(self):
+        """Start the clock as soon as the consumer is registered.
+
+        """
+        super(TimedConsumer, self).start_consuming()
+        if self._started is None:
+            self._started = time.time()
+            self._connection.add_timeout(self._duration, self.finish)
+
+
+    def finish(self):
+        """Invoked by the IOLoop timer once the duration is up.
+
+        """
+        self._results.put((self._name, self._prefetch, self._count, time.time() - self._started))
+        self.stop()
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    start_time = datetime.datetime.now()
+    (broker, exchange, queue_name, consumer_counts, processes, prefetch, duration, min_gain, profile_name, log_level) = process_options()
+
+    cli.setup_logging(log_level)
+
+    steps = []
+    try:
+        for count in consumer_counts:
+            logging.info("Running %s consumers on %s for %ss with the %s connection profile",
+                count, queue_name, duration, profile_name)
+            results = run_step(broker, exchange, queue_name, count, processes, prefetch, duration, profile_name, log_level)
+
+            rates = [messages / seconds for (name, prefetch_count, messages, seconds) in results]
+            total = sum(rates)
+            steps.append((count, total))
+
+            logging.info("%s consumers: %0.1f msg/s in total, fairness %0.3f", count, total, fairness(rates))
+            for ((name, prefetch_count, messages, seconds), rate) in zip(results, rates):
+                logging.info("  %-12s prefetch %-5s %8s messages  %8.1f msg/s  %5.1f%% share",
+                    name, prefetch_count, messages, rate, 100.0 * rate / total if total else 0)
+    except KeyboardInterrupt:
+        logging.info("Keyboard interrupt received")
+
+    # the knee is the first step that didn't add enough throughput to be worth it
+    knee = None
+    for ((count, total), (previous_count, previous_total)) in zip(steps[1:], steps):
+        gain = 100.0 * (total - previous_total) / previous_total if previous_total else 0
+        logging.info("%s -> %s consumers: %+0.1f%% throughput", previous_count, count, gain)
+        if knee is None and gain < min_gain:
+            knee = previous_count
+    if knee is not None:
+        logging.info("Adding consumers stops helping beyond %s (gain below %s%%)", knee, min_gain)
+    elif steps:
+        logging.info("Throughput was still rising at %s consumers", steps[-1][0])
+
+    exec_time = datetime.datetime.now() - start_time
+    logging.info("Execution time %s", exec_time)
+    logging.debug("Disconnected from %s", cli.clean_url(broker))
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
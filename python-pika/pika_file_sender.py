@@ -0,0 +1,518 @@
+#!/usr/bin/python3
+'''
+    Python AMQP 0-9-1 file sender.  Streams the contents of a file onto a
+    queue/topic, one line (or fixed-size record) per message, or the whole
+    file as a single message read a frame at a time.  Capture logs written
+    by the receivers, and JSONL files, are replayed with their original
+    properties and, optionally, their original timing.
+
+    Execute script with -h parameter for usage
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import collections
+import time
+import datetime
+import uuid
+import logging
+import os
+
+import pika
+
+from pika_producer import Publisher, PROFILED_CALLBACKS
+
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import capture, cli, compression, profiling, replay, streaming, tls, tracing, tuning
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="AMQP 0-9-1 file sender.  Will connect to a broker and send a file line-by-line.")
+
+    opts.add_argument("--file", "-f",
+        required=True,
+        help="file (or capture directory, or JSONL file) to be sent")
+    opts.add_argument("--broker", "-b",
+        required=False,
+        default="amqp://localhost:5672",
+        help="broker connection string")
+    opts.add_argument("--exchange", "-e",
+        required=False,
+        help="exchange name (is set to queue/topic name if omitted)")
+    opts.add_argument("--queue", "-q",
+        required=False,
+        help="queue name")
+    opts.add_argument("--topic", "-t",
+        required=False,
+        help="topic name")
+    opts.add_argument("--persistent", "-p",
+        required=False,
+        default=False,
+        action="store_true",
+        help="send persistent messages")
+    opts.add_argument("--header", "-a",
+        action='append',
+        required=False,
+        help="header(s) to be added to the message - to be formatted as 'name=value'")
+    opts.add_argument("--record_size", "-r",
+        type=int,
+        default=0,
+        required=False,
+        help="send fixed-size records of this many bytes rather than lines")
+    opts.add_argument("--stream",
+        required=False,
+        default=False,
+        action="store_true",
+        help="send the whole file as one message, streamed from disk in frame-sized chunks")
+    opts.add_argument("--window", "-w",
+        type=int,
+        default=1000,
+        required=False,
+        help="maximum number of messages awaiting confirmation at any one time")
+    opts.add_argument("--input_compression",
+        choices=["auto", "none", "gzip", "zstd"],
+        default="auto",
+        required=False,
+        help="compression of the input file ('auto' detects it from the file header)")
+    opts.add_argument("--compression", "-z",
+        choices=["none"] + sorted(compression.CODECS),
+        default="none",
+        required=False,
+        help="codec used to compress message bodies")
+    opts.add_argument("--compression_threshold",
+        type=int,
+        default=256,
+        required=False,
+        help="smallest body (in bytes) that will be compressed")
+    replay.add_options(opts)
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    tuning.add_options(opts)
+    cli.add_verbose_option(opts)
+    options = opts.parse_args()
+
+    # Check that the connection string looks sensible
+    cli.check_broker(opts, options.broker, "pika")
+
+    # check that one and only one of topic or queue was specified
+    if options.topic and options.queue:
+        opts.error("You may only specify either a queue or a topic")
+    if not(options.topic) and not(options.queue):
+        opts.error("You must specify either a queue or a topic")
+
+    if options.record_size < 0:
+        opts.error("The record size cannot be negative")
+    if options.window < 1:
+        opts.error("The window must allow at least one unconfirmed message")
+    if options.stream and (options.record_size or options.compression != "none" or options.speed):
+        opts.error("A streamed file cannot be split into records, compressed or paced")
+    if options.input_compression == "zstd" and not capture.ZSTD_AVAILABLE:
+        opts.error("zstd input requires the 'zstandard' package to be installed")
+
+    # add the correct exchange type
+    if options.topic:
+        routing_key = options.topic
+        exchange_type = "topic"
+    else:
+        routing_key = options.queue
+        exchange_type = "direct"
+
+    # if no explicit exchange parameter was specified, set it to the same as the routing key
+    if options.exchange:
+        exchange = options.exchange
+    else:
+        exchange = routing_key
+
+    if options.compression != "none":
+        compressor = compression.Compressor(options.compression, options.compression_threshold)
+    else:
+        compressor = None
+
+    log_level = cli.log_level(options)
+
+    return(
+        options.file,
+        options.broker,
+        routing_key,
+        exchange,
+        exchange_type,
+        options.persistent,
+        options.header,
+        options.record_size,
+        options.stream,
+        options.window,
+        options.input_compression,
+        compressor,
+        replay.from_options(opts, options),
+        tracing.from_options(options),
+        profiling.from_options(options),
+        tuning.from_options(options),
+        log_level)
+
+
+def parse_headers(headers):
+    # takes the array of header parameters and returns a dict
+    header_dict = {}
+
+    for header in headers or []:
+        logging.debug("Header %s", header)
+
+        # headers should have been specified as "name=value"
+        if "=" in header:
+            split_header = header.split('=', 1)
+            header_dict[split_header[0]] = split_header[1]
+        else:
+            logging.warning("Header not structured 'name=value', ignoring parameter - %s", header)
+
+    return header_dict
+
+
+def read_records(a_file, record_size):
+    # yields the file one line, or one fixed-size record, at a time
+    if record_size:
+        record = a_file.read(record_size)
+        while record:
+            yield (record, None, None)
+            record = a_file.read(record_size)
+    else:
+        for a_line in a_file:
+            yield (a_line, None, None)
+
+
+def read_captured_records(path, input_compression):
+    # yields the body, original properties and timestamp of each captured (or JSONL) message
+    for (timestamp, properties, body) in replay.read_timed(path, input_compression):
+        yield (body, properties, timestamp)
+
+
+def captured_properties(captured, headers):
+    # rebuilds pika properties from those stored in a capture
+    merged_headers = dict(captured.get("headers") or captured.get("properties") or {})
+    merged_headers.update(headers)
+
+    return pika.BasicProperties(
+        app_id=captured.get("app_id"),
+        content_type=captured.get("content_type"),
+        content_encoding=captured.get("content_encoding"),
+        correlation_id=captured.get("correlation_id"),
+        delivery_mode=captured.get("delivery_mode"),
+        expiration=captured.get("expiration"),
+        headers=merged_headers or None,
+        message_id=captured.get("message_id") or captured.get("id") or str(uuid.uuid4()),
+        priority=captured.get("priority"),
+        reply_to=captured.get("reply_to"),
+        timestamp=captured.get("timestamp"),
+        type=captured.get("type"))
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class FileSender(Publisher):
+    """Publisher that streams the records of a file rather than generating
+    sequence messages. Only the records inside the confirmation window are
+    held in memory at any one time; publishing pauses when the window is full
+    and resumes as the broker confirms deliveries.  When replaying with a
+    Pacer, publishing also waits on a timer until each record falls due.
+    Records still unconfirmed when the connection drops are sent again once
+    it is back.
+
+    """
+
+    def __init__(
+        self,
+        amqp_url,
+        exchange,
+        exchange_type,
+        routing_key,
+        persistent,
+        records,
+        headers,
+        window,
+        compressor=None,
+        pacer=None,
+        tracer=None,
+        connection_profile=None
+    ):
+        """Setup the file sender, passing in the records to publish.
+
+        :param iter records: Iterator over (bytes body, captured properties,
+            timestamp) tuples, the last two None for plain files
+        :param dict headers: Headers to add to each message
+        :param int window: Maximum number of unconfirmed messages
+        :param Compressor compressor: Compresses message bodies, if compressing
+        :param Pacer pacer: Replays timestamped records at their original
+            pace, if pacing
+        :param Tracer tracer: Traces a sample of the messages, if tracing
+        :param ConnectionProfile connection_profile: Heartbeat, frame and
+            socket settings (the default profile if not given)
+
+        """
+        super(FileSender, self).__init__(
+            amqp_url,
+            exchange,
+            exchange_type,
+            routing_key,
+            0,
+            persistent,
+            compressor=compressor,
+            tracer=tracer,
+            connection_profile=connection_profile)
+        self._records = records
+        self._headers = headers
+        self._window = window
+        self._pacer = pacer
+        self._next_record = None
+        # records to send again, ahead of the rest of the file, after reconnecting
+        self._resend = collections.deque()
+        self._paused = False
+        self._end_of_file = False
+        self._first_message_time = None
+
+        if persistent:
+            self._delivery_mode = 2 # make message persistent
+        else:
+            self._delivery_mode = None
+
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """Requeue the records that were published but never confirmed, and
+        any cut off part way through streaming, before the base class
+        reconnects and forgets them. They go out again, in their original
+        order, ahead of the rest of the file.
+
+        """
+        unconfirmed = [entry if isinstance(entry, tuple) else (entry, None, None)
+            for entry in self._deliveries.values()]
+        self._message_number -= len(unconfirmed)
+        if self._stream is not None:
+            unconfirmed.append((self._stream[3], None, None))
+        if self._next_record is not None:
+            unconfirmed.append(self._next_record)
+            self._next_record = None
+        if unconfirmed and not self._closing:
+            logging.warning("%s unconfirmed records will be sent again", len(unconfirmed))
+        self._resend.extendleft(reversed(unconfirmed))
+        self._end_of_file = False
+
+        super(FileSender, self).on_connection_closed(connection, reply_code, reply_text)
+
+
+    def on_delivery_confirmation(self, method_frame):
+        """Once the base class has done its house keeping, resume publishing
+        if we were waiting for the window to open up, or stop if the whole
+        file has been sent and confirmed.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        super(FileSender, self).on_delivery_confirmation(method_frame)
+
+        if self._end_of_file:
+            if not self._deliveries:
+                self.finish()
+        elif self._paused and len(self._deliveries) < self._window:
+            self._paused = False
+            self.schedule_next_message()
+
+
+    def publish_message(self):
+        """Publish records until either the file is exhausted, the
+        confirmation window is full or (when pacing) the next record isn't due
+        yet, in which case a timer brings us back when it is.
+
+        """
+        if self._first_message_time is None:
+            self._first_message_time = datetime.datetime.now()
+
+        if self._stopping:
+            logging.debug("Script is stopping, cannot publish message")
+            return
+
+        if not self._connection.is_open:
+            logging.debug("Connection is not open, cannot publish message")
+            return
+
+        if self.blocked():
+            return
+
+        while len(self._deliveries) < self._window:
+            # a record that wasn't due yet is held over until its timer fires
+            if self._next_record is None and self._resend:
+                self._next_record = self._resend.popleft()
+            elif self._next_record is None:
+                self._next_record = next(self._records, (None, None, None))
+            (record, captured, timestamp) = self._next_record
+            if record is None:
+                logging.debug("End of file reached after %i messages", self._message_number)
+                self._end_of_file = True
+                if not self._deliveries:
+                    self.finish()
+                return
+
+            if self._pacer is not None and timestamp is not None:
+                due = self._pacer.due(timestamp)
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._connection.add_timeout(wait, self.publish_message)
+                    return
+            self._next_record = None
+
+            if isinstance(record, streaming.Stream):
+                # the body is read from disk as it is sent, and counted once it has all gone
+                self.stream_message(self._routing_key, pika.BasicProperties(
+                    app_id=os.path.basename(__file__),
+                    content_type=streaming.STREAM_CONTENT_TYPE,
+                    delivery_mode=self._delivery_mode,
+                    headers=dict(self._headers, **{streaming.STREAM_NAME_PROPERTY: record.name}),
+                    message_id=(str(uuid.uuid4())),
+                    timestamp=int(time.time())), record)
+                return
+
+            # kept as read, to send again if it isn't confirmed
+            entry = (record, captured, timestamp)
+            if captured is not None:
+                # captured bodies go out exactly as they were received
+                properties = captured_properties(captured, self._headers)
+            else:
+                (record, content_encoding, headers) = self.compress_body(record, self._headers)
+                properties = pika.BasicProperties(
+                    app_id=os.path.basename(__file__),
+                    content_type='text/plain',
+                    content_encoding=content_encoding,
+                    delivery_mode=self._delivery_mode,
+                    headers=headers,
+                    message_id=(str(uuid.uuid4())),
+                    timestamp=int(time.time()))
+
+            self._channel.basic_publish(self._exchange, self._routing_key,
+                                        record,
+                                        properties)
+            self._message_number += 1
+            self.published(entry)
+            if self._pacer is not None and timestamp is not None:
+                self._pacer.sent(timestamp, due)
+            if self._tracer is not None and self._tracer.sampled(self._message_number):
+                self._tracer.emit('publish',
+                    record=self._message_number,
+                    delivery_tag=self._delivery_tag,
+                    message_id=properties.message_id,
+                    size=len(record))
+
+        # the window fills on almost every confirmation, so this isn't logged
+        self._paused = True
+
+
+    def after_publish(self):
+        """Carry on with the next record once a streamed one has been sent.
+
+        """
+        self.publish_message()
+
+
+    def finish(self):
+        """Report on the run and shut down.
+
+        """
+        message_processing_time = datetime.datetime.now() - self._first_message_time
+        logging.info("%s messages sent in %s (%s/s), %i acked and %i nacked",
+            self._message_number,
+            message_processing_time,
+            round(self._message_number/max(message_processing_time.total_seconds(), 0.000001), 2),
+            self._acked,
+            self._nacked)
+        if self._compressor:
+            logging.info("%s compression: %s", self._compressor.codec, self._compressor.summary())
+        if self._pacer:
+            logging.info("Replay: %s", self._pacer.summary())
+        if self._streamed:
+            logging.info("Streaming: %s", streaming.sent_summary(self._streamed, self._streamed_bytes))
+        logging.info("Flow control: %s", self.flow_control_summary(message_processing_time.total_seconds()))
+        self.stop()
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    start_time = datetime.datetime.now()
+    (filename, broker, routing_key, exchange, exchange_type, persistent, headers,
+        record_size, stream, window, input_compression, compressor, pacer, tracer, profiler, connection_profile, log_level) = process_options()
+
+    cli.setup_logging(log_level)
+
+    try:
+        if stream:
+            a_file = None
+            records = iter([(streaming.file_stream(filename), None, None)])
+        elif replay.is_timed(filename):
+            logging.debug("Replaying %s", filename)
+            a_file = None
+            records = read_captured_records(filename, input_compression)
+        else:
+            a_file = capture.open_input(filename, input_compression)
+            records = read_records(a_file, record_size)
+    except IOError:
+        logging.error("File not found %s", filename)
+        sys.exit()
+
+    conn = FileSender(
+        broker,
+        exchange,
+        exchange_type,
+        routing_key,
+        persistent,
+        records,
+        parse_headers(headers),
+        window,
+        compressor,
+        pacer,
+        tracer,
+        connection_profile
+    )
+
+    if profiler:
+        profiler.instrument(conn, PROFILED_CALLBACKS)
+
+    try:
+        if profiler:
+            profiler.run(conn.run)
+        else:
+            conn.run()
+    except KeyboardInterrupt:
+        logging.info("Keyboard interrupt received")
+        conn.stop()
+    except Exception as e:
+        raise e
+    finally:
+        if a_file:
+            a_file.close()
+
+    exec_time = datetime.datetime.now() - start_time
+    logging.info("Execution time %s", exec_time)
+    logging.info("Connection profile %s", connection_profile.summary())
+    for tls_session in tls.sessions():
+        logging.info("TLS %s", tls_session.summary())
+    if profiler:
+        profiler.report(logging)
+    if tracer:
+        tracer.close()
+    logging.debug("Disconnected from %s", cli.clean_url(broker))
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,24 @@ CACERTFILE = "/mnt/ssl/ca/cacert.pem"
 CERTFILE   = "/mnt/ssl/client/cert.pem"
 KEYFILE    = "/mnt/ssl/client/key.pem"
 
+# lifecycle callbacks timed by --phases
+PROFILED_CALLBACKS = [
+    "connect",
+    "on_connection_open",
+    "on_channel_open",
+    "on_exchange_declareok",
+    "on_queue_declareok",
+    "on_bindok",
+    "publish_message",
+    "publish_batch",
+    "on_schedule_tick",
+    "pump_stream",
+    "on_delivery_confirmation",
+    "on_connection_blocked",
+    "on_connection_unblocked",
+    "stop",
+    "on_connection_closed"]
+
 
 # --- LIBRARIES --------------------------------------------------------------
 
@@ -23,9 +41,9 @@ if sys.version_info[0] < 3:
     raise Exception("Python 3 or a more recent version is required.")
 
 import argparse
+import collections
 import time
 import datetime
-import re
 import uuid
 import logging
 import os
@@ -33,9 +51,12 @@ import os
 import pika
 from pika.credentials import ExternalCredentials
 import json
-import ssl
 from urllib.parse import urlparse
 
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import batching, cli, compression, monitoring, profiling, results, routing, scheduling, sequencing, streaming, tls, tracing, tuning
+
 # --- FUNCTIONS --------------------------------------------------------------
 
 def process_options():
@@ -68,17 +89,52 @@ def process_options():
     opts.add_argument("--topic", "-t",
         required=False,
         help="topic name")
-    opts.add_argument("--verbose", "-v",
+    opts.add_argument("--batch",
+        type=int,
+        default=0,
         required=False,
-        default=False,
-        action="store_true",
-        help="send log messages to sysout")
+        help="pack up to this many messages into each AMQP message (0 disables batching)")
+    opts.add_argument("--batch_bytes",
+        type=int,
+        default=128 * 1024,
+        required=False,
+        help="maximum size of a batch in bytes")
+    opts.add_argument("--linger",
+        type=float,
+        default=5,
+        required=False,
+        help="milliseconds a partly filled batch may wait before it is sent")
+    opts.add_argument("--compression", "-z",
+        choices=["none"] + sorted(compression.CODECS),
+        default="none",
+        required=False,
+        help="codec used to compress message bodies")
+    opts.add_argument("--compression_threshold",
+        type=int,
+        default=256,
+        required=False,
+        help="smallest body (in bytes) that will be compressed")
+    opts.add_argument("--expiration",
+        type=int,
+        required=False,
+        help="milliseconds each message may wait on a queue before the broker expires it")
+    opts.add_argument("--payload_size",
+        type=int,
+        default=0,
+        required=False,
+        help="follow each sequence number with this many bytes of payload, streamed in frame-sized chunks rather than built in memory")
+    scheduling.add_options(opts)
+    routing.add_options(opts)
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    results.add_options(opts)
+    monitoring.add_options(opts)
+    tuning.add_options(opts)
+    cli.add_verbose_option(opts)
     options = opts.parse_args()
 
     # Check that the connection string looks sensible
-    checkConnection = re.match('amqp(s?):\/\/(.*):\d{1,5}$', options.broker, )
-    if not(checkConnection):
-        opts.error("The broker connection string looks a bit dodgy.  It should be something like 'amqp://localhost:5672'")
+    cli.check_broker(opts, options.broker, "pika")
 
     # check that one and only one of topic or queue was specified
     if options.topic and options.queue:
@@ -86,6 +142,15 @@ def process_options():
     if not(options.topic) and not(options.queue):
         opts.error("You must specify either a queue or a topic")
 
+    if options.key_space and not options.topic:
+        opts.error("A key space can only be used with a topic")
+    if options.expiration is not None and options.expiration < 0:
+        opts.error("The expiration cannot be negative")
+    if options.payload_size < 0:
+        opts.error("The payload size cannot be negative")
+    if options.payload_size and (options.batch > 1 or options.compression != "none" or options.rate or options.delay):
+        opts.error("A streamed payload cannot be batched, compressed or scheduled")
+
     # add the correct exchange type
     if options.topic:
         routing_key = options.topic
@@ -100,10 +165,17 @@ def process_options():
     else:
         exchange = routing_key
 
-    if options.verbose:
-        log_level = logging.DEBUG
+    if options.batch > 1:
+        batcher = batching.Batcher(options.batch, options.batch_bytes, options.linger / 1000.0)
     else:
-        log_level = logging.INFO
+        batcher = None
+
+    if options.compression != "none":
+        compressor = compression.Compressor(options.compression, options.compression_threshold)
+    else:
+        compressor = None
+
+    log_level = cli.log_level(options)
 
     return(
         options.broker,
@@ -112,17 +184,22 @@ def process_options():
         exchange_type,
         options.max_messages,
         options.persistent,
+        batcher,
+        compressor,
+        routing.from_options(opts, options, routing_key),
+        scheduling.from_options(opts, options, options.max_messages),
+        options.expiration,
+        options.payload_size,
+        tracing.from_options(options),
+        profiling.from_options(options),
+        results.from_options(opts, options, "pika_producer", 1.0 / options.rate if options.rate else None,
+            options.connection_profile),
+        # a topic's queues are the receivers' business, so only alarms are sampled unless queues are named
+        monitoring.from_options(opts, options, "rabbitmq", [options.queue] if options.queue else []),
+        tuning.from_options(options),
         log_level)
 
 
-def clean_url(dirty_url):
-    # removes ID and password from URL, if present
-    if "@" in dirty_url:
-        return dirty_url.split('@', 1)[1]
-    else:
-        return dirty_url
-
-
 # --- CLASSES ----------------------------------------------------------------
 
 class Publisher(object):
@@ -138,7 +215,6 @@ class Publisher(object):
     messages that have been sent and if they've been confirmed by the broker.
 
     """
-    _PUBLISH_INTERVAL = 0 # number of seconds to wait between publishing messages
     _WAIT_INTERVAL = 20   # number of seconds to wait before retrying connection
 
 
@@ -149,7 +225,16 @@ class Publisher(object):
         exchange_type,
         routing_key,
         max_messages,
-        persistent
+        persistent,
+        batcher=None,
+        compressor=None,
+        tracer=None,
+        key_space=None,
+        schedule=None,
+        expiration=None,
+        result_log=None,
+        connection_profile=None,
+        payload_size=0
     ):
         """Setup the example publisher object, passing in the URL we will use
         to connect to the broker.
@@ -159,11 +244,26 @@ class Publisher(object):
         :param str routing_key: The name of the routing key
         :param int max_messages: How many messages to send
         :param boo persistent: Whether to set messages to be persistent or not
+        :param Batcher batcher: Packs messages into envelopes, if batching
+        :param Compressor compressor: Compresses message bodies, if compressing
+        :param Tracer tracer: Traces a sample of the messages, if tracing
+        :param KeySpace key_space: Chooses each message's routing key, if
+            not publishing everything with routing_key
+        :param SendSchedule schedule: Decides when each message is due, if
+            not publishing as fast as possible
+        :param int expiration: Per-message TTL in milliseconds, if any
+        :param ResultLog result_log: Logs throughput and latency per
+            interval, if logging results
+        :param ConnectionProfile connection_profile: Heartbeat, frame and
+            socket settings (the default profile if not given)
+        :param int payload_size: Bytes of payload to stream after each
+            sequence number, if any
 
         """
         self._connection = None
         self._channel = None
-        self._deliveries = []
+        # what was published under each unconfirmed delivery tag, in the order it was published
+        self._deliveries = collections.OrderedDict()
         self._acked = 0
         self._nacked = 0
         self._message_number = 0
@@ -176,6 +276,33 @@ class Publisher(object):
         self._queue = routing_key
         self._max_messages = max_messages
         self._persistent = persistent
+        self._batcher = batcher
+        self._batches = 0
+        self._compressor = compressor
+        self._producer_id = sequencing.producer_id()
+        self._tracer = tracer
+        self._key_space = key_space
+        self._schedule = schedule
+        self._ticking_connection = None
+        if expiration is None:
+            self._expiration = None
+        else:
+            self._expiration = str(expiration)
+        self._result_log = result_log
+        self._connection_profile = connection_profile or tuning.profile("default")
+        # (send time, intended send time, message count) by delivery tag, when logging results
+        self._send_times = {}
+        self._batch_intended = None
+        # flow control: when the broker blocked the connection, if it has, and for how long in all
+        self._blocked_since = None
+        self._blocked_count = 0
+        self._blocked_time = 0.0
+        self._publishing_held = False
+        self._payload_size = payload_size
+        # the body being streamed, and what it is being published with, if there is one
+        self._stream = None
+        self._streamed = 0
+        self._streamed_bytes = 0
         self._closing = False
         self._create_exchange = True
 
@@ -190,35 +317,27 @@ class Publisher(object):
         :rtype: pika.SelectConnection
 
         """
-        logging.debug('Connecting to %s', clean_url(self._url))
+        logging.debug('Connecting to %s', cli.clean_url(self._url))
 
         # pull the url apart
         parsed_url = urlparse(self._url)
 
         if parsed_url.scheme == "amqps":
-            for f in [CACERTFILE, CERTFILE, KEYFILE]:
-                if not os.path.isfile(f):
-                    raise Exception(f + " does not exist")
-
-            # set up SSL connection
-            ssl_options = ({"ca_certs": CACERTFILE,
-                    "certfile": CERTFILE,
-                    "keyfile": KEYFILE,
-                    "ssl_version": ssl.PROTOCOL_TLSv1_2,
-                    "cert_reqs": ssl.CERT_REQUIRED})
+            # set up SSL connection, reusing the process's context and last session
+            tls_session = tls.session(CACERTFILE, CERTFILE, KEYFILE)
+            connection_class = tls_session.connection_class(pika.SelectConnection)
 
             params = pika.ConnectionParameters(
                     host=parsed_url.hostname,
                     port=parsed_url.port,
                     credentials=ExternalCredentials(),
                     ssl=True,
-                    ssl_options=ssl_options,
                     connection_attempts=10,
-                    heartbeat_interval=3600,
-                    socket_timeout=5)
+                    **self._connection_profile.parameters())
 
         else:
             # set up non-SSL connection
+            connection_class = pika.SelectConnection
             credentials = pika.PlainCredentials(parsed_url.username, parsed_url.password)
 
             params = pika.ConnectionParameters(
@@ -226,13 +345,14 @@ class Publisher(object):
                     port=parsed_url.port,
                     credentials=credentials,
                     connection_attempts=100,
-                    heartbeat_interval=3600,
-                    socket_timeout=5)
+                    **self._connection_profile.parameters())
 
 
-        return pika.SelectConnection(params,
-                                    self.on_connection_open,
-                                    stop_ioloop_on_close=False)
+        # the profile's socket buffer sizes have to be set before the socket connects
+        connection_class = self._connection_profile.connection_class(connection_class)
+        return connection_class(params,
+                                self.on_connection_open,
+                                stop_ioloop_on_close=False)
 
 
     def on_connection_open(self, unused_connection):
@@ -244,7 +364,9 @@ class Publisher(object):
 
         """
         logging.debug('Connection opened')
+        self._connection_profile.apply(self._connection)
         self.add_on_connection_close_callback()
+        self.add_on_connection_blocked_callbacks()
         self.open_channel()
 
 
@@ -257,6 +379,75 @@ class Publisher(object):
         self._connection.add_on_close_callback(self.on_connection_closed)
 
 
+    def add_on_connection_blocked_callbacks(self):
+        """Ask pika to tell us when RabbitMQ blocks the connection because
+        of a memory or disk alarm, and when it lifts the block.
+
+        """
+        logging.debug('Adding connection blocked callbacks')
+        self._connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        self._connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
+
+    def on_connection_blocked(self, method_frame):
+        """Invoked by pika when RabbitMQ sends Connection.Blocked. The broker
+        stops reading the socket, so anything published now only piles up in
+        pika's buffers; publishing is held until the block is lifted.
+
+        :param pika.frame.Method method_frame: The Connection.Blocked frame
+
+        """
+        logging.warning('Connection blocked by the broker: %s', method_frame.method.reason)
+        if self._blocked_since is None:
+            self._blocked_since = time.monotonic()
+            self._blocked_count += 1
+
+
+    def on_connection_unblocked(self, method_frame):
+        """Invoked by pika when RabbitMQ sends Connection.Unblocked, picking
+        publishing up again where it was held.
+
+        :param pika.frame.Method method_frame: The Connection.Unblocked frame
+
+        """
+        if self._blocked_since is not None:
+            blocked_for = time.monotonic() - self._blocked_since
+            self._blocked_time += blocked_for
+            self._blocked_since = None
+            logging.warning('Connection unblocked after %0.3fs', blocked_for)
+
+        if self._batcher and self._batcher.due() and self._connection.is_open:
+            self.publish_batch()
+        if self._publishing_held:
+            self._publishing_held = False
+            self.schedule_next_message()
+
+
+    def blocked(self):
+        """Return True (and note that publishing has been held) if the broker
+        has blocked the connection.
+
+        """
+        if self._blocked_since is None:
+            return False
+        self._publishing_held = True
+        return True
+
+
+    def flow_control_summary(self, elapsed):
+        """Split the time spent publishing into time the broker held us up
+        with Connection.Blocked and the rest, when the client set the pace.
+
+        :param float elapsed: Seconds spent publishing
+
+        """
+        blocked_time = self._blocked_time
+        if self._blocked_since is not None:
+            blocked_time += time.monotonic() - self._blocked_since
+        return "blocked %s times, broker-limited %0.3fs, client-limited %0.3fs" % (
+            self._blocked_count, blocked_time, max(elapsed - blocked_time, 0))
+
+
     def on_connection_closed(self, connection, reply_code, reply_text):
         """This method is invoked by pika when the connection to RabbitMQ is
         closed unexpectedly. Since it is unexpected, we will reconnect to
@@ -268,6 +459,12 @@ class Publisher(object):
 
         """
         self._channel = None
+        # a body cut off part way is published again, from the start, once reconnected
+        self._stream = None
+        # a new connection starts unblocked
+        if self._blocked_since is not None:
+            self._blocked_time += time.monotonic() - self._blocked_since
+            self._blocked_since = None
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -281,7 +478,8 @@ class Publisher(object):
         closed. See the on_connection_closed method.
 
         """
-        self._deliveries = []
+        self._deliveries = collections.OrderedDict()
+        self._send_times = {}
         self._acked = 0
         self._nacked = 0
         self._delivery_tag = 0
@@ -475,45 +673,88 @@ class Publisher(object):
 
         """
         confirmation_type = method_frame.method.NAME.split('.')[1].lower()
-        logging.debug('Received %s for delivery tag: %i',
-                    confirmation_type,
-                    method_frame.method.delivery_tag)
+        delivery_tag = method_frame.method.delivery_tag
+
+        # the broker may confirm every outstanding tag up to this one at once,
+        # and the tags are held in order, so those are the oldest
+        if method_frame.method.multiple:
+            confirmed_tags = []
+            while self._deliveries and next(iter(self._deliveries)) <= delivery_tag:
+                confirmed_tags.append(self._deliveries.popitem(last=False)[0])
+        else:
+            confirmed_tags = [delivery_tag]
+            self._deliveries.pop(delivery_tag, None)
+
         if confirmation_type == 'ack':
-            self._acked += 1
+            self._acked += len(confirmed_tags)
         elif confirmation_type == 'nack':
-            self._nacked += 1
-        self._deliveries.remove(method_frame.method.delivery_tag)
-        logging.debug('Published %i messages, %i have yet to be confirmed, '
-                    '%i were acked and %i were nacked',
-                    self._message_number, len(self._deliveries),
-                    self._acked, self._nacked)
+            self._nacked += len(confirmed_tags)
+        if self._result_log is not None:
+            for tag in confirmed_tags:
+                (sent_time, intended_time, count) = self._send_times.pop(tag)
+                self._result_log.record_confirm(sent_time, intended_time, count, confirmation_type == 'nack')
+
+        # per-message detail goes to the sampled trace, keeping logging off the hot path
+        if self._tracer is not None and self._tracer.sampled(delivery_tag):
+            self._tracer.emit(confirmation_type,
+                delivery_tag=delivery_tag,
+                confirmed=len(confirmed_tags),
+                published=self._message_number,
+                unconfirmed=len(self._deliveries),
+                acked=self._acked,
+                nacked=self._nacked)
 
 
     def schedule_next_message(self):
         """If we are not closing our connection to RabbitMQ, schedule another
-        message to be delivered in _PUBLISH_INTERVAL seconds.
+        message to be delivered straight away. If the messages are on a
+        schedule, start the timer that turns it instead (once per
+        connection), rather than adding a timeout per message.
+
+        """
+        if self._stopping:
+            return
+
+        if self._schedule is None:
+            self._connection.add_timeout(0, self.publish_message)
+        elif self._ticking_connection is not self._connection:
+            self._ticking_connection = self._connection
+            if self._schedule.started is None:
+                self._schedule.start()
+            self._connection.add_timeout(0, self.on_schedule_tick)
+
+
+    def on_schedule_tick(self):
+        """Invoked by the IOLoop timer every tick of the schedule, publishing
+        whatever has fallen due. Messages that fall due while the connection
+        is down wait until it is back.
 
         """
         if self._stopping:
             return
 
-        logging.debug('Scheduling next message for %0.1f seconds',
-                    self._PUBLISH_INTERVAL)
-        self._connection.add_timeout(self._PUBLISH_INTERVAL,
-                                     self.publish_message)
+        # while the connection is blocked, messages fall due but wait
+        if self._connection.is_open and self._blocked_since is None:
+            for due in self._schedule.due():
+                self.publish_message(due)
+                if self._stopping:
+                    return
 
+        self._connection.add_timeout(self._schedule.resolution, self.on_schedule_tick)
 
-    def publish_message(self):
+
+    def publish_message(self, intended_time=None):
         """If the class is not stopping, publish a message to RabbitMQ,
         appending a list of deliveries with the message number that was sent.
         This list will be used to check for delivery confirmations in the
         on_delivery_confirmations method.
 
         Once the message has been sent, schedule another message to be sent.
-        The main reason I put scheduling in was just so you can get a good idea
-        of how the process is flowing by slowing down and speeding up the
-        delivery intervals by changing the _PUBLISH_INTERVAL constant in the
-        class.
+        When publishing to a schedule (--rate or --delay), this is called for
+        each message as it falls due and scheduling the next does nothing.
+
+        :param float intended_time: When the schedule meant the message to be
+            sent (time.monotonic()), if there is one
 
         """
         if self._message_number == 0:
@@ -527,34 +768,85 @@ class Publisher(object):
             logging.debug("Connection is not open, cannot publish message")
             return
 
+        if self.blocked():
+            return
+
         message = {'sequence':(self._message_number+1)}
-        message_id = uuid.uuid4()
 
-        if self._persistent:
-            properties = pika.BasicProperties(
-                app_id=os.path.basename(__file__),
-                content_type='application/json',
-                delivery_mode=2, # make message persistent
-                message_id=(str(message_id)),
-                timestamp=int(time.time()))
+        if self._batcher:
+            self.batch_message(message, intended_time)
         else:
-            properties = pika.BasicProperties(
-                app_id=os.path.basename(__file__),
-                content_type='application/json',
-                message_id=(str(message_id)),
-                timestamp=int(time.time()))
-
-        self._channel.basic_publish(self._exchange, self._routing_key,
-                                    json.dumps(message, ensure_ascii=False),
-                                    properties)
-        self._message_number += 1
-        self._delivery_tag += 1
-        self._deliveries.append(self._delivery_tag)
-        logging.debug('Published message # %i, tag %i, id %s',
-                    self._message_number,
-                    self._delivery_tag,
-                    message_id)
+            message_id = uuid.uuid4()
+            if self._payload_size:
+                # the sequence number leads the payload, on a line of its own
+                body = streaming.generated_stream(
+                    json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n",
+                    self._payload_size)
+                content_type = streaming.STREAM_CONTENT_TYPE
+                content_encoding = None
+                headers = {sequencing.PRODUCER_ID_PROPERTY: self._producer_id,
+                    sequencing.SENT_TIME_PROPERTY: sequencing.sent_time()}
+            else:
+                (body, content_encoding, headers) = self.compress_body(
+                    json.dumps(message, ensure_ascii=False).encode('utf-8'),
+                    {sequencing.PRODUCER_ID_PROPERTY: self._producer_id,
+                        sequencing.SENT_TIME_PROPERTY: sequencing.sent_time()})
+                content_type = 'application/json'
+
+            if self._persistent:
+                properties = pika.BasicProperties(
+                    app_id=os.path.basename(__file__),
+                    content_type=content_type,
+                    content_encoding=content_encoding,
+                    delivery_mode=2, # make message persistent
+                    expiration=self._expiration,
+                    headers=headers,
+                    message_id=(str(message_id)),
+                    timestamp=int(time.time()))
+            else:
+                properties = pika.BasicProperties(
+                    app_id=os.path.basename(__file__),
+                    content_type=content_type,
+                    content_encoding=content_encoding,
+                    expiration=self._expiration,
+                    headers=headers,
+                    message_id=(str(message_id)),
+                    timestamp=int(time.time()))
+
+            if self._key_space:
+                routing_key = self._key_space.next()
+                self._key_space.count(routing_key)
+            else:
+                routing_key = self._routing_key
+
+            if self._payload_size:
+                # the message is counted, and the next one published, once the body has all gone
+                self.stream_message(routing_key, properties, body, intended_time)
+                return
+
+            self._channel.basic_publish(self._exchange, routing_key,
+                                        body,
+                                        properties)
+            self._message_number += 1
+            self.published()
+            if self._result_log is not None:
+                self.record_send(intended_time, 1)
+            if self._tracer is not None and self._tracer.sampled(self._message_number):
+                self._tracer.emit('publish',
+                    sequence=self._message_number,
+                    delivery_tag=self._delivery_tag,
+                    message_id=message_id,
+                    routing_key=routing_key,
+                    size=len(body))
+
+        self.after_publish()
+
+
+    def after_publish(self):
+        """Publish the next message, or report on the run and stop if that
+        was the last.
 
+        """
         if self._message_number < self._max_messages:
             self.schedule_next_message()
         else:
@@ -563,9 +855,218 @@ class Publisher(object):
                 self._max_messages,
                 message_processing_time,
                 round(self._max_messages/message_processing_time.total_seconds(), 2))
+            if self._batcher:
+                logging.info("%s batches sent (%s messages per batch)",
+                    self._batches,
+                    round(self._max_messages/self._batches, 2))
+            if self._compressor:
+                logging.info("%s compression: %s", self._compressor.codec, self._compressor.summary())
+            if self._key_space:
+                logging.info("Routing keys: %s", self._key_space.summary())
+            if self._schedule:
+                logging.info("Schedule: %s", self._schedule.summary())
+            if self._streamed:
+                logging.info("Streaming: %s", streaming.sent_summary(self._streamed, self._streamed_bytes))
+            logging.info("Flow control: %s", self.flow_control_summary(message_processing_time.total_seconds()))
             self.stop()
 
 
+    def stream_message(self, routing_key, properties, stream, intended_time=None):
+        """Publish a message whose body is read from a Stream a frame at a
+        time, rather than handing pika the whole body to split into frames.
+        The method and content header frames go first, then pump_stream
+        writes the body frames. Nothing else may be published on the channel
+        until the body is complete, as frames of one message can't be
+        interleaved with another's.
+
+        :param str routing_key: The routing key to publish with
+        :param pika.BasicProperties properties: The message properties
+        :param Stream stream: The message body
+        :param float intended_time: When the schedule meant the message to be
+            sent, if there is one
+
+        """
+        channel_number = self._channel.channel_number
+        self._connection._send_frame(pika.frame.Method(channel_number,
+            pika.spec.Basic.Publish(exchange=self._exchange, routing_key=routing_key)))
+        self._connection._send_frame(pika.frame.Header(channel_number, stream.length, properties))
+
+        # body frames carry at most frame_max less the frame header and end byte
+        frame_size = self._connection.params.frame_max - pika.spec.FRAME_HEADER_SIZE - pika.spec.FRAME_END_SIZE
+        self._stream = (stream.chunks(frame_size), routing_key, properties, stream, intended_time)
+        self.pump_stream()
+
+
+    def pump_stream(self):
+        """Write body frames until pika's outbound buffer holds STREAM_WINDOW
+        bytes, the broker blocks the connection or the body is complete. Until then, the IOLoop
+        timer brings us back once pika has had the chance to write some out.
+        pika 0.11 has no public call for sending a body in pieces, so the
+        frames are sent the way basic_publish sends them.
+
+        """
+        if self._stream is None or not self._connection.is_open:
+            return
+
+        (chunks, routing_key, properties, stream, intended_time) = self._stream
+        # the buffer holds marshalled frames, and nothing is written out until we return
+        queued = sum(len(frame) for frame in self._connection.outbound_buffer)
+        while queued < streaming.STREAM_WINDOW and self._blocked_since is None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                self._stream = None
+                self.on_stream_sent(routing_key, properties, stream, intended_time)
+                return
+            self._connection._send_frame(pika.frame.Body(self._channel.channel_number, chunk))
+            queued += pika.spec.FRAME_HEADER_SIZE + len(chunk) + pika.spec.FRAME_END_SIZE
+
+        self._connection.add_timeout(streaming.POLL_INTERVAL, self.pump_stream)
+
+
+    def on_stream_sent(self, routing_key, properties, stream, intended_time):
+        """Invoked once the last body frame of a streamed message has been
+        written, to count it and carry on publishing.
+
+        """
+        self._message_number += 1
+        self.published(stream)
+        self._streamed += 1
+        self._streamed_bytes += stream.length
+        if self._result_log is not None:
+            self.record_send(intended_time, 1)
+        if self._tracer is not None and self._tracer.sampled(self._message_number):
+            self._tracer.emit('publish',
+                sequence=self._message_number,
+                delivery_tag=self._delivery_tag,
+                message_id=properties.message_id,
+                routing_key=routing_key,
+                size=stream.length)
+
+        self.after_publish()
+
+
+    def published(self, entry=None):
+        """Give the message (or batch) just published the next delivery tag,
+        holding it until the broker confirms it.
+
+        :param entry: What was published, for anything that might need to
+            send it again (a streamed message's Stream)
+
+        """
+        self._delivery_tag += 1
+        self._deliveries[self._delivery_tag] = entry
+
+
+    def compress_body(self, body, headers):
+        """Compress the body if a compressor is in use and the body is big
+        enough to be worth it, returning the body, content encoding and
+        headers to publish with. The uncompressed length is added to the
+        headers so that receivers can report on it without decompressing.
+
+        :param bytes body: The message body
+        :param dict headers: Any headers already destined for the message
+
+        """
+        if not self._compressor:
+            return (body, None, headers)
+
+        original_length = len(body)
+        (body, content_encoding) = self._compressor.compress(body)
+        if content_encoding:
+            headers = dict(headers or {})
+            headers[compression.ORIGINAL_LENGTH_PROPERTY] = original_length
+
+        return (body, content_encoding, headers)
+
+
+    def record_send(self, intended_time, count):
+        """Log the send of the message (or batch) just published, and keep
+        its send times until it is confirmed.
+
+        """
+        sent_time = time.monotonic()
+        self._send_times[self._delivery_tag] = (sent_time, intended_time, count)
+        self._result_log.record_send(sent_time, intended_time, count)
+
+
+    def batch_message(self, message, intended_time=None):
+        """Add the message to the current batch, sending the batch once it is
+        full or this is the last message. The first message of a new batch
+        starts the linger timer, so that a partly filled batch is not held
+        back indefinitely when messages are being published slowly. A batch
+        is as late as its oldest message, so that one's intended send time is
+        kept for the whole batch.
+
+        """
+        full = self._batcher.add(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+        self._message_number += 1
+        if len(self._batcher) == 1:
+            self._batch_intended = intended_time
+
+        if full or self._message_number >= self._max_messages:
+            self.publish_batch()
+        elif len(self._batcher) == 1:
+            self._connection.add_timeout(self._batcher.linger, self.on_linger_expired)
+
+
+    def on_linger_expired(self):
+        """Invoked by the IOLoop timer started with a new batch. The batch may
+        already have been sent because it filled up, in which case a later
+        batch will not yet be due.
+
+        """
+        if self._batcher.due() and self._connection.is_open and self._blocked_since is None:
+            self.publish_batch()
+
+
+    def publish_batch(self):
+        """Pack the current batch into a single message and publish it.
+
+        """
+        (envelope, count) = self._batcher.pack()
+        (envelope, content_encoding, headers) = self.compress_body(envelope,
+            {'batch_count': count, sequencing.PRODUCER_ID_PROPERTY: self._producer_id})
+        message_id = uuid.uuid4()
+
+        if self._persistent:
+            delivery_mode = 2 # make message persistent
+        else:
+            delivery_mode = None
+
+        properties = pika.BasicProperties(
+            app_id=os.path.basename(__file__),
+            content_type=batching.BATCH_CONTENT_TYPE,
+            content_encoding=content_encoding,
+            delivery_mode=delivery_mode,
+            expiration=self._expiration,
+            headers=headers,
+            message_id=(str(message_id)),
+            timestamp=int(time.time()))
+
+        # a batch is routed as one message, so all of its entries share a key
+        if self._key_space:
+            routing_key = self._key_space.next()
+            self._key_space.count(routing_key, count)
+        else:
+            routing_key = self._routing_key
+
+        self._channel.basic_publish(self._exchange, routing_key,
+                                    envelope,
+                                    properties)
+        self._batches += 1
+        self.published()
+        if self._result_log is not None:
+            self.record_send(self._batch_intended, count)
+        if self._tracer is not None and self._tracer.sampled(self._batches):
+            self._tracer.emit('publish_batch',
+                batch=self._batches,
+                messages=count,
+                delivery_tag=self._delivery_tag,
+                message_id=message_id,
+                routing_key=routing_key,
+                size=len(envelope))
+
+
     def close_channel(self):
         """Invoke this command to close the channel with RabbitMQ by sending
         the Channel.Close RPC command.
@@ -612,13 +1113,12 @@ class Publisher(object):
 
 def main():
     start_time = datetime.datetime.now()
-    (broker, routing_key, exchange, exchange_type, max_messages, persistent, log_level) = process_options()
+    (broker, routing_key, exchange, exchange_type, max_messages, persistent, batcher, compressor, key_space, schedule,
+        expiration, payload_size, tracer, profiler, result_log, monitor, connection_profile, log_level) = process_options()
 
-    logging.basicConfig(
-            level=log_level,
-            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
-        )
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Started")
+    cli.setup_logging(log_level)
+    if monitor:
+        monitor.start()
 
     conn = Publisher(
         broker,
@@ -626,21 +1126,50 @@ def main():
         exchange_type,
         routing_key,
         max_messages,
-        persistent
+        persistent,
+        batcher,
+        compressor,
+        tracer,
+        key_space,
+        schedule,
+        expiration,
+        result_log,
+        connection_profile,
+        payload_size
     )
 
+    if profiler:
+        profiler.instrument(conn, PROFILED_CALLBACKS)
+
     if max_messages > 0:
         try:
-            conn.run()
+            if profiler:
+                profiler.run(conn.run)
+            else:
+                conn.run()
         except KeyboardInterrupt:
             logging.info("Keyboard interrupt received")
             conn.stop()
         except Exception as e:
             raise e
 
+    if monitor:
+        monitor.stop()
+        for line in monitor.summary_lines():
+            logging.info("Broker %s", line)
+
     exec_time = datetime.datetime.now() - start_time
     logging.info("Execution time %s", exec_time)
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Finished")
+    logging.info("Connection profile %s", connection_profile.summary())
+    for tls_session in tls.sessions():
+        logging.info("TLS %s", tls_session.summary())
+    if profiler:
+        profiler.report(logging)
+    if tracer:
+        tracer.close()
+    if result_log:
+        result_log.close()
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
 
 
 
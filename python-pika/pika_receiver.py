@@ -15,6 +15,18 @@ CACERTFILE = "/mnt/ssl/ca/cacert.pem"
 CERTFILE   = "/mnt/ssl/client/cert.pem"
 KEYFILE    = "/mnt/ssl/client/key.pem"
 
+# lifecycle callbacks timed by --phases
+PROFILED_CALLBACKS = [
+    "connect",
+    "on_connection_open",
+    "on_channel_open",
+    "on_queue_declareok",
+    "on_bindok",
+    "on_message",
+    "on_cancelok",
+    "stop",
+    "on_connection_closed"]
+
 
 # --- LIBRARIES --------------------------------------------------------------
 
@@ -24,15 +36,19 @@ if sys.version_info[0] < 3:
 
 import argparse
 import datetime
-import re
+import time
 import logging
 import os
 
 import pika
+from pika.channel import ContentFrameAssembler
 from pika.credentials import ExternalCredentials
-import ssl
 from urllib.parse import urlparse
 
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import batching, capture, cli, compression, deadletter, monitoring, profiling, sequencing, streaming, tls, tracing, tuning
+
 # --- FUNCTIONS --------------------------------------------------------------
 
 def process_options():
@@ -54,23 +70,80 @@ def process_options():
         default=100,
         required=True,
         help="number of messages to receive before stopping. Setting '0' retrieves indefinitely")
+    opts.add_argument("--prefetch",
+        type=int,
+        default=0,
+        required=False,
+        help="most unacknowledged messages the broker will deliver at once (0 is unlimited)")
     opts.add_argument("--queue", "-q",
         required=False,
         help="queue name")
     opts.add_argument("--topic", "-t",
         required=False,
         help="topic name")
-    opts.add_argument("--verbose", "-v",
+    opts.add_argument("--binding_key", "-k",
+        nargs="+",
+        required=False,
+        help="topic pattern(s) to bind the queue with, e.g. 'some.topic.*.3' or 'some.topic.#' (defaults to the topic name)")
+    opts.add_argument("--capture",
+        required=False,
+        help="directory to capture received messages to (replayable by the file senders)")
+    opts.add_argument("--capture_compression",
+        choices=["none", "gzip", "zstd"],
+        default="none",
+        required=False,
+        help="compression of the capture segments")
+    opts.add_argument("--verify",
+        required=False,
+        default=False,
+        action="store_true",
+        help="check the producers' sequence numbers for gaps, duplicates and reordering")
+    opts.add_argument("--verify_window",
+        type=int,
+        default=65536,
+        required=False,
+        help="how far out of order a message may arrive before the messages it skipped are counted as gaps")
+    opts.add_argument("--reject",
+        type=float,
+        default=0,
+        required=False,
+        help="fraction of messages (0 to 1) to nack, which are dead-lettered unless --requeue is given")
+    opts.add_argument("--requeue",
+        required=False,
+        default=False,
+        action="store_true",
+        help="requeue rejected messages rather than dead-lettering them")
+    opts.add_argument("--dead_letters",
         required=False,
         default=False,
         action="store_true",
-        help="send log messages to sysout")
+        help="report the reasons and latency of dead-lettered messages (when consuming from a dead-letter queue)")
+    opts.add_argument("--echo",
+        required=False,
+        default=False,
+        action="store_true",
+        help="act as an RPC server, sending each message with a reply_to back to it (see pika_rpc_client.py)")
+    streaming.add_options(opts)
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    monitoring.add_options(opts)
+    tuning.add_options(opts)
+    cli.add_verbose_option(opts)
     options = opts.parse_args()
 
+    if options.capture_compression == "zstd" and not capture.ZSTD_AVAILABLE:
+        opts.error("zstd capture requires the 'zstandard' package to be installed")
+
     # Check that the connection string looks sensible
-    checkConnection = re.match('amqp(s?):\/\/(.*):\d{1,5}$', options.broker, )
-    if not(checkConnection):
-        opts.error("The broker connection string looks a bit dodgy.  It should be something like 'amqp://localhost:5672'")
+    cli.check_broker(opts, options.broker, "pika")
+
+    if options.reject < 0 or options.reject > 1:
+        opts.error("The fraction of messages to reject must be between 0 and 1")
+    if options.requeue and options.reject >= 1:
+        opts.error("Requeueing every rejected message would redeliver them forever")
+
+    if options.binding_key and not options.topic:
+        opts.error("Binding keys can only be used with a topic")
 
     # set up the queue name and binding key
     if options.topic:
@@ -91,30 +164,101 @@ def process_options():
     else:
         exchange = binding_key
 
-    if options.verbose:
-        log_level = logging.DEBUG
+    if options.verify:
+        verifier = sequencing.SequenceVerifier(options.verify_window, logging)
+    else:
+        verifier = None
+
+    if options.reject:
+        rejecter = deadletter.Rejecter(options.reject, options.requeue)
+    else:
+        rejecter = None
+
+    if options.dead_letters:
+        dead_letter_stats = deadletter.DeadLetterStats()
     else:
-        log_level = logging.INFO
+        dead_letter_stats = None
+
+    log_level = cli.log_level(options)
 
     return(
         options.broker,
         exchange,
-        binding_key,
+        options.binding_key or [binding_key],
         queue_name,
         options.max_messages,
+        options.prefetch,
+        options.capture,
+        options.capture_compression,
+        verifier,
+        rejecter,
+        dead_letter_stats,
+        options.echo,
+        streaming.from_options(opts, options),
+        tracing.from_options(options),
+        profiling.from_options(options),
+        monitoring.from_options(opts, options, "rabbitmq", [queue_name]),
+        tuning.from_options(options),
         log_level)
 
 
-def clean_url(dirty_url):
-    # removes ID and password from URL, if present
-    if "@" in dirty_url:
-        return dirty_url.split('@', 1)[1]
-    else:
-        return dirty_url
+def capture_properties(properties, basic_deliver):
+    # flattens the message properties into a dict for the capture log
+    captured = dict((name, value) for (name, value) in vars(properties).items()
+        if value is not None)
+    captured["exchange"] = basic_deliver.exchange
+    captured["routing_key"] = basic_deliver.routing_key
+    return captured
 
 
 # --- CLASSES ----------------------------------------------------------------
 
+class StreamingAssembler(ContentFrameAssembler):
+    """Assembles deliveries as pika's own assembler does, except that a body
+    of at least the sink's threshold is written to a StreamFile frame by
+    frame instead of being collected and joined. The StreamFile is passed to
+    on_message as the body. Compressed bodies and batches are collected as
+    usual, to be unpacked. pika 0.11 has no hook for this, so the assembler
+    replaces the channel's own.
+
+    """
+
+    def __init__(self, sink):
+        """
+        :param StreamSink sink: Where large bodies are written
+
+        """
+        super(StreamingAssembler, self).__init__()
+        self._sink = sink
+        self._stream_file = None
+
+
+    def process(self, frame_value):
+        if (isinstance(frame_value, pika.frame.Header) and frame_value.body_size >= self._sink.threshold
+                and streaming.streamable(frame_value.properties.content_type,
+                    frame_value.properties.content_encoding in compression.CODECS)):
+            self._header_frame = frame_value
+            self._stream_file = self._sink.open(frame_value.body_size)
+            return None
+        return super(StreamingAssembler, self).process(frame_value)
+
+
+    def _handle_body_frame(self, body_frame):
+        if self._stream_file is None:
+            return super(StreamingAssembler, self)._handle_body_frame(body_frame)
+
+        self._stream_file.write(body_frame.fragment)
+        if self._stream_file.received < self._header_frame.body_size:
+            return None
+
+        properties = self._header_frame.properties
+        content = (self._method_frame, self._header_frame, self._sink.finished(self._stream_file,
+            (properties.headers or {}).get(streaming.STREAM_NAME_PROPERTY) or properties.message_id))
+        self._stream_file = None
+        self._reset()
+        return content
+
+
 class Consumer(object):
     """This consumer will handle unexpected interactions with RabbitMQ such
     as channel and connection closures.
@@ -131,12 +275,25 @@ class Consumer(object):
     _WAIT_INTERVAL = 20   # number of seconds to wait before retrying connection
 
 
-    def __init__(self, amqp_url, exchange, binding_key, queue_name, max_messages):
+    def __init__(self, amqp_url, exchange, binding_keys, queue_name, max_messages, capture_writer=None, verifier=None, tracer=None, prefetch=0,
+                 rejecter=None, dead_letter_stats=None, echo=False, connection_profile=None, stream_sink=None):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
-        :param str binding_key: The name of the binding key
+        :param list binding_keys: The key(s) to bind the queue with
+        :param CaptureWriter capture_writer: Where to capture messages, if anywhere
+        :param SequenceVerifier verifier: Checks sequence numbers, if verifying
+        :param Tracer tracer: Traces a sample of the messages, if tracing
+        :param int prefetch: Unacknowledged messages allowed (0 is unlimited)
+        :param Rejecter rejecter: Chooses messages to nack, if rejecting any
+        :param DeadLetterStats dead_letter_stats: Records dead letters, if
+            consuming from a dead-letter queue
+        :param bool echo: Whether to answer messages that have a reply_to
+        :param ConnectionProfile connection_profile: Heartbeat, frame and
+            socket settings (the default profile if not given)
+        :param StreamSink stream_sink: Writes large bodies out as they
+            arrive, if streaming them
 
         """
         self._connection = None
@@ -144,12 +301,28 @@ class Consumer(object):
         self._closing = False
         self._consumer_tag = None
         self._url = amqp_url
-        self._binding_key = binding_key
+        self._binding_keys = binding_keys
+        self._bindings = 0
         self._exchange = exchange
         self._queue = queue_name
         self._max_messages = max_messages
         self._count = 0
         self._first_message_time = datetime.datetime.now()
+        self._capture_writer = capture_writer
+        self._verifier = verifier
+        self._tracer = tracer
+        self._prefetch = prefetch
+        self._rejecter = rejecter
+        self._dead_letter_stats = dead_letter_stats
+        self._echo = echo
+        self._connection_profile = connection_profile or tuning.profile("default")
+        self._stream_sink = stream_sink
+        self._replies = 0
+        self._batches = 0
+        self._compression_stats = compression.CompressionStats()
+        self._latency_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
 
 
 
@@ -161,35 +334,27 @@ class Consumer(object):
         :rtype: pika.SelectConnection
 
         """
-        logging.debug('Connecting to %s', clean_url(self._url))
+        logging.debug('Connecting to %s', cli.clean_url(self._url))
 
         # pull the url apart
         parsed_url = urlparse(self._url)
 
         if parsed_url.scheme == "amqps":
-            for f in [CACERTFILE, CERTFILE, KEYFILE]:
-                if not os.path.isfile(f):
-                    raise Exception(f + " does not exist")
-
-            # set up SSL connection
-            ssl_options = ({"ca_certs": CACERTFILE,
-                    "certfile": CERTFILE,
-                    "keyfile": KEYFILE,
-                    "ssl_version": ssl.PROTOCOL_TLSv1_2,
-                    "cert_reqs": ssl.CERT_REQUIRED})
+            # set up SSL connection, reusing the process's context and last session
+            tls_session = tls.session(CACERTFILE, CERTFILE, KEYFILE)
+            connection_class = tls_session.connection_class(pika.SelectConnection)
 
             params = pika.ConnectionParameters(
                     host=parsed_url.hostname,
                     port=parsed_url.port,
                     credentials=ExternalCredentials(),
                     ssl=True,
-                    ssl_options=ssl_options,
                     connection_attempts=10,
-                    heartbeat_interval=3600,
-                    socket_timeout=5)
+                    **self._connection_profile.parameters())
 
         else:
             # set up non-SSL connection
+            connection_class = pika.SelectConnection
             credentials = pika.PlainCredentials(parsed_url.username, parsed_url.password)
 
             params = pika.ConnectionParameters(
@@ -197,12 +362,13 @@ class Consumer(object):
                     port=parsed_url.port,
                     credentials=credentials,
                     connection_attempts=100,
-                    heartbeat_interval=3600,
-                    socket_timeout=5)
+                    **self._connection_profile.parameters())
 
-        return pika.SelectConnection(params,
-                                    self.on_connection_open,
-                                    stop_ioloop_on_close=False)
+        # the profile's socket buffer sizes have to be set before the socket connects
+        connection_class = self._connection_profile.connection_class(connection_class)
+        return connection_class(params,
+                                self.on_connection_open,
+                                stop_ioloop_on_close=False)
 
 
     def on_connection_open(self, unused_connection):
@@ -214,6 +380,7 @@ class Consumer(object):
 
         """
         logging.debug('Connection opened')
+        self._connection_profile.apply(self._connection)
         self.add_on_connection_close_callback()
         self.open_channel()
 
@@ -277,7 +444,8 @@ class Consumer(object):
         """This method is invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
 
-        Since the channel is now open, we'll declare the exchange to use.
+        Since the channel is now open, we'll set the prefetch count (if
+        there is one) and declare the queue to use.
 
         :param pika.channel.Channel channel: The channel object
 
@@ -285,6 +453,22 @@ class Consumer(object):
         logging.debug('Channel opened')
         self._channel = channel
         self.add_on_channel_close_callback()
+        if self._stream_sink is not None:
+            channel._content_assembler = StreamingAssembler(self._stream_sink)
+        if self._prefetch:
+            logging.debug('Setting prefetch count to %s', self._prefetch)
+            self._channel.basic_qos(self.on_basic_qos_ok, prefetch_count=self._prefetch)
+        else:
+            self.setup_queue(self._queue)
+
+
+    def on_basic_qos_ok(self, unused_frame):
+        """Invoked by pika when the Basic.Qos method has completed, at which
+        point the queue can be declared.
+
+        :param pika.frame.Method unused_frame: The Basic.QosOk response frame
+
+        """
         self.setup_queue(self._queue)
 
 
@@ -339,22 +523,38 @@ class Consumer(object):
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
+        self._bindings = 0
+        self.bind_queue()
+
+
+    def bind_queue(self):
+        """Bind the queue with the next of the binding keys, issuing the
+        Queue.Bind RPC command. on_bindok will be invoked by pika when it
+        completes.
+
+        """
+        binding_key = self._binding_keys[self._bindings]
         logging.info('Binding %s to %s with %s',
-                    self._exchange, self._queue, self._binding_key)
+                    self._exchange, self._queue, binding_key)
         self._channel.queue_bind(self.on_bindok, self._queue,
-                                 self._exchange, self._binding_key)
+                                 self._exchange, binding_key)
 
 
     def on_bindok(self, unused_frame):
-        """Invoked by pika when the Queue.Bind method has completed. At this
-        point we will start consuming messages by calling start_consuming
-        which will invoke the needed RPC commands to start the process.
+        """Invoked by pika when the Queue.Bind method has completed. Once
+        every binding key is bound we will start consuming messages by
+        calling start_consuming which will invoke the needed RPC commands to
+        start the process.
 
         :param pika.frame.Method unused_frame: The Queue.BindOk response frame
 
         """
         logging.debug('Queue bound')
-        self.start_consuming()
+        self._bindings += 1
+        if self._bindings < len(self._binding_keys):
+            self.bind_queue()
+        else:
+            self.start_consuming()
 
 
     def start_consuming(self):
@@ -407,35 +607,151 @@ class Consumer(object):
         :param pika.channel.Channel unused_channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
-        :param str|unicode body: The message body
+        :param str|unicode|StreamFile body: The message body, or where it
+            was written if it was streamed
 
         """
         if self._count == 0:
             self._first_message_time = datetime.datetime.now()
 
-        logging.debug("Message received %s %s %s", properties, basic_deliver, body)
+        # a streamed body has already been written out, keeping only its first line to hand
+        streamed = isinstance(body, streaming.StreamFile)
+
+        # per-message detail goes to the sampled trace, keeping logging off the hot path
+        if self._tracer is not None and self._tracer.sampled(self._count + 1):
+            self._tracer.emit('receive',
+                count=self._count + 1,
+                delivery_tag=basic_deliver.delivery_tag,
+                redelivered=basic_deliver.redelivered,
+                routing_key=basic_deliver.routing_key,
+                message_id=properties.message_id,
+                content_type=properties.content_type,
+                size=len(body))
+
+        if self._capture_writer and not streamed:
+            self._capture_writer.append(
+                capture_properties(properties, basic_deliver),
+                body,
+                time.time())
+
+        # rejected messages are requeued or dead-lettered, and only count once accepted
+        if self._rejecter is not None and self._rejecter.reject(properties.message_id, basic_deliver.redelivered):
+            self._channel.basic_nack(
+                delivery_tag=basic_deliver.delivery_tag,
+                requeue=self._rejecter.requeue)
+            return
 
-        logging.debug('Acknowledging message %s', basic_deliver.delivery_tag)
         self._channel.basic_ack(basic_deliver.delivery_tag)
 
-        # the following code can be uncommented in place of the ack above
-        # in order to test dead letter processing
-        #self._channel.basic_nack(
-        #    delivery_tag=basic_deliver.delivery_tag,
-        #    requeue=False)
+        if self._echo and properties.reply_to and not streamed:
+            self.reply(properties, body)
 
-        self._count += 1
+        if self._dead_letter_stats is not None:
+            self._dead_letter_stats.record(properties.headers)
 
-        if self._count == self._max_messages:
+        # compressed bodies are only decompressed if something needs to look inside them
+        if properties.content_encoding in compression.CODECS:
+            self._compression_stats.record(len(body),
+                (properties.headers or {}).get(compression.ORIGINAL_LENGTH_PROPERTY))
+        else:
+            self._compression_stats.record(len(body))
+
+        # a body in an encoding that can't be read here counts as one message, unopened
+        decodable = compression.decodable(properties.content_encoding)
+        if not decodable and self._compression_stats.record_undecodable(properties.content_encoding):
+            logging.warning("Unsupported encoding %s (available: %s), bodies in it are counted but not unpacked or verified",
+                properties.content_encoding,
+                ", ".join(sorted(compression.CODECS)))
+
+        # batches count as each of the messages packed into them
+        if decodable and properties.content_type == batching.BATCH_CONTENT_TYPE:
+            entries = self.unpack_batch(compression.decompress(body, properties.content_encoding))
+        else:
+            entries = None
+            self._count += 1
+            sent = (properties.headers or {}).get(sequencing.SENT_TIME_PROPERTY)
+            if sent:
+                self.record_latency(sequencing.latency_since(sent))
+
+        if self._verifier and decodable:
+            producer = (properties.headers or {}).get(sequencing.PRODUCER_ID_PROPERTY)
+            if streamed:
+                self._verifier.add(producer, sequencing.extract_sequence(body.first_line()))
+            elif entries is None:
+                self._verifier.add(producer, sequencing.extract_sequence(
+                    compression.decompress(body, properties.content_encoding)))
+            else:
+                for (sent, payload) in entries:
+                    self._verifier.add(producer, sequencing.extract_sequence(payload))
+
+        if self._max_messages and self._count >= self._max_messages and not self._closing:
             message_processing_time = datetime.datetime.now() - self._first_message_time
             logging.info("%s messages received in %s (%s/s)",
                 self._count,
                 message_processing_time,
                 round(self._count/message_processing_time.total_seconds(), 2))
+            if self._batches:
+                logging.info("%s batches received", self._batches)
+            if self._latency_count:
+                logging.info("Latency mean %0.3fms max %0.3fms",
+                    1000 * self._latency_total / self._latency_count,
+                    1000 * self._latency_max)
+            if self._compression_stats.compressed or self._compression_stats.undecodable:
+                logging.info("Compression: %s", self._compression_stats.summary())
+            if self._replies:
+                logging.info("%s requests answered", self._replies)
 
             self.stop()
 
-            logging.debug("Disconnected from %s", clean_url(self._url))
+            logging.debug("Disconnected from %s", cli.clean_url(self._url))
+
+
+    def reply(self, properties, body):
+        """Send the body of a request straight back to its reply_to queue
+        through the default exchange, with the request's correlation id so
+        that the client can match it up.
+
+        :param pika.Spec.BasicProperties properties: The request's properties
+        :param bytes body: The request's body
+
+        """
+        self._channel.basic_publish('', properties.reply_to, body,
+            pika.BasicProperties(
+                correlation_id=properties.correlation_id,
+                content_type=properties.content_type,
+                content_encoding=properties.content_encoding,
+                headers=properties.headers))
+        self._replies += 1
+
+
+    def unpack_batch(self, body):
+        """Count each message packed into a batch, measuring its latency
+        from the time it was added to the batch by the producer.
+
+        :param bytes body: The batch envelope
+        :rtype: list
+
+        """
+        received = time.time()
+        entries = batching.unpack(body)
+
+        for (sent, payload) in entries:
+            self.record_latency(received - sent)
+
+        self._batches += 1
+        self._count += len(entries)
+
+        return entries
+
+
+    def record_latency(self, latency):
+        """Add a message's latency, in seconds, to the running totals.
+
+        """
+        self._latency_count += 1
+        self._latency_total += latency
+        if latency > self._latency_max:
+            self._latency_max = latency
 
 
     def stop_consuming(self):
@@ -507,33 +823,79 @@ class Consumer(object):
 
 def main():
     start_time = datetime.datetime.now()
-    (broker, exchange, binding_key, queue_name, max_messages, log_level) = process_options()
+    (broker, exchange, binding_keys, queue_name, max_messages, prefetch, capture_dir, capture_compression,
+        verifier, rejecter, dead_letter_stats, echo, stream_sink, tracer, profiler, monitor, connection_profile, log_level) = process_options()
 
-    logging.basicConfig(
-            level=log_level,
-            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
-        )
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Started")
+    cli.setup_logging(log_level)
+    if monitor:
+        monitor.start()
+
+    if capture_dir:
+        logging.debug("Capturing messages to %s", capture_dir)
+        capture_writer = capture.CaptureWriter(capture_dir, capture_compression)
+    else:
+        capture_writer = None
 
     conn = Consumer(
             broker,
             exchange,
-            binding_key,
+            binding_keys,
             queue_name,
-            max_messages
+            max_messages,
+            capture_writer,
+            verifier,
+            tracer,
+            prefetch,
+            rejecter,
+            dead_letter_stats,
+            echo,
+            connection_profile,
+            stream_sink
         )
 
+    if profiler:
+        profiler.instrument(conn, PROFILED_CALLBACKS)
+
     try:
-        conn.run()
+        if profiler:
+            profiler.run(conn.run)
+        else:
+            conn.run()
     except KeyboardInterrupt:
         logging.info("Keyboard interrupt received")
         conn.stop()
     except Exception as e:
         raise e
+    finally:
+        if capture_writer:
+            capture_writer.close()
+            logging.info("%s messages captured to %s", capture_writer.captured, capture_dir)
+        if stream_sink:
+            stream_sink.close()
+
+    if verifier:
+        logging.info("Sequence check: %s", verifier.summary())
+    if rejecter:
+        logging.info("Rejections: %s", rejecter.summary())
+    if dead_letter_stats:
+        logging.info("Dead letters: %s", dead_letter_stats.summary())
+    if stream_sink:
+        logging.info("Streaming: %s", stream_sink.summary())
+    if monitor:
+        monitor.stop()
+        for line in monitor.summary_lines():
+            logging.info("Broker %s", line)
 
     exec_time = datetime.datetime.now() - start_time
     logging.info("Execution time %s", exec_time)
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Finished")
+    logging.info("Connection profile %s", connection_profile.summary())
+    for tls_session in tls.sessions():
+        logging.info("TLS %s", tls_session.summary())
+    if profiler:
+        profiler.report(logging)
+    if tracer:
+        tracer.close()
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
 
 
 
@@ -541,7 +903,4 @@ def main():
 
 
 if __name__ == "__main__":
-    # initialise first message time (global variable used to calculate timings)
-    first_message_time = datetime.datetime.now()
-
     main()
@@ -0,0 +1,462 @@
+#!/usr/bin/python3
+'''
+    Python AMQP 0-9-1 RPC client.  Sends requests to a queue, with a reply_to
+    and correlation id, and times each one until its reply comes back.  The
+    server end is pika_receiver.py run with --echo.
+
+    A fixed number of requests are kept in flight at once, a new one being
+    sent as each reply (or timeout) comes in.  Given several concurrency
+    levels, it runs them in turn and reports the rate and round-trip
+    latency percentiles at each, and the highest rate sustained within the
+    latency limit.
+
+    Execute script with -h parameter for usage
+'''
+
+# --- CONSTANTS --------------------------------------------------------------
+
+PROFILED_CALLBACKS = [
+    "connect",
+    "on_connection_open",
+    "on_channel_open",
+    "on_exchange_declareok",
+    "on_queue_declareok",
+    "on_bindok",
+    "send_request",
+    "on_reply",
+    "on_tick",
+    "stop",
+    "on_connection_closed"]
+
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import time
+
+import pika
+
+from pika_producer import Publisher
+
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import cli, profiling, rpc, tls, tracing, tuning
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="AMQP 0-9-1 RPC client.  Will send requests to a queue and time the replies.")
+
+    opts.add_argument("--broker", "-b",
+        required=False,
+        default="amqp://localhost:5672",
+        help="broker connection string")
+    opts.add_argument("--exchange", "-e",
+        required=False,
+        help="exchange name (is set to the queue name if omitted)")
+    opts.add_argument("--queue", "-q",
+        required=True,
+        help="queue the server consumes requests from")
+    opts.add_argument("--max_messages", "-m",
+        type=int,
+        default=1000,
+        required=False,
+        help="number of requests to send at each concurrency level")
+    opts.add_argument("--concurrency", "-n",
+        type=int,
+        nargs="+",
+        default=[1],
+        required=False,
+        help="number(s) of requests to keep in flight at once, tried in turn")
+    opts.add_argument("--persistent", "-p",
+        required=False,
+        default=False,
+        action="store_true",
+        help="send persistent requests")
+    opts.add_argument("--reply_queue",
+        required=False,
+        default=False,
+        action="store_true",
+        help="receive replies on an exclusive queue rather than through direct reply-to")
+    opts.add_argument("--timeout",
+        type=float,
+        default=10,
+        required=False,
+        help="seconds to wait for a reply before giving up on a request")
+    opts.add_argument("--max_latency",
+        type=float,
+        required=False,
+        help="99th percentile round trip (ms) a rate must stay within to count as sustainable")
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    tuning.add_options(opts)
+    cli.add_verbose_option(opts)
+    options = opts.parse_args()
+
+    # Check that the connection string looks sensible
+    cli.check_broker(opts, options.broker, "pika")
+
+    if options.max_messages < 1 or min(options.concurrency) < 1:
+        opts.error("The number of requests and the concurrency must be at least 1")
+    if options.timeout <= 0:
+        opts.error("The timeout must be greater than 0")
+
+    # if no explicit exchange parameter was specified, set it to the same as the queue
+    if options.exchange:
+        exchange = options.exchange
+    else:
+        exchange = options.queue
+
+    log_level = cli.log_level(options)
+
+    return(
+        options.broker,
+        exchange,
+        options.queue,
+        options.max_messages,
+        options.concurrency,
+        options.persistent,
+        not options.reply_queue,
+        options.timeout,
+        options.max_latency,
+        tracing.from_options(options),
+        profiling.from_options(options),
+        tuning.from_options(options),
+        log_level)
+
+
+# --- CLASSES ----------------------------------------------------------------
+
+class RpcClient(Publisher):
+    """Publisher that sends requests and matches up their replies, rather
+    than publishing with delivery confirmations (the reply is confirmation
+    enough).
+
+    """
+
+    def __init__(
+        self,
+        amqp_url,
+        exchange,
+        queue_name,
+        max_messages,
+        concurrency,
+        persistent,
+        direct_reply_to=True,
+        timeout=10,
+        tracer=None,
+        connection_profile=None
+    ):
+        """Setup the RPC client.
+
+        :param str queue_name: The queue the server consumes requests from
+        :param int max_messages: How many requests to send at each concurrency
+        :param list concurrency: The numbers of requests to keep in flight, in turn
+        :param bool direct_reply_to: Whether to use direct reply-to rather
+            than an exclusive reply queue
+        :param float timeout: Seconds to wait for each reply
+        :param Tracer tracer: Traces a sample of the requests, if tracing
+        :param ConnectionProfile connection_profile: Heartbeat, frame and
+            socket settings (the default profile if not given)
+
+        """
+        super(RpcClient, self).__init__(
+            amqp_url,
+            exchange,
+            "direct",
+            queue_name,
+            max_messages,
+            persistent,
+            tracer=tracer,
+            connection_profile=connection_profile)
+        self._concurrency = concurrency
+        self._direct_reply_to = direct_reply_to
+        self._reply_to = None
+        self._wheel = rpc.TimeoutWheel(timeout, min(0.1, timeout))
+        self._pending = {}
+        self._requests = 0
+        self._step = -1
+        self._step_sent = 0
+        self._step_done = 0
+        # requests due while the connection was down, sent once it is back
+        self._deferred = 0
+        self._step_started = None
+        self._latencies = []
+        self._timeouts = 0
+        self._late_replies = 0
+        self.results = []
+
+        if persistent:
+            self._delivery_mode = 2 # make message persistent
+        else:
+            self._delivery_mode = None
+
+
+    def start_publishing(self):
+        """Once the request queue is set up, set up somewhere for the replies
+        to come back to, either direct reply-to (which must be consumed from
+        before the first request is sent) or an exclusive queue of our own.
+
+        """
+        if self._direct_reply_to:
+            self.start_consuming_replies(rpc.DIRECT_REPLY_TO)
+        else:
+            logging.debug('Declaring exclusive reply queue')
+            self._channel.queue_declare(self.on_reply_queue_declareok, '', exclusive=True, auto_delete=True)
+
+
+    def on_reply_queue_declareok(self, method_frame):
+        """Invoked by pika once the broker has named our reply queue.
+
+        :param pika.frame.Method method_frame: The Queue.DeclareOk frame
+
+        """
+        self.start_consuming_replies(method_frame.method.queue)
+
+
+    def start_consuming_replies(self, queue_name):
+        """Consume the replies (without acknowledgements), start the timeout
+        wheel turning and begin the first concurrency level.
+
+        :param str queue_name: The queue the replies arrive on
+
+        """
+        logging.debug('Consuming replies from %s', queue_name)
+        self._reply_to = queue_name
+        self._channel.basic_consume(self.on_reply, queue_name, no_ack=True)
+        self._connection.add_timeout(self._wheel.resolution, self.on_tick)
+
+        # after a reconnection, the requests lost with the old channel time out and are
+        # replaced, including those that timed out while it was down
+        if self._step < 0:
+            self.next_step()
+        else:
+            (deferred, self._deferred) = (self._deferred, 0)
+            for n in range(deferred):
+                self.send_request()
+
+
+    def next_step(self):
+        """Record the results of the concurrency level just finished (if
+        any), then fill the pipeline for the next, or stop if there are no
+        more.
+
+        """
+        if self._step >= 0:
+            self.record_step()
+
+        self._step += 1
+        if self._step >= len(self._concurrency):
+            if self._late_replies:
+                logging.info("%s replies arrived after their requests had timed out", self._late_replies)
+            self.stop()
+            return
+
+        self._step_sent = 0
+        self._step_done = 0
+        self._latencies = []
+        self._timeouts = 0
+        self._step_started = time.perf_counter()
+        logging.info("Sending %s requests, %s at a time", self._max_messages, self._concurrency[self._step])
+        for n in range(min(self._concurrency[self._step], self._max_messages)):
+            self.send_request()
+
+
+    def record_step(self):
+        elapsed = time.perf_counter() - self._step_started
+        replies = len(self._latencies)
+        result = {
+            "concurrency": self._concurrency[self._step],
+            "replies": replies,
+            "timeouts": self._timeouts,
+            "seconds": elapsed,
+            "rate": replies / elapsed if elapsed else 0,
+            "percentiles": rpc.percentiles(self._latencies),
+            "max": max(self._latencies) if self._latencies else 0}
+        self.results.append(result)
+
+        logging.info("%s in flight: %s replies in %0.3fs (%0.1f/s), %s timed out",
+            result["concurrency"], replies, elapsed, result["rate"], self._timeouts)
+        if self._latencies:
+            logging.info("  round trip %s, max %0.3fms",
+                ", ".join("p%s %0.3fms" % (point, 1000 * value) for (point, value) in result["percentiles"]),
+                1000 * result["max"])
+
+
+    def send_request(self):
+        """Publish a request, remembering when it was sent and putting it on
+        the timeout wheel.  While the connection is down, the request is
+        deferred until it is back, so that the level still sends them all.
+
+        """
+        if self._stopping:
+            return
+        if not self._connection.is_open:
+            self._deferred += 1
+            return
+
+        self._requests += 1
+        self._step_sent += 1
+        correlation_id = str(self._requests)
+        body = json.dumps({'sequence': self._requests}, ensure_ascii=False).encode('utf-8')
+
+        properties = pika.BasicProperties(
+            app_id=os.path.basename(__file__),
+            content_type='application/json',
+            correlation_id=correlation_id,
+            delivery_mode=self._delivery_mode,
+            reply_to=self._reply_to)
+
+        self._channel.basic_publish(self._exchange, self._routing_key, body, properties)
+        self._pending[correlation_id] = (time.perf_counter(), self._wheel.add(correlation_id))
+
+        if self._tracer is not None and self._tracer.sampled(self._requests):
+            self._tracer.emit('request',
+                correlation_id=correlation_id,
+                in_flight=len(self._pending),
+                size=len(body))
+
+
+    def on_reply(self, unused_channel, basic_deliver, properties, body):
+        """Invoked by pika when a reply arrives. Replies to requests that
+        have already timed out are counted but otherwise ignored.
+
+        :param pika.channel.Channel unused_channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The reply body
+
+        """
+        pending = self._pending.pop(properties.correlation_id, None)
+        if pending is None:
+            self._late_replies += 1
+            return
+
+        (sent, slot) = pending
+        self._wheel.remove(properties.correlation_id, slot)
+        latency = time.perf_counter() - sent
+        self._latencies.append(latency)
+
+        if self._tracer is not None and self._tracer.sampled(int(properties.correlation_id)):
+            self._tracer.emit('reply',
+                correlation_id=properties.correlation_id,
+                latency=latency,
+                in_flight=len(self._pending))
+
+        self.request_done()
+
+
+    def on_tick(self):
+        """Invoked by the IOLoop timer at each turn of the timeout wheel;
+        requests in the slot it turns to have waited too long.
+
+        """
+        if self._stopping:
+            return
+
+        for correlation_id in self._wheel.tick():
+            if self._pending.pop(correlation_id, None) is not None:
+                self._timeouts += 1
+                logging.debug("Request %s timed out", correlation_id)
+                self.request_done()
+
+        self._connection.add_timeout(self._wheel.resolution, self.on_tick)
+
+
+    def request_done(self):
+        # keeps the pipeline full until the level's requests have all been sent, and moves on once all are back
+        self._step_done += 1
+        if self._step_sent < self._max_messages:
+            self.send_request()
+        elif self._step_done >= self._max_messages:
+            self.next_step()
+
+
+    def sustainable_rate(self, max_latency=None):
+        """Return the result with the highest rate that had no timeouts and,
+        if a limit is given, a 99th percentile round trip within it.
+
+        :param float max_latency: Milliseconds allowed at the 99th percentile
+
+        """
+        sustainable = [result for result in self.results
+            if not result["timeouts"] and result["replies"] and
+                (max_latency is None or 1000 * dict(result["percentiles"])[99] <= max_latency)]
+        if not sustainable:
+            return None
+        return max(sustainable, key=lambda result: result["rate"])
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    start_time = datetime.datetime.now()
+    (broker, exchange, queue_name, max_messages, concurrency, persistent, direct_reply_to, timeout, max_latency,
+        tracer, profiler, connection_profile, log_level) = process_options()
+
+    cli.setup_logging(log_level)
+
+    conn = RpcClient(
+        broker,
+        exchange,
+        queue_name,
+        max_messages,
+        concurrency,
+        persistent,
+        direct_reply_to,
+        timeout,
+        tracer,
+        connection_profile
+    )
+
+    if profiler:
+        profiler.instrument(conn, PROFILED_CALLBACKS)
+
+    try:
+        if profiler:
+            profiler.run(conn.run)
+        else:
+            conn.run()
+    except KeyboardInterrupt:
+        logging.info("Keyboard interrupt received")
+        conn.stop()
+    except Exception as e:
+        raise e
+
+    best = conn.sustainable_rate(max_latency)
+    if best:
+        logging.info("Highest sustainable rate %0.1f requests/s, with %s in flight (p99 %0.3fms)",
+            best["rate"], best["concurrency"], 1000 * dict(best["percentiles"])[99])
+    elif conn.results:
+        logging.warning("No concurrency level was sustainable (requests timed out or exceeded %sms at p99)", max_latency)
+
+    exec_time = datetime.datetime.now() - start_time
+    logging.info("Execution time %s", exec_time)
+    logging.info("Connection profile %s", connection_profile.summary())
+    for tls_session in tls.sessions():
+        logging.info("TLS %s", tls_session.summary())
+    if profiler:
+        profiler.report(logging)
+    if tracer:
+        tracer.close()
+    logging.debug("Disconnected from %s", cli.clean_url(broker))
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
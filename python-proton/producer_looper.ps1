@@ -1,12 +1,17 @@
 # Runs a given number of the Python message producer Docker containers
-# as background processes
-param([int]$count, [int]$max_messages)
+# as background processes.  If a results directory is given, each producer
+# writes a result log there, to be combined with python-common/merge-results.py
+param([int]$count, [int]$max_messages, [string]$results_dir)
 
 For ($i=1; $i -le $count; $i++)
 {
     Start-Job -Name producer_$i -ScriptBlock {
-        param([int]$j, [int]$messages)
-        docker run --rm --name producer_$j --network container:activemq_1 proton-producer -b user:password@localhost:5672 -t some_topic -m $messages -s producer_$j
+        param([int]$j, [int]$messages, [string]$results)
+        if ($results) {
+            docker run --rm --name producer_$j -v ${results}:/results --network container:activemq_1 proton-producer -b user:password@localhost:5672 -t some_topic -m $messages -s producer_$j --results /results/producer_$j.log
+        } else {
+            docker run --rm --name producer_$j --network container:activemq_1 proton-producer -b user:password@localhost:5672 -t some_topic -m $messages -s producer_$j
+        }
 #        docker run --rm --name producer_$j --network container:activemq_1 proton-producer -b user:password@localhost:5672 -q some_queue -m $messages -s producer_$j
-    } -Arg $i,$max_messages
+    } -Arg $i,$max_messages,$results_dir
 }
@@ -4,11 +4,27 @@ Created on 24th Apr 2017
 
 @author: Jeremy Gooch
 
-    Slightly hacky script to put the contents of a file onto a queue/topic.
+    Slightly hacky script to put the contents of a file onto a queue/topic,
+    a line per message or, with --stream, the whole file as one message
+    spread over as many transfers as it takes.  Capture logs written by the receivers, and JSONL files, are replayed
+    with their original properties and, optionally, their original timing.
 
     Execute script with -h parameter for usage
 '''
 
+# --- CONSTANTS --------------------------------------------------------------
+
+# lifecycle callbacks timed by --phases
+PROFILED_CALLBACKS = [
+    "on_start",
+    "on_link_opened",
+    "on_sendable",
+    "on_accepted",
+    "on_timer_task",
+    "pump",
+    "on_disconnected"]
+
+
 # --- LIBRARIES --------------------------------------------------------------
 
 import sys
@@ -19,15 +35,17 @@ import argparse
 import time
 import datetime
 import os.path
-import re
 import uuid
 import logging
-import sys
 
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import capture, cli, compression, profiling, replay, streaming, tracing
+
 # --- FUNCTIONS --------------------------------------------------------------
 
 def process_options():
@@ -39,7 +57,7 @@ def process_options():
 
     opts.add_argument("--file", "-f",
         required=True,
-        help="file to be sent")
+        help="file (or capture directory, or JSONL file) to be sent")
     opts.add_argument("--broker", "-b",
         required=False,
         default="localhost:5672",
@@ -62,17 +80,29 @@ def process_options():
         action='append',
         required=False,
         help="header(s) to be added to the message - to be formatted as 'name=value'")
-    opts.add_argument("--verbose", "-v",
+    opts.add_argument("--stream",
         required=False,
         default=False,
         action="store_true",
-        help="send log messages to sysout")
+        help="send the whole file as one message, streamed from disk over as many transfers as it takes")
+    opts.add_argument("--compression", "-z",
+        choices=["none"] + sorted(compression.CODECS),
+        default="none",
+        required=False,
+        help="codec used to compress message bodies")
+    opts.add_argument("--compression_threshold",
+        type=int,
+        default=256,
+        required=False,
+        help="smallest body (in bytes) that will be compressed")
+    replay.add_options(opts)
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    cli.add_verbose_option(opts)
     options = opts.parse_args()
 
     # Check that the connection string looks sensible
-    checkConnection = re.match('(.*):\d{1,5}', options.broker, )
-    if not(checkConnection):
-        opts.error("The broker connection string looks a bit dodgy.  It should be something like 'localhost:5672'")
+    cli.check_broker(opts, options.broker, "proton")
 
     # check that one and only one of topic or queue was specified
     if options.topic and options.queue:
@@ -80,16 +110,21 @@ def process_options():
     if not(options.topic) and not(options.queue):
         opts.error("You must specify either a queue or a topic")
 
+    if options.stream and (options.compression != "none" or options.speed):
+        opts.error("A streamed file cannot be compressed or paced")
+
     # add the correct internal protocol
     if options.topic:
         resource = "topic://" + options.topic
     else:
         resource = "queue://" + options.queue
 
-    if options.verbose:
-        log_level = logging.DEBUG
+    if options.compression != "none":
+        compressor = compression.Compressor(options.compression, options.compression_threshold)
     else:
-        log_level = logging.INFO
+        compressor = None
+
+    log_level = cli.log_level(options)
 
     return(
         options.file,
@@ -98,30 +133,27 @@ def process_options():
         options.persistent,
         options.user_id,
         options.header,
+        options.stream,
+        compressor,
+        replay.from_options(opts, options),
+        tracing.from_options(options),
+        profiling.from_options(options),
         log_level)
 
 
-def clean_url(dirty_url):
-    # removes ID and password from URL, if present
-    if "@" in dirty_url:
-        return dirty_url.split('@', 1)[1]
-    else:
-        return dirty_url
-
-
 def parse_headers(headers):
     # takes the array of header parameters and returns a dict
     header_dict = {}
 
-    for header in headers:
-        logging.debug("Header " + header)
+    for header in headers or []:
+        logging.debug("Header %s", header)
 
         # headers should have been specified as "name=value"
         if "=" in header:
             split_header = header.split('=', 1)
             header_dict[split_header[0]] = split_header[1]
         else:
-            logging.warning("Header not structured 'name=value', ignoring parameter - " + header)
+            logging.warning("Header not structured 'name=value', ignoring parameter - %s", header)
 
     return header_dict
 
@@ -129,88 +161,232 @@ def parse_headers(headers):
 # --- CLASSES ----------------------------------------------------------------
 
 class Send(MessagingHandler):
-    def __init__(self, filename, url, resource, persistent, user_id, headers):
+    def __init__(self, filename, url, resource, persistent, user_id, headers, compressor=None, pacer=None, tracer=None, streamed=False):
         super(Send, self).__init__()
         self.filename = filename
         self.url = url
         self.resource = resource
         self.persistent = persistent
         self.user_id = user_id
+        # encode the user_id if present
+        self.encoded_user_id = user_id.encode('utf-8') if user_id else None
         self.headers = headers
+        self.compressor = compressor
+        self.pacer = pacer
+        self.tracer = tracer
+        self.streamed = streamed
+        self.outgoing = None
+        self.sender = None
+        self.records = None
+        self.next_record = None
+        self.waiting = False
+        self.sent = 0
+        self.accepted = 0
 
 
     def on_start(self, event):
         messaging_connection = event.container.connect(self.url)
-        event.container.create_sender(messaging_connection, self.resource)
+        self.sender = event.container.create_sender(messaging_connection, self.resource)
 
 
-    def on_sendable(self, event):
-        global send_count
+    def on_link_opened(self, event):
+        # on_sendable fires on every credit top-up, so the link is logged here instead
+        logging.debug("Connected to %s %s", cli.clean_url(self.url), self.resource)
 
-        logging.debug(str(send_count) + " messages sent")
-        logging.debug("Connected to " + clean_url(self.url) + " " + self.resource)
-
-        # encode the user_id if present
-        if self.user_id:
-            encoded_user_id = self.user_id.encode('utf-8')
-        else:
-            encoded_user_id = None
 
+    def on_sendable(self, event):
         try:
-            with open(self.filename, encoding='utf-8') as a_file:
-                logging.debug("Opened file " + self.filename)
-
-                for a_line in a_file:
-                    msg = Message(
-                        id=(str(uuid.uuid4())),
-                        user_id=encoded_user_id,
-                        durable=self.persistent,
-                        properties=self.headers,
-                        creation_time=time.time(),
-                        body=a_line
-                    )
-                    event.sender.send(msg)
-
-            event.connection.close()
+            if self.streamed:
+                if self.outgoing is None:
+                    self.start_stream(event.sender)
+                self.pump(event.container)
+            elif self.records is not None:
+                # more credit for a replay that's already under way
+                self.replay(event.container)
+            elif replay.is_timed(self.filename):
+                logging.debug("Replaying %s", self.filename)
+                self.records = replay.read_timed(self.filename)
+                self.replay(event.container)
+            else:
+                with open(self.filename, encoding='utf-8') as a_file:
+                    logging.debug("Opened file %s", self.filename)
+
+                    for a_line in a_file:
+                        body = a_line
+                        properties = self.headers
+                        if self.compressor:
+                            (body, properties) = compression.compress_value(self.compressor, body, properties)
+
+                        msg = Message(
+                            id=(str(uuid.uuid4())),
+                            user_id=self.encoded_user_id,
+                            durable=self.persistent,
+                            properties=properties,
+                            creation_time=time.time(),
+                            body=body
+                        )
+                        self.send(event.sender, msg)
+
+                event.connection.close()
 
         except IOError:
-            logging.error("File not found " + self.filename)
+            logging.error("File not found %s", self.filename)
             sys.exit()
 
 
+    def replay(self, container):
+        # sends captured (or JSONL) messages with their original properties, for as long as
+        # there's credit, waiting on a timer whenever the pacer says the next one isn't due yet
+        while self.sender.credit and not self.waiting:
+            if self.next_record is None:
+                self.next_record = next(self.records, None)
+                if self.next_record is None:
+                    logging.debug("End of %s reached after %i messages", self.filename, self.sent)
+                    self.sender.connection.close()
+                    return
+
+            (timestamp, captured, body) = self.next_record
+            if self.pacer is not None:
+                due = self.pacer.due(timestamp)
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.waiting = True
+                    container.schedule(wait, self)
+                    return
+            self.next_record = None
+
+            self.send(self.sender, self.captured_message(captured, body))
+            if self.pacer is not None:
+                self.pacer.sent(timestamp, due)
+
+
+    def start_stream(self, sender):
+        # begins the delivery that the whole file is written into by pump
+        stream = streaming.file_stream(self.filename)
+        properties = dict(self.headers)
+        properties[streaming.STREAM_NAME_PROPERTY] = stream.name
+
+        msg = Message(
+            id=(str(uuid.uuid4())),
+            user_id=self.encoded_user_id,
+            durable=self.persistent,
+            content_type=streaming.STREAM_CONTENT_TYPE,
+            properties=properties,
+            creation_time=time.time()
+        )
+        logging.debug("Streaming %s bytes of %s", stream.length, self.filename)
+        self.outgoing = streaming.OutgoingStream(sender, msg.encode(), stream)
+        self.sent += 1
+
+        if self.tracer is not None and self.tracer.sampled(self.sent):
+            self.tracer.emit('publish',
+                record=self.sent,
+                address=self.resource,
+                message_id=msg.id,
+                size=stream.length)
+
+
+    def pump(self, container):
+        # writes as much of the file as the session has room for, checking back on a timer until it's all gone
+        if self.waiting or self.outgoing.done:
+            return
+        if self.outgoing.pump():
+            self.sender.connection.close()
+        else:
+            self.waiting = True
+            container.schedule(streaming.POLL_INTERVAL, self)
+
+
+    def on_timer_task(self, event):
+        # the next record has fallen due, or there's room to write more of the file
+        self.waiting = False
+        if self.streamed:
+            self.pump(event.container)
+        else:
+            self.replay(event.container)
+
+
+    def captured_message(self, captured, body):
+        # rebuilds a message from the properties stored with it
+        properties = dict(captured.get("properties") or captured.get("headers") or {})
+        properties.update(self.headers)
+
+        if captured.get("user_id"):
+            user_id = captured["user_id"].encode('utf-8')
+        else:
+            user_id = self.encoded_user_id
+
+        return Message(
+            id=captured.get("id") or captured.get("message_id") or str(uuid.uuid4()),
+            user_id=user_id,
+            durable=captured.get("durable", self.persistent),
+            subject=captured.get("subject"),
+            reply_to=captured.get("reply_to"),
+            correlation_id=captured.get("correlation_id"),
+            content_type=captured.get("content_type"),
+            content_encoding=captured.get("content_encoding"),
+            properties=properties,
+            creation_time=captured.get("creation_time") or time.time(),
+            body=capture.decode_body(body, captured)
+        )
+
+
+    def send(self, sender, msg):
+        sender.send(msg)
+        self.sent += 1
+
+        # per-message detail goes to the sampled trace, keeping logging off the hot path
+        if self.tracer is not None and self.tracer.sampled(self.sent):
+            self.tracer.emit('publish',
+                record=self.sent,
+                address=self.resource,
+                message_id=msg.id)
+
+
     def on_accepted(self, event):
-        global send_count
-        send_count += 1
+        self.accepted += 1
 
 
     def on_disconnected(self, event):
-        logging.debug("Disconnected from " + clean_url(self.url))
+        logging.debug("Disconnected from %s", cli.clean_url(self.url))
 
 
 # --- START OF MAIN ----------------------------------------------------------
 
 def main():
     start_time = datetime.datetime.now()
-    (filename, broker, resource, persistent, user_id, headers, log_level) = process_options()
+    (filename, broker, resource, persistent, user_id, headers, streamed, compressor, pacer, tracer, profiler, log_level) = process_options()
 
-    logging.basicConfig(
-            level=log_level,
-            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
-        )
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Started")
+    cli.setup_logging(log_level)
+
+    sender = Send(filename, broker, resource, persistent, user_id, parse_headers(headers), compressor, pacer, tracer, streamed)
+    if profiler:
+        profiler.instrument(sender, PROFILED_CALLBACKS)
 
     try:
-        Container(
-                Send(filename, broker, resource, persistent, user_id, parse_headers(headers))
-                ).run()
+        if profiler:
+            profiler.run(Container(sender).run)
+        else:
+            Container(sender).run()
     except KeyboardInterrupt:
         logging.info("Keyboard interrupt received")
     except Exception as e:
         raise e
+    finally:
+        if tracer:
+            tracer.close()
 
     exec_time = datetime.datetime.now() - start_time
-    logging.info(str(send_count) + " messages sent in " + str(exec_time))
-    logging.debug(datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p") + " Finished")
+    logging.info("%s messages sent in %s", sender.accepted, exec_time)
+    if compressor:
+        logging.info("%s compression: %s", compressor.codec, compressor.summary())
+    if pacer:
+        logging.info("Replay: %s", pacer.summary())
+    if streamed and sender.outgoing:
+        logging.info("Streaming: %s", streaming.sent_summary(sender.sent, sender.outgoing.stream.length))
+    if profiler:
+        profiler.report(logging)
+    logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
 
 
 
@@ -218,5 +394,4 @@ def main():
 
 
 if __name__ == "__main__":
-    send_count = 0
     main()
@@ -9,6 +9,22 @@ Created on 11th Jan 2017
     Execute script with -h parameter for usage
 '''
 
+# --- CONSTANTS --------------------------------------------------------------
+
+# lifecycle callbacks timed by --phases
+PROFILED_CALLBACKS = [
+    "on_start",
+    "on_link_opened",
+    "on_sendable",
+    "send_batch",
+    "pump_streams",
+    "on_accepted",
+    "on_rejected",
+    "on_released",
+    "on_modified",
+    "on_disconnected"]
+
+
 # --- LIBRARIES --------------------------------------------------------------
 
 import sys
@@ -18,14 +34,19 @@ if sys.version_info[0] < 3:
 import argparse
 import time
 import datetime
-import re
 import uuid
 import logging
+import json
+import os
 
-from proton import Message
+from proton import Delivery, Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import batching, cli, compression, monitoring, profiling, results, sequencing, streaming, tracing
+
 # --- FUNCTIONS --------------------------------------------------------------
 
 def process_options():
@@ -40,16 +61,28 @@ def process_options():
         default="localhost:5672",
         help="broker connection string")
     opts.add_argument("--topic", "-t",
+        nargs="+",
         required=False,
-        help="topic name")
+        help="topic name(s)")
     opts.add_argument("--queue", "-q",
+        nargs="+",
+        required=False,
+        help="queue name(s)")
+    opts.add_argument("--links", "-l",
+        type=int,
+        default=1,
         required=False,
-        help="queue name")
+        help="number of sender links to open per address")
+    opts.add_argument("--connections", "-c",
+        type=int,
+        default=1,
+        required=False,
+        help="number of connections to spread the links across")
     opts.add_argument("--max_messages", "-m",
         type=int,
         default=100,
         required=False,
-        help="number of messages to send")
+        help="number of messages to send (shared across all links)")
     opts.add_argument("--persistent", "-p",
         required=False,
         default=False,
@@ -61,76 +94,161 @@ def process_options():
     opts.add_argument("--user_id", "-u",
         required=False,
         help="client user id")
-    opts.add_argument("--verbose", "-v",
+    opts.add_argument("--batch",
+        type=int,
+        default=0,
         required=False,
-        default=False,
-        action="store_true",
-        help="send log messages to sysout")
+        help="pack up to this many messages into each AMQP message (0 disables batching)")
+    opts.add_argument("--batch_bytes",
+        type=int,
+        default=128 * 1024,
+        required=False,
+        help="maximum size of a batch in bytes")
+    opts.add_argument("--compression", "-z",
+        choices=["none"] + sorted(compression.CODECS),
+        default="none",
+        required=False,
+        help="codec used to compress message bodies")
+    opts.add_argument("--compression_threshold",
+        type=int,
+        default=256,
+        required=False,
+        help="smallest body (in bytes) that will be compressed")
+    opts.add_argument("--payload_size",
+        type=int,
+        default=0,
+        required=False,
+        help="follow each sequence number with this many bytes of payload, streamed over as many transfers as it takes rather than built in memory")
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    results.add_options(opts)
+    monitoring.add_options(opts)
+    cli.add_verbose_option(opts)
     options = opts.parse_args()
 
     # Check that the connection string looks sensible
-    checkConnection = re.match('(.*):\d{1,5}', options.broker, )
-    if not(checkConnection):
-        opts.error("The broker connection string looks a bit dodgy.  It should be something like 'localhost:5672'")
+    cli.check_broker(opts, options.broker, "proton")
 
-    # check that one and only one of topic or queue was specified
-    if options.topic and options.queue:
-        opts.error("You may only specify either a queue or a topic")
+    # check that at least one topic or queue was specified
     if not(options.topic) and not(options.queue):
-        opts.error("You must specify either a queue or a topic")
+        opts.error("You must specify at least one queue or topic")
+
+    if options.links < 1 or options.connections < 1:
+        opts.error("The number of links and connections must both be at least 1")
+    if options.payload_size < 0:
+        opts.error("The payload size cannot be negative")
+    if options.payload_size and (options.batch > 1 or options.compression != "none"):
+        opts.error("A streamed payload cannot be batched or compressed")
 
     # add the correct internal protocol
-    if options.topic:
-        resource = "topic://" + options.topic
+    resources = []
+    for topic in options.topic or []:
+        resources.append("topic://" + topic)
+    for queue in options.queue or []:
+        resources.append("queue://" + queue)
+
+    # batches are filled as soon as there is credit, so they never need to linger
+    if options.batch > 1:
+        batcher = batching.Batcher(options.batch, options.batch_bytes, 0)
     else:
-        resource = "queue://" + options.queue
+        batcher = None
 
-    if options.verbose:
-        log_level = logging.DEBUG
+    if options.compression != "none":
+        compressor = compression.Compressor(options.compression, options.compression_threshold)
     else:
-        log_level = logging.INFO
+        compressor = None
+
+    log_level = cli.log_level(options)
 
     return(
         options.broker,
-        resource,
+        resources,
+        options.links,
+        options.connections,
         options.max_messages,
         options.persistent,
         options.subject,
         options.user_id,
+        batcher,
+        compressor,
+        options.payload_size,
+        tracing.from_options(options),
+        profiling.from_options(options),
+        results.from_options(opts, options, "proton_producer"),
+        monitoring.from_options(opts, options, "activemq", resources),
         log_level)
 
 
-def clean_url(dirty_url):
-    # removes ID and password from URL, if present
-    if "@" in dirty_url:
-        return dirty_url.split('@', 1)[1]
-    else:
-        return dirty_url
-
-
 # --- CLASSES ----------------------------------------------------------------
 
 class Send(MessagingHandler):
-    def __init__(self, url, resource, messages, persistent, subject, user_id):
+    def __init__(self, url, resources, links, connections, messages, persistent, subject, user_id, batcher=None, compressor=None, tracer=None,
+            result_log=None, payload_size=0):
         super(Send, self).__init__()
         self.url = url
-        self.resource = resource
+        self.resources = resources
+        self.links = links
+        self.connections = connections
         self.persistent = persistent
         self.subject = subject
         self.user_id = user_id
+        self.batcher = batcher
+        self.compressor = compressor
+        self.tracer = tracer
+        self.result_log = result_log
+        self.payload_size = payload_size
+        self.producer_id = sequencing.producer_id()
+        self.batch_sizes = {}
+        self.batches = 0
+        # send time by delivery, when logging results
+        self.send_times = {}
         self.sent = 0
         self.confirmed = 0
+        self.rejected = 0
+        self.undeliverable = 0
         self.total = messages
+        # the delivery being streamed on each link, and whether a timer will pump them again
+        self.streams = {}
+        self.stream_timer = False
+        self.streamed = 0
+        self.streamed_bytes = 0
+
+        # shared accounting across every link driven by the container
+        self.messaging_connections = []
+        self.in_flight = {}
+        self.confirmed_by_address = dict((resource, 0) for resource in resources)
 
 
     def on_start(self, event):
-        messaging_connection = event.container.connect(self.url)
-        event.container.create_sender(messaging_connection, self.resource)
+        for i in range(self.connections):
+            messaging_connection = event.container.connect(self.url)
+            self.messaging_connections.append(messaging_connection)
+            self.in_flight[messaging_connection] = 0
+
+        # spread the links round-robin over the connections
+        link_number = 0
+        for resource in self.resources:
+            for i in range(self.links):
+                messaging_connection = self.messaging_connections[link_number % self.connections]
+                event.container.create_sender(messaging_connection, resource)
+                link_number += 1
+
+        logging.debug("Opened %s links over %s connections to %s",
+            link_number, self.connections, cli.clean_url(self.url))
+
+
+    def on_link_opened(self, event):
+        # on_sendable fires on every credit top-up, so links are logged here instead
+        logging.debug("Connected to %s %s", cli.clean_url(self.url), event.link.target.address)
 
 
     def on_sendable(self, event):
-        logging.debug("%s messages sent", self.confirmed)
-        logging.debug("Connected to %s %s", clean_url(self.url), self.resource)
+        # large messages go one at a time on each link, the next as soon as the last is written
+        if self.payload_size:
+            if event.sender not in self.streams:
+                self.start_stream(event.sender)
+            self.pump_streams(event.container)
+            return
 
         # encode the user_id if present
         if self.user_id:
@@ -139,52 +257,262 @@ class Send(MessagingHandler):
             encoded_user_id = None
 
         while event.sender.credit and self.sent < self.total:
+            if self.batcher:
+                self.send_batch(event, encoded_user_id)
+                continue
+
+            body = {'sequence':(self.sent+1)}
+            properties = None
+            if self.compressor:
+                (body, properties) = compression.compress_value(self.compressor, body, properties)
+
             msg = Message(
                 id=(str(uuid.uuid4())),
                 user_id=encoded_user_id,
                 durable=self.persistent,
                 subject=self.subject,
+                group_id=self.producer_id,
+                properties=properties,
                 creation_time=time.time(),
-                body={'sequence':(self.sent+1)}
+                body=body
                 )
-            event.sender.send(msg)
+            delivery = event.sender.send(msg)
             self.sent += 1
+            self.in_flight[event.connection] += 1
+            if self.result_log is not None:
+                self.record_send(delivery, 1)
+            if self.tracer is not None and self.tracer.sampled(self.sent):
+                self.tracer.emit('publish',
+                    sequence=self.sent,
+                    address=event.sender.target.address,
+                    message_id=msg.id)
+
+
+    def send_batch(self, event, encoded_user_id):
+        # packs messages into a single envelope until the batch is full or none are left
+        while self.sent + len(self.batcher) < self.total:
+            message = {'sequence':(self.sent+len(self.batcher)+1)}
+            if self.batcher.add(json.dumps(message, ensure_ascii=False).encode('utf-8')):
+                break
+
+        (envelope, count) = self.batcher.pack()
+        properties = {'batch_count': count}
+        if self.compressor:
+            (envelope, properties) = compression.compress_value(self.compressor, envelope, properties)
+
+        msg = Message(
+            id=(str(uuid.uuid4())),
+            user_id=encoded_user_id,
+            durable=self.persistent,
+            subject=self.subject,
+            group_id=self.producer_id,
+            content_type=batching.BATCH_CONTENT_TYPE,
+            properties=properties,
+            creation_time=time.time(),
+            body=envelope
+            )
+        delivery = event.sender.send(msg)
+        self.batch_sizes[delivery] = count
+        self.batches += 1
+        self.sent += count
+        self.in_flight[event.connection] += count
+        if self.result_log is not None:
+            self.record_send(delivery, count)
+        if self.tracer is not None and self.tracer.sampled(self.batches):
+            self.tracer.emit('publish_batch',
+                batch=self.batches,
+                sequence=self.sent,
+                messages=count,
+                address=event.sender.target.address,
+                message_id=msg.id,
+                size=len(envelope))
+
+
+    def start_stream(self, sender):
+        # begins a delivery whose payload is written in pieces by pump_streams, if there's credit for one
+        if not sender.credit or self.sent >= self.total:
+            return
+
+        msg = Message(
+            id=(str(uuid.uuid4())),
+            user_id=self.user_id.encode('utf-8') if self.user_id else None,
+            durable=self.persistent,
+            subject=self.subject,
+            group_id=self.producer_id,
+            content_type=streaming.STREAM_CONTENT_TYPE,
+            creation_time=time.time()
+            )
+        # the sequence number leads the payload, on a line of its own
+        stream = streaming.generated_stream(
+            json.dumps({'sequence':(self.sent+1)}, ensure_ascii=False).encode('utf-8') + b"\n",
+            self.payload_size)
+        outgoing = streaming.OutgoingStream(sender, msg.encode(), stream)
+
+        self.streams[sender] = outgoing
+        self.sent += 1
+        self.in_flight[sender.connection] += 1
+        if self.result_log is not None:
+            self.record_send(outgoing.delivery, 1)
+        if self.tracer is not None and self.tracer.sampled(self.sent):
+            self.tracer.emit('publish',
+                sequence=self.sent,
+                address=sender.target.address,
+                message_id=msg.id,
+                size=stream.length)
+
+
+    def pump_streams(self, container):
+        # writes what each link's session has room for, checking back on a timer until every stream is written
+        waiting = False
+        for sender in list(self.streams):
+            while sender in self.streams and self.streams[sender].pump():
+                self.streamed += 1
+                self.streamed_bytes += self.streams.pop(sender).stream.length
+                self.start_stream(sender)
+            if sender in self.streams:
+                waiting = True
+
+        if waiting and not self.stream_timer:
+            self.stream_timer = True
+            container.schedule(streaming.POLL_INTERVAL, self)
+
+
+    def on_timer_task(self, event):
+        self.stream_timer = False
+        self.pump_streams(event.container)
+
+
+    def record_send(self, delivery, count):
+        # logs the send, keeping its time until the delivery is settled
+        sent_time = time.monotonic()
+        self.send_times[delivery] = sent_time
+        self.result_log.record_send(sent_time, count=count)
 
 
     def on_accepted(self, event):
-        self.confirmed += 1
-        if self.confirmed == self.total:
-            event.connection.close()
+        # a batch confirms all of the messages packed into it
+        count = self.batch_sizes.pop(event.delivery, 1)
+        self.confirmed += count
+        self.in_flight[event.connection] -= count
+        self.confirmed_by_address[event.link.target.address] += count
+        if self.result_log is not None:
+            self.result_log.record_confirm(self.send_times.pop(event.delivery), count=count)
+        self.close_if_settled()
+
+
+    def on_rejected(self, event):
+        # rejected messages aren't sent again, but they are done with
+        count = self.batch_sizes.pop(event.delivery, 1)
+        self.rejected += count
+        self.in_flight[event.connection] -= count
+        if self.result_log is not None:
+            self.result_log.record_confirm(self.send_times.pop(event.delivery), count=count, nacked=True)
+        self.close_if_settled()
+
+
+    def on_released(self, event):
+        # proton reports modified deliveries here too
+        if event.delivery.remote_state == Delivery.MODIFIED:
+            self.on_modified(event)
+        else:
+            self.resend(event)
+
+
+    def on_modified(self, event):
+        # a delivery the broker marks undeliverable won't be taken here if it's sent again, so it's done with
+        if not event.delivery.remote.undeliverable:
+            self.resend(event)
+            return
+
+        count = self.batch_sizes.pop(event.delivery, 1)
+        self.undeliverable += count
+        self.in_flight[event.connection] -= count
+        if self.result_log is not None:
+            self.result_log.record_confirm(self.send_times.pop(event.delivery), count=count, nacked=True)
+        self.close_if_settled()
+
+
+    def resend(self, event):
+        # the broker didn't take the delivery, so its messages are sent again
+        count = self.batch_sizes.pop(event.delivery, 1)
+        self.sent -= count
+        self.in_flight[event.connection] -= count
+        if self.result_log is not None:
+            self.result_log.record_confirm(self.send_times.pop(event.delivery), count=count, nacked=True)
+        # on_sendable only fires again once the broker tops up the credit
+        if event.link.credit:
+            self.on_sendable(event)
+
+
+    def close_if_settled(self):
+        # closes the connections once every message has been accepted, rejected or found undeliverable
+        if self.confirmed + self.rejected + self.undeliverable == self.total:
+            for messaging_connection in self.messaging_connections:
+                messaging_connection.close()
 
 
     def on_disconnected(self, event):
-        self.sent = self.confirmed
-        logging.debug("Disconnected from %s", clean_url(self.url))
+        # anything unconfirmed on this connection will be sent again
+        self.sent -= self.in_flight.get(event.connection, 0)
+        self.in_flight[event.connection] = 0
+        self.batch_sizes = dict((delivery, count) for (delivery, count) in self.batch_sizes.items()
+            if delivery.link.connection != event.connection)
+        self.send_times = dict((delivery, sent_time) for (delivery, sent_time) in self.send_times.items()
+            if delivery.link.connection != event.connection)
+        self.streams = dict((sender, outgoing) for (sender, outgoing) in self.streams.items()
+            if sender.connection != event.connection)
+        logging.debug("Disconnected from %s", cli.clean_url(self.url))
 
 
 # --- START OF MAIN ----------------------------------------------------------
 
 def main():
     start_time = datetime.datetime.now()
-    (broker, resource, max_messages, persistent, subject, user_id, log_level) = process_options()
+    (broker, resources, links, connections, max_messages, persistent, subject, user_id, batcher, compressor, payload_size, tracer,
+        profiler, result_log, monitor, log_level) = process_options()
 
-    logging.basicConfig(
-            level=log_level,
-            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
-        )
-    logging.debug("%s Started", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+    cli.setup_logging(log_level)
+    if monitor:
+        monitor.start()
 
     if max_messages > 0:
         try:
-            Container(
-                    Send(broker, resource, max_messages, persistent, subject, user_id)
-                    ).run()
+            sender = Send(broker, resources, links, connections, max_messages, persistent, subject, user_id, batcher, compressor, tracer,
+                result_log, payload_size)
+            if profiler:
+                profiler.instrument(sender, PROFILED_CALLBACKS)
+                profiler.run(Container(sender).run)
+            else:
+                Container(sender).run()
             exec_time = datetime.datetime.now() - start_time
-            logging.info("%s messages sent in %s", max_messages, exec_time)
+            logging.info("%s messages sent and %s confirmed in %s", sender.sent, sender.confirmed, exec_time)
+            if sender.rejected:
+                logging.info("%s messages rejected by the broker", sender.rejected)
+            if sender.undeliverable:
+                logging.info("%s messages undeliverable", sender.undeliverable)
+            for resource in resources:
+                logging.info("  %s messages confirmed on %s", sender.confirmed_by_address[resource], resource)
+            if compressor:
+                logging.info("%s compression: %s", compressor.codec, compressor.summary())
+            if sender.streamed:
+                logging.info("Streaming: %s", streaming.sent_summary(sender.streamed, sender.streamed_bytes))
         except KeyboardInterrupt:
             logging.info("Keyboard interrupt received")
         except Exception as e:
             raise e
+        finally:
+            # reported however the run ended, so an interrupted run still shows where its time went
+            if profiler:
+                profiler.report(logging)
+            if tracer:
+                tracer.close()
+            if result_log:
+                result_log.close()
+
+    if monitor:
+        monitor.stop()
+        for line in monitor.summary_lines():
+            logging.info("Broker %s", line)
 
     logging.debug("%s Finished", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
 
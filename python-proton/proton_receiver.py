@@ -9,6 +9,18 @@ Created on 13th Jan 2017
     Execute script with -h parameter for usage
 '''
 
+# --- CONSTANTS --------------------------------------------------------------
+
+# lifecycle callbacks timed by --phases
+PROFILED_CALLBACKS = [
+    "on_start",
+    "on_link_opened",
+    "on_message",
+    "on_delivery",
+    "on_link_flow",
+    "on_disconnected"]
+
+
 # --- LIBRARIES --------------------------------------------------------------
 
 import sys
@@ -18,11 +30,17 @@ if sys.version_info[0] < 3:
 import argparse
 import logging
 import datetime
-import re
+import time
+import os
 
+from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container, DurableSubscription
 
+# shared client code lives in the python-common folder alongside this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "python-common"))
+from amqp_common import batching, capture, cli, compression, monitoring, profiling, sequencing, streaming, tracing
+
 # --- FUNCTIONS --------------------------------------------------------------
 
 def process_options():
@@ -37,78 +55,179 @@ def process_options():
         default="localhost:5672",
         help="broker connection string")
     opts.add_argument("--topic", "-t",
+        nargs="+",
         required=False,
-        help="topic name")
+        help="topic name(s)")
     opts.add_argument("--queue", "-q",
+        nargs="+",
+        required=False,
+        help="queue name(s)")
+    opts.add_argument("--links", "-l",
+        type=int,
+        default=1,
+        required=False,
+        help="number of receiver links to open per address")
+    opts.add_argument("--connections", "-c",
+        type=int,
+        default=1,
         required=False,
-        help="queue name")
+        help="number of connections to spread the links across")
     opts.add_argument("--max_messages", "-m",
         type=int,
         default=100,
         required=True,
-        help="number of messages to receive before stopping. Setting '0' retrieves indefinitely")
+        help="number of messages to receive (across all links) before stopping. Setting '0' retrieves indefinitely")
     opts.add_argument("--subscription_name", "-n",
         required=False,
         help="subscription name (durable)")
-    opts.add_argument("--verbose", "-v",
+    opts.add_argument("--catch_up",
+        type=int,
+        default=0,
+        required=False,
+        help="drain the backlog with this much credit at a time, reporting how long it takes, then stop")
+    opts.add_argument("--capture",
+        required=False,
+        help="directory to capture received messages to (replayable by the file senders)")
+    opts.add_argument("--capture_compression",
+        choices=["none", "gzip", "zstd"],
+        default="none",
+        required=False,
+        help="compression of the capture segments")
+    opts.add_argument("--verify",
         required=False,
         default=False,
         action="store_true",
-        help="send log messages to sysout")
+        help="check the producers' sequence numbers for gaps, duplicates and reordering")
+    opts.add_argument("--verify_window",
+        type=int,
+        default=65536,
+        required=False,
+        help="how far out of order a message may arrive before the messages it skipped are counted as gaps")
+    streaming.add_options(opts)
+    tracing.add_options(opts)
+    profiling.add_options(opts)
+    monitoring.add_options(opts)
+    cli.add_verbose_option(opts)
     options = opts.parse_args()
 
+    if options.capture_compression == "zstd" and not capture.ZSTD_AVAILABLE:
+        opts.error("zstd capture requires the 'zstandard' package to be installed")
+
     # Check that the connection string looks sensible
-    checkConnection = re.match('(.*):\d{1,5}', options.broker, )
-    if not(checkConnection):
-        opts.error("The broker connection string looks a bit dodgy.  It should be something like 'localhost:5672'")
+    cli.check_broker(opts, options.broker, "proton")
 
-    # check that one and only one of topic or queue was specified
-    if options.topic and options.queue:
-        opts.error("You may only specify either a queue or a topic")
+    # check that at least one topic or queue was specified
     if not(options.topic) and not(options.queue):
-        opts.error("You must specify either a queue or a topic")
+        opts.error("You must specify at least one queue or topic")
+
+    if options.links < 1 or options.connections < 1:
+        opts.error("The number of links and connections must both be at least 1")
+    if options.catch_up < 0:
+        opts.error("The catch-up credit window cannot be negative")
 
     # add the correct internal protocol
-    if options.topic:
-        resource = "topic://" + options.topic
+    resources = []
+    for topic in options.topic or []:
+        resources.append("topic://" + topic)
+    for queue in options.queue or []:
+        resources.append("queue://" + queue)
+
+    if options.verify:
+        verifier = sequencing.SequenceVerifier(options.verify_window, logging)
     else:
-        resource = "queue://" + options.queue
+        verifier = None
 
-    if options.verbose:
-        log_level = logging.DEBUG
-    else:
-        log_level = logging.INFO
+    log_level = cli.log_level(options)
 
     return(
         options.broker,
-        resource,
+        resources,
+        options.links,
+        options.connections,
         options.max_messages,
         options.subscription_name,
+        options.catch_up,
+        options.capture,
+        options.capture_compression,
+        verifier,
+        streaming.from_options(opts, options),
+        tracing.from_options(options),
+        profiling.from_options(options),
+        monitoring.from_options(opts, options, "activemq", resources),
         log_level)
 
 
-def clean_url(dirty_url):
-    # removes ID and password from URL, if present
-    if "@" in dirty_url:
-        return dirty_url.split('@', 1)[1]
-    else:
-        return dirty_url
+def capture_message(message):
+    # splits the message into a dict of properties and a bytes body for the capture log
+    captured = {
+        "id": message.id,
+        "subject": message.subject,
+        "address": message.address,
+        "reply_to": message.reply_to,
+        "correlation_id": message.correlation_id,
+        "content_type": message.content_type,
+        "content_encoding": message.content_encoding,
+        "creation_time": message.creation_time,
+        "durable": message.durable,
+        "priority": message.priority,
+        "ttl": message.ttl,
+        "properties": message.properties
+    }
+    if message.user_id:
+        captured["user_id"] = message.user_id.decode('utf-8', 'replace')
+
+    (body, captured["body_type"]) = capture.encode_body(message.body)
+
+    return (dict((name, value) for (name, value) in captured.items() if value is not None), body)
 
 
 # --- CLASSES ----------------------------------------------------------------
 
 class Recv(MessagingHandler):
-    def __init__(self, url, resource, count, subscription_name):
-        super(Recv, self).__init__()
+    def __init__(self, url, resources, links, connections, count, subscription_name, capture_writer=None, verifier=None, tracer=None,
+            catch_up=0, stream_sink=None):
+        if catch_up:
+            # credit is granted by drain requests rather than by the flow controller
+            super(Recv, self).__init__(prefetch=0)
+        else:
+            super(Recv, self).__init__()
         self.url = url
-        self.resource = resource
+        self.resources = resources
+        self.links = links
+        self.connections = connections
         self.expected = count
         self.subscription_name = subscription_name
-        self.received = []
+        self.capture_writer = capture_writer
+        self.verifier = verifier
+        self.tracer = tracer
+        self.stream_sink = stream_sink
+        # a SectionReader for each delivery whose transfers are still arriving
+        self.streams = {}
+        self.received = set()
         self.count = 0
+        self.first_message_time = datetime.datetime.now()
+        self.stopping = False
+        self.compression_stats = compression.CompressionStats()
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        # catch-up progress for each receiver link
+        self.catch_up = catch_up
+        self.started = None
+        self.drained = {}
+        self.backlog = {}
+        self.attached = {}
+        self.caught_up = {}
+
+        # shared accounting across every link driven by the container
+        self.messaging_connections = []
+        self.receivers = []
+        self.count_by_address = dict((resource, 0) for resource in resources)
 
 
     def on_start(self, event):
+        self.started = time.perf_counter()
         if self.subscription_name:
             logging.debug("Naming durable subscription %s", self.subscription_name)
             durable = DurableSubscription()
@@ -118,64 +237,292 @@ class Recv(MessagingHandler):
 
         event.container.container_id = self.subscription_name
 
-        messaging_connection = event.container.connect(self.url)
-        event.container.create_receiver(
-            messaging_connection,
-            self.resource,
-            name=self.subscription_name,
-            options=durable
-        )
-        logging.debug("Connected to %s %s", clean_url(self.url), self.resource)
+        for i in range(self.connections):
+            self.messaging_connections.append(event.container.connect(self.url))
 
+        # spread the links round-robin over the connections
+        for resource in self.resources:
+            for i in range(self.links):
+                messaging_connection = self.messaging_connections[len(self.receivers) % self.connections]
+                self.receivers.append(event.container.create_receiver(
+                    messaging_connection,
+                    resource,
+                    name=self.link_name(len(self.receivers)),
+                    options=durable
+                ))
+                logging.debug("Connected to %s %s", cli.clean_url(self.url), resource)
 
-    def on_message(self, event):
-        global first_message_time
 
+    def on_link_opened(self, event):
+        # in catch-up mode, ask for the backlog as soon as the link is (re)attached
+        if self.catch_up and event.receiver:
+            self.attached[event.receiver] = time.perf_counter()
+            self.backlog[event.receiver] = 0
+            self.drain(event.receiver)
+
+
+    def drain(self, receiver):
+        self.drained[receiver] = 0
+        receiver.drain(self.catch_up)
+
+
+    def on_link_flow(self, event):
+        # the broker answers a drain with a flow once it has sent all it can;
+        # anything short of the full window means the backlog is empty
+        receiver = event.receiver
+        if not self.catch_up or receiver not in self.drained or receiver in self.caught_up or receiver.draining():
+            return
+
+        self.backlog[receiver] += self.drained[receiver]
+        if self.drained[receiver] < self.catch_up:
+            self.caught_up[receiver] = time.perf_counter()
+            logging.debug("Caught up on %s after %s messages", receiver.source.address, self.backlog[receiver])
+            if len(self.caught_up) == len(self.receivers):
+                self.report_catch_up()
+                self.finish()
+        else:
+            self.drain(receiver)
+
+
+    def report_catch_up(self):
+        for receiver in self.receivers:
+            catch_up_time = self.caught_up[receiver] - self.attached[receiver]
+            logging.info("%s: attached in %0.3fms, backlog of %s drained in %0.3fms (%0.1f msg/s)",
+                receiver.name or receiver.source.address,
+                1000 * (self.attached[receiver] - self.started),
+                self.backlog[receiver],
+                1000 * catch_up_time,
+                self.backlog[receiver] / catch_up_time if catch_up_time else 0)
+
+        total = sum(self.backlog.values())
+        catch_up_time = max(self.caught_up.values()) - self.started
+        logging.info("Caught up on a backlog of %s messages in %0.3fms (%0.1f msg/s)",
+            total,
+            1000 * catch_up_time,
+            total / catch_up_time if catch_up_time else 0)
+
+
+    def link_name(self, link_number):
+        # durable subscriptions need a distinct name per link
+        if not self.subscription_name:
+            return None
+        if len(self.resources) * self.links == 1:
+            return self.subscription_name
+        return "%s-%s" % (self.subscription_name, link_number)
+
+
+    def on_delivery(self, event):
+        # a delivery spread over several transfers is read as they arrive, rather than
+        # left for proton to hold until the last one, so that a large body can be
+        # written out a transfer at a time; everything else is left to on_message
+        delivery = event.delivery
+        if self.stream_sink is None or not delivery.link.is_receiver:
+            return
+        if delivery not in self.streams and not delivery.partial:
+            return
+
+        reader = self.streams.get(delivery)
+        if reader is None:
+            reader = self.streams[delivery] = streaming.SectionReader(self.stream_sink, self.streamable)
+        if delivery.pending:
+            reader.feed(event.receiver.recv(delivery.pending))
+        if delivery.partial:
+            return
+
+        del self.streams[delivery]
+        event.receiver.advance()
+        event.message = Message()
+        event.message.decode(reader.encoded())
+        if reader.stream_file is not None:
+            properties = event.message.properties or {}
+            event.message.body = self.stream_sink.finished(reader.stream_file,
+                properties.get(streaming.STREAM_NAME_PROPERTY) or event.message.id)
+
+        self.on_message(event)
+        self.accept(delivery)
+
+
+    def streamable(self, preamble):
+        # compressed bodies and batches are read whole, to be unpacked
+        head = Message()
+        head.decode(preamble)
+        return streaming.streamable(head.content_type, compression.COMPRESSION_PROPERTY in (head.properties or {}))
+
+
+    def on_message(self, event):
         if self.count == 0:
-            first_message_time = datetime.datetime.now()
+            self.first_message_time = datetime.datetime.now()
+
+        # a streamed body has already been written out, keeping only its first line to hand
+        streamed = isinstance(event.message.body, streaming.StreamFile)
+
+        if self.catch_up:
+            self.drained[event.receiver] += 1
 
-        if event.message.id and event.message.id in self.received:
+        # the sequence verifier finds duplicates in constant memory, so the
+        # message ids only need remembering when it isn't in use
+        if not self.verifier and event.message.id and event.message.id in self.received:
             logging.error("Duplicate message received %s", event.message.body)
             return
 
-        # print the message out
-        logging.debug(event.message)
+        # per-message detail goes to the sampled trace, keeping logging off the hot path
+        if self.tracer is not None and self.tracer.sampled(self.count + 1):
+            self.tracer.emit('receive',
+                count=self.count + 1,
+                address=event.receiver.source.address,
+                message_id=event.message.id,
+                group_id=event.message.group_id,
+                content_type=event.message.content_type,
+                delivery_count=event.message.delivery_count)
+
+        if self.capture_writer and not streamed:
+            (captured, body) = capture_message(event.message)
+            self.capture_writer.append(captured, body, time.time())
+
+        # compressed bodies are only decompressed if something needs to look inside them
+        properties = event.message.properties
+        if properties and compression.COMPRESSION_PROPERTY in properties:
+            self.compression_stats.record(len(event.message.body),
+                properties.get(compression.ORIGINAL_LENGTH_PROPERTY))
+        elif isinstance(event.message.body, (bytes, str, streaming.StreamFile)):
+            self.compression_stats.record(len(event.message.body))
+
+        # a body in an encoding that can't be read here counts as one message, unopened
+        encoding = properties.get(compression.COMPRESSION_PROPERTY) if properties else None
+        decodable = compression.decodable(encoding)
+        if not decodable and self.compression_stats.record_undecodable(encoding):
+            logging.warning("Unsupported encoding %s (available: %s), bodies in it are counted but not unpacked or verified",
+                encoding,
+                ", ".join(sorted(compression.CODECS)))
+
+        # batches count as each of the messages packed into them
+        if decodable and event.message.content_type == batching.BATCH_CONTENT_TYPE:
+            entries = self.unpack_batch(compression.decompress_value(event.message.body, properties))
+            received = len(entries)
+        else:
+            entries = None
+            received = 1
+            if event.message.creation_time:
+                self.record_latency(time.time() - event.message.creation_time)
+
+        if self.verifier and decodable:
+            if streamed:
+                result = self.verifier.add(event.message.group_id, sequencing.extract_sequence(
+                    event.message.body.first_line()))
+            elif entries is None:
+                result = self.verifier.add(event.message.group_id, sequencing.extract_sequence(
+                    compression.decompress_value(event.message.body, properties)))
+                if result == 'duplicate':
+                    return
+            else:
+                for (sent, payload) in entries:
+                    self.verifier.add(event.message.group_id, sequencing.extract_sequence(payload))
+
+        self.count += received
+        self.count_by_address[event.receiver.source.address] += received
+        if event.message.id and not self.verifier:
+            self.received.add(event.message.id)
 
-        self.count += 1
-        if event.message.id:
-            self.received.append(event.message.id)
+        if self.expected and self.count >= self.expected:
+            self.finish()
 
-        if self.count == self.expected:
+
+    def finish(self):
+        # detaches from (or closes) every link and reports on the run
+        if self.stopping:
+            return
+
+        self.stopping = True
+        for receiver in self.receivers:
             if self.subscription_name:
-                event.receiver.detach()
+                receiver.detach()
             else:
-                event.receiver.close()
+                receiver.close()
+
+        for messaging_connection in self.messaging_connections:
+            messaging_connection.close()
+
+        message_processing_time = datetime.datetime.now() - self.first_message_time
+        logging.info("%s messages received in %s", self.count, message_processing_time)
+        if self.latency_count:
+            logging.info("Latency mean %0.3fms max %0.3fms",
+                1000 * self.latency_total / self.latency_count,
+                1000 * self.latency_max)
+        if self.compression_stats.compressed or self.compression_stats.undecodable:
+            logging.info("Compression: %s", self.compression_stats.summary())
+        for resource in self.resources:
+            logging.info("  %s messages received on %s", self.count_by_address[resource], resource)
+        logging.debug("Disconnected from %s", cli.clean_url(self.url))
+
+
+    def unpack_batch(self, body):
+        # measures each packed message from when the producer added it to the batch
+        received = time.time()
+        entries = batching.unpack(body)
 
-            event.connection.close()
+        for (sent, payload) in entries:
+            self.record_latency(received - sent)
 
-            message_processing_time = datetime.datetime.now() - first_message_time
-            logging.info("%s messages received in %s", self.count, message_processing_time)
-            logging.debug("Disconnected from %s", clean_url(self.url))
+        return entries
+
+
+    def record_latency(self, latency):
+        self.latency_count += 1
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
 
 
 # --- START OF MAIN ----------------------------------------------------------
 
 def main():
     start_time = datetime.datetime.now()
-    (broker, resource, max_messages, subscription_name, log_level) = process_options()
+    (broker, resources, links, connections, max_messages, subscription_name, catch_up,
+        capture_dir, capture_compression, verifier, stream_sink, tracer, profiler, monitor, log_level) = process_options()
 
-    logging.basicConfig(
-            level=log_level,
-            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
-        )
-    logging.debug("%s Started", datetime.datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"))
+    cli.setup_logging(log_level)
+    if monitor:
+        monitor.start()
+
+    if capture_dir:
+        logging.debug("Capturing messages to %s", capture_dir)
+        capture_writer = capture.CaptureWriter(capture_dir, capture_compression)
+    else:
+        capture_writer = None
+
+    receiver = Recv(broker, resources, links, connections, max_messages, subscription_name, capture_writer, verifier, tracer,
+        catch_up=catch_up, stream_sink=stream_sink)
+    if profiler:
+        profiler.instrument(receiver, PROFILED_CALLBACKS)
 
     try:
-        Container(Recv(broker, resource, max_messages, subscription_name)).run()
+        if profiler:
+            profiler.run(Container(receiver).run)
+        else:
+            Container(receiver).run()
     except KeyboardInterrupt:
         logging.info("Keyboard interrupt received")
     except Exception as e:
         raise e
+    finally:
+        if capture_writer:
+            capture_writer.close()
+            logging.info("%s messages captured to %s", capture_writer.captured, capture_dir)
+        if tracer:
+            tracer.close()
+        if stream_sink:
+            stream_sink.close()
+
+    if verifier:
+        logging.info("Sequence check: %s", verifier.summary())
+    if stream_sink:
+        logging.info("Streaming: %s", stream_sink.summary())
+    if monitor:
+        monitor.stop()
+        for line in monitor.summary_lines():
+            logging.info("Broker %s", line)
+    if profiler:
+        profiler.report(logging)
 
     exec_time = datetime.datetime.now() - start_time
     logging.debug("Execution time %s", exec_time)
@@ -187,7 +534,4 @@ def main():
 
 
 if __name__ == "__main__":
-    # initialise first message time (global variable used to calculate timings)
-    first_message_time = datetime.datetime.now()
-
     main()
@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+'''
+    Generates, validates and diffs RabbitMQ definitions files.
+
+    generate - expands a compact JSON spec into thousands of vhosts,
+               exchanges, queues, bindings and policies, merged onto a base
+               definitions file (e.g. rabbitmq-defs.json)
+    validate - checks a definitions file for missing fields, duplicates,
+               dangling references and bad policy patterns
+    diff     - compares two definitions files by key, optionally writing the
+               added and changed definitions out as a file of their own, which
+               can be imported on top of a broker already loaded with the first
+
+    Each spec entry is a template with a count; {name} in a string value is
+    replaced by i (0 to count-1) or by any variable named in "mod" (i modulo
+    the given value) or "div" (i divided by the given value).  Any other
+    braces, such as regular expression quantifiers in policy patterns, are
+    left alone...
+
+        {"queues": [{"name": "bench.q.{i}", "count": 10000}],
+         "bindings": [{"source": "bench.x.{e}", "destination": "bench.q.{i}",
+                       "routing_key": "bench.{i}", "count": 10000, "mod": {"e": 100}}]}
+
+    Execute script with -h parameter for usage
+'''
+
+# --- LIBRARIES --------------------------------------------------------------
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception("Python 3 or a more recent version is required.")
+
+import argparse
+import logging
+
+import json
+import re
+
+
+# --- CONSTANTS --------------------------------------------------------------
+
+# the sections of a definitions file and how the items in each are identified
+KEYS = {
+    "users": lambda item: item["name"],
+    "vhosts": lambda item: item["name"],
+    "permissions": lambda item: (item["user"], item["vhost"]),
+    "parameters": lambda item: (item["vhost"], item["component"], item["name"]),
+    "global_parameters": lambda item: item["name"],
+    "policies": lambda item: (item["vhost"], item["name"]),
+    "queues": lambda item: (item["vhost"], item["name"]),
+    "exchanges": lambda item: (item["vhost"], item["name"]),
+    "bindings": lambda item: (item["vhost"], item["source"], item["destination"], item["destination_type"],
+        item.get("routing_key", ""), json.dumps(item.get("arguments", {}), sort_keys=True))}
+
+# a template variable, e.g. {i}
+VARIABLE = re.compile(r"\{(\w+)\}")
+
+REQUIRED_FIELDS = {
+    "users": ["name", "tags"],
+    "vhosts": ["name"],
+    "permissions": ["user", "vhost", "configure", "write", "read"],
+    "parameters": ["vhost", "component", "name", "value"],
+    "global_parameters": ["name", "value"],
+    "policies": ["vhost", "name", "pattern", "definition"],
+    "queues": ["vhost", "name"],
+    "exchanges": ["vhost", "name", "type"],
+    "bindings": ["vhost", "source", "destination", "destination_type"]}
+
+# fields filled in for generated items that the spec leaves out
+DEFAULTS = {
+    "vhosts": {},
+    "queues": {"vhost": "/", "durable": True, "auto_delete": False, "arguments": {}},
+    "exchanges": {"vhost": "/", "type": "direct", "durable": True, "auto_delete": False, "internal": False, "arguments": {}},
+    "bindings": {"vhost": "/", "destination_type": "queue", "routing_key": "", "arguments": {}},
+    "policies": {"vhost": "/", "apply-to": "all", "priority": 0},
+    "permissions": {"vhost": "/", "configure": "", "write": "", "read": ""}}
+
+EXCHANGE_TYPES = ["direct", "fanout", "topic", "headers", "x-consistent-hash", "x-delayed-message"]
+POLICY_TARGETS = ["all", "queues", "exchanges"]
+SPEC_FIELDS = ["count", "mod", "div"]
+
+
+# --- FUNCTIONS --------------------------------------------------------------
+
+def process_options():
+    '''
+    Processes command line options
+    '''
+
+    opts = argparse.ArgumentParser(description="Generates, validates and diffs RabbitMQ definitions files.")
+    commands = opts.add_subparsers(dest="command")
+
+    generate = commands.add_parser("generate", help="expand a topology spec into a definitions file")
+    generate.add_argument("--spec", "-s",
+        required=True,
+        help="JSON topology spec")
+    generate.add_argument("--base", "-b",
+        required=False,
+        help="definitions file to add the generated topology to")
+    generate.add_argument("--output", "-o",
+        required=False,
+        help="file to write the definitions to (defaults to stdout)")
+
+    validate = commands.add_parser("validate", help="check a definitions file for errors")
+    validate.add_argument("definitions",
+        help="definitions file")
+
+    diff = commands.add_parser("diff", help="compare two definitions files")
+    diff.add_argument("old",
+        help="definitions file already loaded")
+    diff.add_argument("new",
+        help="definitions file to compare against it")
+    diff.add_argument("--output", "-o",
+        required=False,
+        help="write the added and changed definitions to this file")
+
+    for command in [generate, validate, diff]:
+        command.add_argument("--verbose", "-v",
+            required=False,
+            default=False,
+            action="store_true",
+            help="send log messages to sysout")
+    options = opts.parse_args()
+
+    if not options.command:
+        opts.error("A command is required")
+
+    if options.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+
+    return(
+        options,
+        log_level)
+
+
+def load(filename):
+    with open(filename) as a_file:
+        return json.load(a_file)
+
+
+def save(definitions, filename):
+    # writes to stdout if no filename is given
+    if filename:
+        with open(filename, 'w') as a_file:
+            json.dump(definitions, a_file, indent=4)
+            a_file.write("\n")
+    else:
+        json.dump(definitions, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+
+
+def expand(value, variables):
+    # substitutes the variables into every string inside a template value
+    if isinstance(value, str):
+        return VARIABLE.sub(lambda match: str(variables.get(match.group(1), match.group(0))), value)
+    if isinstance(value, dict):
+        return dict((expand(k, variables), expand(v, variables)) for (k, v) in value.items())
+    if isinstance(value, list):
+        return [expand(v, variables) for v in value]
+    return value
+
+
+def generate_section(section, templates):
+    # yields the items described by each of a section's templates
+    for template in templates:
+        item_template = dict(DEFAULTS.get(section, {}))
+        item_template.update((k, v) for (k, v) in template.items() if k not in SPEC_FIELDS)
+
+        for i in range(template.get("count", 1)):
+            variables = {"i": i}
+            for (name, modulus) in template.get("mod", {}).items():
+                variables[name] = i % modulus
+            for (name, divisor) in template.get("div", {}).items():
+                variables[name] = i // divisor
+
+            yield expand(item_template, variables)
+
+
+def merge(definitions, section, items):
+    # adds items to a section of the definitions, replacing any with the same key
+    key = KEYS[section]
+    merged = dict((key(item), item) for item in definitions.get(section, []))
+    before = len(merged)
+
+    for item in items:
+        merged[key(item)] = item
+
+    definitions[section] = list(merged.values())
+    return len(merged) - before
+
+
+def validate(definitions):
+    # returns a list of the problems found
+    errors = []
+
+    for section in KEYS:
+        seen = set()
+        for (n, item) in enumerate(definitions.get(section, [])):
+            missing = [field for field in REQUIRED_FIELDS[section] if field not in item]
+            if missing:
+                errors.append("%s[%s] is missing %s" % (section, n, ", ".join(missing)))
+                continue
+
+            key = KEYS[section](item)
+            if key in seen:
+                errors.append("%s[%s] duplicates %s" % (section, n, key))
+            seen.add(key)
+
+    vhosts = set(vhost["name"] for vhost in definitions.get("vhosts", []) if "name" in vhost)
+    users = set(user["name"] for user in definitions.get("users", []) if "name" in user)
+    queues = set((q.get("vhost"), q.get("name")) for q in definitions.get("queues", []))
+    exchanges = set((x.get("vhost"), x.get("name")) for x in definitions.get("exchanges", []))
+
+    for section in ["permissions", "parameters", "policies", "queues", "exchanges", "bindings"]:
+        for item in definitions.get(section, []):
+            if "vhost" in item and item["vhost"] not in vhosts:
+                errors.append("%s %s refers to unknown vhost %s" % (section, item.get("name", ""), item["vhost"]))
+
+    for permission in definitions.get("permissions", []):
+        if permission.get("user") not in users:
+            errors.append("Permission refers to unknown user %s" % permission.get("user"))
+        for access in ["configure", "write", "read"]:
+            if not valid_pattern(permission.get(access, "")):
+                errors.append("Permission for %s has invalid %s pattern" % (permission.get("user"), access))
+
+    for exchange in definitions.get("exchanges", []):
+        if exchange.get("type") not in EXCHANGE_TYPES:
+            errors.append("Exchange %s has unknown type %s" % (exchange.get("name"), exchange.get("type")))
+
+    for binding in definitions.get("bindings", []):
+        if "source" not in binding or "destination" not in binding:
+            continue
+        vhost = binding.get("vhost")
+        if binding["source"] and not binding["source"].startswith("amq.") and (vhost, binding["source"]) not in exchanges:
+            errors.append("Binding from unknown exchange %s" % binding["source"])
+        if binding.get("destination_type") == "queue":
+            if (vhost, binding["destination"]) not in queues:
+                errors.append("Binding to unknown queue %s" % binding["destination"])
+        elif binding.get("destination_type") == "exchange":
+            if (vhost, binding["destination"]) not in exchanges and not binding["destination"].startswith("amq."):
+                errors.append("Binding to unknown exchange %s" % binding["destination"])
+        else:
+            errors.append("Binding to %s has unknown destination type %s" % (
+                binding["destination"], binding.get("destination_type")))
+
+    for policy in definitions.get("policies", []):
+        if not valid_pattern(policy.get("pattern", "")):
+            errors.append("Policy %s has an invalid pattern" % policy.get("name"))
+        if policy.get("apply-to", "all") not in POLICY_TARGETS:
+            errors.append("Policy %s applies to unknown %s" % (policy.get("name"), policy.get("apply-to")))
+        if not isinstance(policy.get("priority", 0), int):
+            errors.append("Policy %s priority is not an integer" % policy.get("name"))
+
+    for section in ["queues", "exchanges"]:
+        for item in definitions.get(section, []):
+            if len(item.get("name", "").encode('utf-8')) > 255:
+                errors.append("%s name longer than 255 bytes - %s..." % (section, item["name"][:32]))
+
+    return errors
+
+
+def valid_pattern(pattern):
+    # the broker uses Erlang regular expressions, which Python's are close enough to for checking
+    try:
+        re.compile(pattern)
+        return True
+    except re.error:
+        return False
+
+
+def diff(old, new):
+    # returns (added, changed, removed) dicts of lists, by section
+    added = {}
+    changed = {}
+    removed = {}
+
+    for (section, key) in KEYS.items():
+        old_items = dict((key(item), item) for item in old.get(section, []))
+        new_items = dict((key(item), item) for item in new.get(section, []))
+
+        added[section] = [item for (k, item) in new_items.items() if k not in old_items]
+        changed[section] = [item for (k, item) in new_items.items() if k in old_items and old_items[k] != item]
+        removed[section] = [item for (k, item) in old_items.items() if k not in new_items]
+
+    return (added, changed, removed)
+
+
+# --- START OF MAIN ----------------------------------------------------------
+
+def main():
+    (options, log_level) = process_options()
+
+    logging.basicConfig(
+            level=log_level,
+            format='[%(levelname)s] (%(threadName)-10s) %(message)s',
+        )
+
+    if options.command == "generate":
+        spec = load(options.spec)
+        if options.base:
+            definitions = load(options.base)
+        else:
+            definitions = {"vhosts": [{"name": "/"}]}
+
+        for section in KEYS:
+            if section in spec:
+                added = merge(definitions, section, generate_section(section, spec[section]))
+                logging.info("%s %s added (%s in total)", added, section, len(definitions[section]))
+
+        errors = validate(definitions)
+        for error in errors:
+            logging.warning(error)
+
+        save(definitions, options.output)
+
+    elif options.command == "validate":
+        definitions = load(options.definitions)
+        errors = validate(definitions)
+        for error in errors:
+            logging.error(error)
+
+        for section in KEYS:
+            logging.debug("%s %s", len(definitions.get(section, [])), section)
+        logging.info("%s errors found", len(errors))
+        if errors:
+            sys.exit(1)
+
+    elif options.command == "diff":
+        (added, changed, removed) = diff(load(options.old), load(options.new))
+
+        for section in KEYS:
+            if added[section] or changed[section] or removed[section]:
+                logging.info("%-18s %6s added  %6s changed  %6s removed",
+                    section, len(added[section]), len(changed[section]), len(removed[section]))
+            for item in removed[section]:
+                logging.debug("Removed from %s - %s", section, KEYS[section](item))
+
+        if options.output:
+            # importing definitions only ever adds or updates, so removals can't be carried across
+            save(dict((section, added[section] + changed[section]) for section in KEYS
+                if added[section] or changed[section]), options.output)
+            if any(removed.values()):
+                logging.warning("Removed definitions are not in %s and must be deleted by hand", options.output)
+
+
+# --- END OF MAIN ------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
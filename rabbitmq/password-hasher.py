@@ -4,10 +4,14 @@ Created on 14th July 2017
 
 @author: Jeremy Gooch
 
-    Generates a salted SHA-256 hash of an incoming string,
+    Generates a salted hash of an incoming string,
     conformant to RabbitMQ's password hash computation
     https://www.rabbitmq.com/passwords.html
 
+    In bulk mode, reads users from a CSV file (or stdin), hashes their
+    passwords across a pool of processes and writes them, merged into an
+    existing definitions file if one is given, as RabbitMQ definitions JSON.
+
     Execute script with -h parameter for usage
 '''
 
@@ -21,14 +25,24 @@ import argparse
 import logging
 
 import os
-import binascii
 import hashlib
 import base64
+import csv
+import json
+import multiprocessing
 
 
 # --- CONSTANTS --------------------------------------------------------------
 SALT_LENGTH = 4
 
+# RabbitMQ's name for each hashing algorithm
+ALGORITHMS = {
+    "sha256": "rabbit_password_hashing_sha256",
+    "sha512": "rabbit_password_hashing_sha512",
+    "md5": "rabbit_password_hashing_md5"}
+
+CSV_FIELDS = ["name", "password", "tags", "vhost", "configure", "write", "read"]
+
 
 # --- FUNCTIONS --------------------------------------------------------------
 
@@ -37,11 +51,30 @@ def process_options():
     Processes command line options
     '''
 
-    opts = argparse.ArgumentParser(description="Generates a salted SHA-256 hash of an incoming string.")
+    opts = argparse.ArgumentParser(description="Generates a salted hash of an incoming string, or of many users' passwords.")
 
     opts.add_argument("input_string",
         nargs="?",
         help="input string")
+    opts.add_argument("-a", "--algorithm",
+        choices=sorted(ALGORITHMS),
+        default="sha256",
+        required=False,
+        help="hashing algorithm (must match the broker's password_hashing_module)")
+    opts.add_argument("-b", "--bulk",
+        required=False,
+        help="CSV file of users ('-' for stdin), one 'name,password[,tags[,vhost,configure,write,read]]' per line")
+    opts.add_argument("-d", "--definitions",
+        required=False,
+        help="existing definitions file to merge the bulk users into")
+    opts.add_argument("-o", "--output",
+        required=False,
+        help="file to write the bulk definitions to (defaults to stdout)")
+    opts.add_argument("-w", "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        required=False,
+        help="number of processes to hash bulk passwords with")
     opts.add_argument("-v", "--verbose",
         required=False,
         default=False,
@@ -49,50 +82,152 @@ def process_options():
         help="send log messages to sysout")
     options = opts.parse_args()
 
-    if not options.input_string:
-        opts.error("Input string required")
+    if not options.input_string and not options.bulk:
+        opts.error("Input string or bulk input file required")
+    if options.input_string and options.bulk:
+        opts.error("You may only specify either an input string or a bulk input file")
+    if options.workers < 1:
+        opts.error("At least one worker is required")
 
     if options.verbose:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
 
+    if options.input_string:
+        input_string = options.input_string.encode('utf-8')
+    else:
+        input_string = None
+
     return(
-        options.input_string.encode('utf-8'),
+        input_string,
+        options.algorithm,
+        options.bulk,
+        options.definitions,
+        options.output,
+        options.workers,
         log_level)
 
 
-def hextrim(binary_thing):
-    # extract just the hex bit of a binary representation
-    # TODO - there must be a neater way to do this bit rather than string slicing!
-    hex_end=len(str(binary_thing))-1
-    return str(binary_thing)[2:hex_end]
+def hash_password(password, algorithm="sha256"):
+    # returns the base64 encoding of a random salt followed by the hash of the salted password
+    salt = os.urandom(SALT_LENGTH)
+    hashed_salted_output = hashlib.new(algorithm, salt + password).digest()
+
+    return base64.b64encode(salt + hashed_salted_output).decode('ascii')
+
+
+def read_users(csv_file):
+    # yields a dict per CSV row, skipping blank lines and '#' comments
+    for row in csv.reader(csv_file):
+        if not row or row[0].startswith("#"):
+            continue
+        if len(row) < 2:
+            logging.warning("Row not structured 'name,password,...', ignoring - %s", row[0])
+            continue
+
+        yield dict(zip(CSV_FIELDS, row))
+
+
+def hash_user(job):
+    # hashes one user's password, returning their user and (optional) permission definitions
+    (user, algorithm) = job
+
+    user_definition = {
+        "name": user["name"],
+        "password_hash": hash_password(user["password"].encode('utf-8'), algorithm),
+        "hashing_algorithm": ALGORITHMS[algorithm],
+        "tags": user.get("tags") or "none"}
+
+    if user.get("vhost"):
+        permission_definition = {
+            "user": user["name"],
+            "vhost": user["vhost"],
+            "configure": user.get("configure", ""),
+            "write": user.get("write", ""),
+            "read": user.get("read", "")}
+    else:
+        permission_definition = None
+
+    return (user_definition, permission_definition)
+
+
+def hash_users(users, algorithm, workers):
+    # yields the definitions for each user, hashing across a process pool if there's more than one worker
+    jobs = ((user, algorithm) for user in users)
+
+    if workers == 1:
+        for result in map(hash_user, jobs):
+            yield result
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for result in pool.imap(hash_user, jobs, chunksize=256):
+                yield result
+
+
+def merge_definitions(definitions, results):
+    # adds or replaces users (by name) and permissions (by user and vhost), and adds
+    # any vhosts the permissions refer to, keeping everything else
+    users = dict((user["name"], user) for user in definitions.get("users", []))
+    permissions = dict(((permission["user"], permission["vhost"]), permission)
+        for permission in definitions.get("permissions", []))
+
+    count = 0
+    for (user_definition, permission_definition) in results:
+        users[user_definition["name"]] = user_definition
+        if permission_definition:
+            permissions[(permission_definition["user"], permission_definition["vhost"])] = permission_definition
+        count += 1
+
+    definitions["users"] = list(users.values())
+    definitions["permissions"] = list(permissions.values())
+
+    vhosts = definitions.setdefault("vhosts", [])
+    known_vhosts = set(vhost["name"] for vhost in vhosts)
+    for (user, vhost) in permissions:
+        if vhost not in known_vhosts:
+            vhosts.append({"name": vhost})
+            known_vhosts.add(vhost)
+
+    return count
 
 
 # --- START OF MAIN ----------------------------------------------------------
 
 def main():
-    (input_string, log_level) = process_options()
+    (input_string, algorithm, bulk, definitions_file, output, workers, log_level) = process_options()
 
     logging.basicConfig(
             level=log_level,
             format='[%(levelname)s] (%(threadName)-10s) %(message)s',
         )
 
-    # generate a random hexadecimal salt
-    salt = os.urandom(SALT_LENGTH)
+    if input_string:
+        logging.debug("Input string - %s", input_string)
+        print(hash_password(input_string, algorithm))
+        return
 
-    # concatenate the salt and the input string and hash the result
-    hashed_salted_output = hashlib.sha256(salt + input_string).digest()
+    if definitions_file:
+        with open(definitions_file) as a_file:
+            definitions = json.load(a_file)
+    else:
+        definitions = {}
 
-    # concatenate the hex salt again and base64 encode it all
-    encoded_output = base64.b64encode(salt + hashed_salted_output)
+    if bulk == "-":
+        count = merge_definitions(definitions, hash_users(read_users(sys.stdin), algorithm, workers))
+    else:
+        with open(bulk, newline='') as csv_file:
+            count = merge_definitions(definitions, hash_users(read_users(csv_file), algorithm, workers))
 
-    logging.debug("Input string - %s", input_string)
-    logging.debug("Salt - %s", salt)
-    logging.debug("Hashed and salted output - %s", hashed_salted_output)
+    logging.info("%s users hashed with %s across %s workers", count, algorithm, workers)
 
-    print(hextrim(encoded_output))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(definitions, output_file, indent=4)
+            output_file.write("\n")
+    else:
+        json.dump(definitions, sys.stdout, indent=4)
+        sys.stdout.write("\n")
 
 
 # --- END OF MAIN ------------------------------------------------------------